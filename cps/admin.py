@@ -51,6 +51,11 @@ from . import constants, logger, helper, services, cli_param
 from . import db, calibre_db, ub, web_server, config, updater_thread, gdriveutils, \
     kobo_sync_status, schedule, audit_helper
 from .tasks.database import TaskDatabaseHealthCheck
+from .tasks.content_index import TaskUpdateContentIndex
+from .document_index import document_index
+from .content_index import content_index, CONTENT_FORMATS
+from .metadata_gateway import metadata_gateway
+from .http_cache import http_cache
 from .helper import check_valid_domain, send_test_mail, reset_password, generate_password_hash, check_email, \
     valid_email, check_username
 from .embed_helper import get_calibre_binarypath
@@ -238,7 +243,8 @@ def admin():
 
     return render_title_template("admin.html", allUser=all_user, config=config, commit=commit,
                                  feature_support=feature_support, schedule_time=schedule_time,
-                                 schedule_duration=schedule_duration,
+                                 schedule_duration=schedule_duration, metadata_stats=metadata_gateway.get_stats(),
+                                 document_stats=document_index.get_stats(),
                                  title=_("Admin page"), page="admin")
 
 
@@ -616,6 +622,7 @@ def update_view_configuration():
     _config_int(to_save, "config_random_books")
     _config_int(to_save, "config_books_per_page")
     _config_int(to_save, "config_authors_max")
+    _config_checkbox(to_save, "config_fuzzy_search")
     _config_string(to_save, "config_default_language")
     _config_string(to_save, "config_default_locale")
 
@@ -1426,6 +1433,7 @@ def update_scheduledtasks():
     _config_checkbox(to_save, "schedule_generate_book_covers")
     _config_checkbox(to_save, "schedule_generate_series_covers")
     _config_checkbox(to_save, "schedule_metadata_backup")
+    _config_checkbox(to_save, "schedule_content_index")
     _config_checkbox(to_save, "schedule_reconnect")
 
     if not error:
@@ -1458,6 +1466,37 @@ def integrity_check():
     return json.dumps({'success': True})
 
 
+@admi.route("/ajax/content_index", methods=["GET"])
+@user_login_required
+@admin_required
+def content_index_status():
+    indexable = (calibre_db.session.query(func.count(func.distinct(db.Data.book)))
+                 .filter(db.Data.format.in_(CONTENT_FORMATS)).scalar())
+    stats = content_index.get_stats(indexable)
+    stats["size_text"] = "{:.1f} MB".format(stats["size"] / (1024 * 1024))
+    return jsonify(stats)
+
+
+@admi.route("/ajax/content_index", methods=["POST"])
+@user_login_required
+@admin_required
+def update_content_index():
+    if content_index.progress is not None:
+        return jsonify({'text': _('The full-text index is already being updated')})
+    rebuild = bool((request.get_json(silent=True) or {}).get('rebuild'))
+    WorkerThread.add(current_user.name, TaskUpdateContentIndex(rebuild=rebuild))
+    return jsonify({'text': _('Full-text index update started, please check Tasks for progress')})
+
+
+@admi.route("/ajax/metadata_cache", methods=["DELETE"])
+@user_login_required
+@admin_required
+def clear_metadata_cache():
+    metadata_gateway.cache.clear()
+    http_cache.clear()
+    return jsonify({'text': _('Cached metadata search results and http responses deleted')})
+
+
 
 @admi.route("/admin/user/<int:user_id>", methods=["GET", "POST"])
 @user_login_required
@@ -1844,6 +1883,28 @@ def _configuration_update_helper():
         _config_checkbox_int(to_save, "config_unicode_filename")
         _config_checkbox_int(to_save, "config_embed_metadata")
         _config_checkbox_int(to_save, "config_author_enrichment")
+        if to_save.get("config_enrichment_rate"):
+            try:
+                if float(to_save["config_enrichment_rate"]) <= 0:
+                    raise ValueError
+            except ValueError:
+                return _configuration_result(_('Author enrichment requests per second have to be a positive number'))
+            _config_int(to_save, "config_enrichment_rate", float)
+        if to_save.get("config_enrichment_burst"):
+            try:
+                if not 0 < int(to_save["config_enrichment_burst"]) < 101:
+                    raise ValueError
+            except ValueError:
+                return _configuration_result(_('Request Burst per Website has to be a number between 1 and 100'))
+            _config_int(to_save, "config_enrichment_burst")
+        if to_save.get("config_enrichment_workers"):
+            try:
+                if not 0 < int(to_save["config_enrichment_workers"]) < 33:
+                    raise ValueError
+            except ValueError:
+                return _configuration_result(_('Concurrent Requests have to be a number between 1 and 32'))
+            _config_int(to_save, "config_enrichment_workers")
+        _config_checkbox(to_save, "config_http_cache_offline")
         # Reboot on config_anonbrowse with enabled ldap, as decoraters are changed in this case
         reboot_required |= (_config_checkbox_int(to_save, "config_anonbrowse")
                             and config.config_login_type == constants.LOGIN_LDAP)
@@ -20,7 +20,7 @@ import os
 import sys
 import json
 
-from sqlalchemy import Column, String, Integer, SmallInteger, Boolean, BLOB, JSON
+from sqlalchemy import Column, String, Integer, SmallInteger, Boolean, BLOB, JSON, Float
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.sql.expression import text
 from sqlalchemy import exists
@@ -88,6 +88,7 @@ class _Settings(_Base):
                                 default=r'^(A|The|An|Der|Die|Das|Den|Ein|Eine'
                                         r'|Einen|Dem|Des|Einem|Eines|Le|La|Les|L\'|Un|Une)\s+')
     config_theme = Column(Integer, default=0)
+    config_fuzzy_search = Column(Boolean, default=False)
 
     config_log_level = Column(SmallInteger, default=logger.DEFAULT_LOG_LEVEL)
     config_logfile = Column(String, default=logger.DEFAULT_LOG_FILE)
@@ -123,6 +124,10 @@ class _Settings(_Base):
     config_hardcover_api_key = Column(String, default='')
     config_enable_watched_folder = Column(Boolean, default=False)
     config_author_enrichment = Column(Boolean, default=True)
+    config_enrichment_rate = Column(Float, default=1.0)
+    config_enrichment_burst = Column(Integer, default=5)
+    config_enrichment_workers = Column(Integer, default=8)
+    config_http_cache_offline = Column(Boolean, default=False)
     config_register_email = Column(Boolean, default=False)
     config_login_type = Column(Integer, default=0)
 
@@ -166,6 +171,7 @@ class _Settings(_Base):
     schedule_generate_series_covers = Column(Boolean, default=False)
     schedule_reconnect = Column(Boolean, default=False)
     schedule_metadata_backup = Column(Boolean, default=False)
+    schedule_content_index = Column(Boolean, default=False)
 
     config_password_policy = Column(Boolean, default=True)
     config_password_min_length = Column(Integer, default=8)
@@ -192,6 +192,10 @@ NIGHTLY_VERSION[1] = '$Format:%cI$'
 
 # CACHE
 CACHE_TYPE_THUMBNAILS    = 'thumbnails'
+CACHE_TYPE_CONTENT_INDEX = 'content_index'
+CACHE_TYPE_METADATA      = 'metadata'
+CACHE_TYPE_HTTP          = 'http'
+CACHE_TYPE_DOCUMENT_INDEX = 'document_index'
 
 # Thumbnail Types
 THUMBNAIL_TYPE_COVER     = 1
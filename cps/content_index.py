@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+# Full-text index of the book contents. The text of one format per book (EPUB, FB2, DOCX, TXT or PDF with text layer)
+# is extracted by a background task and stored in a sqlite FTS5 table in the cache directory, next to a table with
+# format, modification time and size of the indexed file. Runs of the task only extract files which changed since.
+# The simple search adds books with matching contents after the metadata hits and shows a highlighted snippet of the
+# matching text for them.
+# The text extraction of audit_helper only reads samples for language detection, the extraction here reads the whole
+# book up to MAX_TEXT_CHARS.
+
+import os
+import re
+import sqlite3
+import time
+import zipfile
+from posixpath import dirname as zip_dirname, join as zip_join, normpath as zip_normpath
+from threading import Lock
+from urllib.parse import unquote
+
+from lxml import etree
+from markupsafe import escape
+
+from . import logger, constants
+from .fs import FileSystem
+
+log = logger.create()
+
+try:
+    from pypdf import PdfReader
+    use_pdf_text = True
+except ImportError as e:
+    log.debug('Cannot import pypdf, text of pdf files will not be indexed: %s', e)
+    use_pdf_text = False
+
+# Indexed format of a book, in order of preference
+CONTENT_FORMATS = ["EPUB", "FB2", "DOCX", "TXT", "PDF"]
+MAX_TEXT_CHARS = 2000000
+MAX_FILE_SIZE = 200 * 1024 * 1024
+MAX_RESULTS = 1000
+SNIPPET_TOKENS = 24
+
+STATUS_INDEXED = 0
+STATUS_NO_TEXT = 1
+STATUS_ERROR = 2
+
+# Markers of the matches in snippets, replaced by <mark> after escaping the text
+_MATCH_START = "\x02"
+_MATCH_END = "\x03"
+_whitespace = re.compile(r"\s+")
+_search_words = re.compile(r"\w+", re.UNICODE)
+
+
+def _clean(text):
+    return _whitespace.sub(" ", text or "").strip()
+
+
+def _markup_text(data):
+    parser = etree.HTMLParser(recover=True, remove_comments=True)
+    root = etree.fromstring(data, parser)
+    if root is None:
+        return ""
+    etree.strip_elements(root, "script", "style", "head", with_tail=False)
+    return _clean(" ".join(root.itertext()))
+
+
+def _epub_documents(archive):
+    """Content documents of the epub in reading order, all html files if the spine can't be read"""
+    names = archive.namelist()
+    try:
+        container = etree.fromstring(archive.read("META-INF/container.xml"))
+        opf_path = container.xpath("//*[local-name()='rootfile']/@full-path")[0]
+        opf = etree.fromstring(archive.read(opf_path))
+        manifest = {item.get("id"): item.get("href") for item in opf.xpath("//*[local-name()='manifest']/*")}
+        base = zip_dirname(opf_path)
+        documents = [zip_normpath(zip_join(base, unquote(manifest[ref])))
+                     for ref in opf.xpath("//*[local-name()='spine']/*/@idref") if ref in manifest]
+        documents = [document for document in documents if document in names]
+        if documents:
+            return documents
+    except (KeyError, IndexError, etree.LxmlError) as ex:
+        log.debug("Reading spine of epub failed, using all html files: %s", ex)
+    return sorted(name for name in names if name.lower().endswith((".xhtml", ".html", ".htm")))
+
+
+def extract_epub(file_path):
+    parts = []
+    length = 0
+    with zipfile.ZipFile(file_path) as archive:
+        for document in _epub_documents(archive):
+            text = _markup_text(archive.read(document))
+            parts.append(text)
+            length += len(text)
+            if length > MAX_TEXT_CHARS:
+                break
+    return " ".join(parts)
+
+
+def extract_docx(file_path):
+    with zipfile.ZipFile(file_path) as archive:
+        root = etree.fromstring(archive.read("word/document.xml"))
+    paragraphs = ("".join(paragraph.xpath(".//*[local-name()='t']/text()"))
+                  for paragraph in root.iter("{*}p"))
+    return _clean(" ".join(paragraphs))
+
+
+def extract_fb2(file_path):
+    parser = etree.XMLParser(recover=True, huge_tree=True, resolve_entities=False, no_network=True)
+    root = etree.parse(file_path, parser).getroot()
+    # binary elements hold the base64 encoded images
+    return _clean(" ".join(" ".join(body.itertext()) for body in root.iter("{*}body")))
+
+
+def extract_txt(file_path):
+    with open(file_path, "rb") as text_file:
+        data = text_file.read(MAX_TEXT_CHARS * 2)
+    for encoding in ("utf-8", "cp1252"):
+        try:
+            return _clean(data.decode(encoding))
+        except UnicodeDecodeError:
+            pass
+    return _clean(data.decode("latin-1"))
+
+
+def extract_pdf(file_path):
+    if not use_pdf_text:
+        return ""
+    parts = []
+    length = 0
+    for page in PdfReader(file_path).pages:
+        text = _clean(page.extract_text() or "")
+        parts.append(text)
+        length += len(text)
+        if length > MAX_TEXT_CHARS:
+            break
+    return " ".join(parts)
+
+
+EXTRACTORS = {"EPUB": extract_epub, "FB2": extract_fb2, "DOCX": extract_docx, "TXT": extract_txt, "PDF": extract_pdf}
+
+
+def extract_text(file_path, book_format):
+    """Returns (status, text) of the book file"""
+    try:
+        if os.path.getsize(file_path) > MAX_FILE_SIZE:
+            log.info("Not indexing contents of %s, file is too large", file_path)
+            return STATUS_NO_TEXT, ""
+        text = EXTRACTORS[book_format.upper()](file_path)[:MAX_TEXT_CHARS]
+    except Exception as ex:
+        log.warning("Extracting text of %s failed: %s", file_path, ex)
+        return STATUS_ERROR, ""
+    return (STATUS_INDEXED if text else STATUS_NO_TEXT), text
+
+
+def match_query(term):
+    """FTS5 query matching all words of the search term, the words are quoted so no query syntax is interpreted"""
+    words = _search_words.findall(term or "")
+    return " ".join('"{}"'.format(word) for word in words) if words else None
+
+
+class ContentIndex:
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = Lock()
+        self._available = None
+        # (books done, books to check) of a running update
+        self.progress = None
+
+    @property
+    def path(self):
+        if not self._path:
+            self._path = os.path.join(FileSystem().get_cache_dir(constants.CACHE_TYPE_CONTENT_INDEX), "content.db")
+        return self._path
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS documents (book_id INTEGER PRIMARY KEY, format TEXT, "
+                           "mtime REAL, size INTEGER, chars INTEGER, status INTEGER, indexed_at REAL)")
+        connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS contents "
+                           "USING fts5(content, tokenize='unicode61 remove_diacritics 2')")
+        return connection
+
+    @property
+    def available(self):
+        """False if sqlite was built without FTS5"""
+        if self._available is None:
+            try:
+                self._connect().close()
+                self._available = True
+            except sqlite3.Error as ex:
+                log.error("Full-text index of book contents is not available: %s", ex)
+                self._available = False
+        return self._available
+
+    def get_state(self):
+        """Returns dict book_id -> (format, mtime, size) of the indexed files"""
+        connection = self._connect()
+        try:
+            return {row[0]: tuple(row[1:]) for row in connection.execute(
+                "SELECT book_id, format, mtime, size FROM documents")}
+        finally:
+            connection.close()
+
+    def store(self, documents):
+        """Stores list of (book_id, format, mtime, size, status, text)"""
+        with self._lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    for book_id, book_format, mtime, size, status, text in documents:
+                        connection.execute("DELETE FROM contents WHERE rowid = ?", (book_id,))
+                        if text:
+                            connection.execute("INSERT INTO contents (rowid, content) VALUES (?, ?)", (book_id, text))
+                        connection.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                           (book_id, book_format, mtime, size, len(text), status, time.time()))
+            finally:
+                connection.close()
+
+    def remove(self, book_ids):
+        book_ids = [(book_id,) for book_id in book_ids]
+        with self._lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.executemany("DELETE FROM contents WHERE rowid = ?", book_ids)
+                    connection.executemany("DELETE FROM documents WHERE book_id = ?", book_ids)
+            finally:
+                connection.close()
+
+    def clear(self):
+        with self._lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute("DELETE FROM contents")
+                    connection.execute("DELETE FROM documents")
+                connection.execute("VACUUM")
+            finally:
+                connection.close()
+
+    def version(self):
+        """Changes whenever documents are stored or removed, part of the search cache key"""
+        connection = self._connect()
+        try:
+            return tuple(connection.execute("SELECT count(*), max(indexed_at) FROM documents").fetchone())
+        finally:
+            connection.close()
+
+    def search(self, term, limit=MAX_RESULTS):
+        """Returns the ids of books containing all words of the term, best matches first"""
+        query = match_query(term)
+        if not query:
+            return []
+        connection = self._connect()
+        try:
+            return [row[0] for row in connection.execute(
+                "SELECT rowid FROM contents WHERE contents MATCH ? ORDER BY rank LIMIT ?", (query, limit))]
+        except sqlite3.Error as ex:
+            log.error("Content search failed: %s", ex)
+            return []
+        finally:
+            connection.close()
+
+    def snippets(self, term, book_ids):
+        """Returns dict book_id -> html snippet of the matching text with the matches highlighted"""
+        query = match_query(term)
+        if not query or not book_ids:
+            return {}
+        book_ids = list(book_ids)
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                "SELECT rowid, snippet(contents, 0, ?, ?, '…', ?) FROM contents WHERE contents MATCH ? "
+                "AND rowid IN ({})".format(",".join("?" * len(book_ids))),
+                [_MATCH_START, _MATCH_END, SNIPPET_TOKENS, query] + book_ids).fetchall()
+        except sqlite3.Error as ex:
+            log.error("Reading content snippets failed: %s", ex)
+            return {}
+        finally:
+            connection.close()
+        return {book_id: str(escape(snippet)).replace(_MATCH_START, "<mark>").replace(_MATCH_END, "</mark>")
+                for book_id, snippet in rows}
+
+    def get_stats(self, indexable_books=None):
+        if not os.path.exists(self.path):
+            stats = {"documents": 0, "with_text": 0, "errors": 0, "chars": 0, "size": 0}
+        else:
+            connection = self._connect()
+            try:
+                documents, with_text, errors, chars = connection.execute(
+                    "SELECT count(*), sum(status = ?), sum(status = ?), sum(chars) FROM documents",
+                    (STATUS_INDEXED, STATUS_ERROR)).fetchone()
+            finally:
+                connection.close()
+            size = sum(os.path.getsize(self.path + suffix) for suffix in ("", "-wal")
+                       if os.path.exists(self.path + suffix))
+            stats = {"documents": documents, "with_text": with_text or 0, "errors": errors or 0,
+                     "chars": chars or 0, "size": size}
+        stats["indexable"] = indexable_books
+        stats["coverage"] = round(100.0 * stats["documents"] / indexable_books, 1) if indexable_books else None
+        stats["progress"] = self.progress
+        return stats
+
+
+content_index = ContentIndex()
@@ -57,6 +57,9 @@ log = logger.create()
 cc_exceptions = ['composite', 'series']
 cc_classes = {}
 
+# Books loaded per query when rows are fetched by cached search result ids
+SEARCH_ID_BATCH = 500
+
 Base = declarative_base()
 
 books_authors_link = Table('books_authors_link', Base.metadata,
@@ -891,21 +894,13 @@ class CalibreDB:
         return self.fill_indexpage_with_archived_books(page, database, pagesize, db_filter, order, False,
                                                        join_archive_read, config_read_column, *join)
 
-    def fill_indexpage_with_archived_books(self, page, database, pagesize, db_filter, order, allow_show_archived,
-                                           join_archive_read, config_read_column, *join):
-        pagesize = pagesize or self.config.config_books_per_page
-        if current_user.show_detail_random():
-            random_query = self.generate_linked_query(config_read_column, database)
-            randm = (random_query.filter(self.common_filters(allow_show_archived))
-                     .order_by(func.random())
-                     .limit(self.config.config_random_books).all())
-        else:
-            randm = false()
+    # Filtered (but unordered and unpaginated) query behind fill_indexpage, can also be iterated batchwise
+    def generate_indexpage_query(self, database, db_filter, allow_show_archived, join_archive_read,
+                                 config_read_column, *join):
         if join_archive_read:
             query = self.generate_linked_query(config_read_column, database)
         else:
             query = self.session.query(database)
-        off = int(int(pagesize) * (page - 1))
 
         indx = len(join)
         element = 0
@@ -924,6 +919,21 @@ class CalibreDB:
                 element += 1
         query = query.filter(db_filter)\
             .filter(self.common_filters(allow_show_archived))
+        return query
+
+    def fill_indexpage_with_archived_books(self, page, database, pagesize, db_filter, order, allow_show_archived,
+                                           join_archive_read, config_read_column, *join):
+        pagesize = pagesize or self.config.config_books_per_page
+        if current_user.show_detail_random():
+            random_query = self.generate_linked_query(config_read_column, database)
+            randm = (random_query.filter(self.common_filters(allow_show_archived))
+                     .order_by(func.random())
+                     .limit(self.config.config_random_books).all())
+        else:
+            randm = false()
+        query = self.generate_indexpage_query(database, db_filter, allow_show_archived, join_archive_read,
+                                              config_read_column, *join)
+        off = int(int(pagesize) * (page - 1))
         entries = list()
         pagination = list()
         try:
@@ -948,6 +958,25 @@ class CalibreDB:
         entries = self.order_authors(entries, True, join_archive_read)
         return entries, randm, pagination
 
+    # Most downloaded books, ranked in one query over the downloads table of app.db (attached as app_settings),
+    # books which are deleted or not visible for the user are dropped by the join and the filters
+    def fill_indexpage_hot_books(self, page, pagesize, order, config_read_column, offset=None):
+        pagesize = pagesize or self.config.config_books_per_page
+        off = int(int(pagesize) * (page - 1)) if offset is None else int(offset)
+        query = (self.generate_linked_query(config_read_column, Books)
+                 .join(ub.Downloads, ub.Downloads.book_id == Books.id)
+                 .filter(self.common_filters())
+                 .group_by(Books.id))
+        entries = list()
+        pagination = list()
+        try:
+            pagination = Pagination(page, pagesize, query.count())
+            entries = query.order_by(*order).order_by(Books.id).offset(off).limit(pagesize).all()
+        except Exception as ex:
+            log.error_or_exception(ex)
+        entries = self.order_authors(entries, True, True)
+        return entries, pagination
+
     # Orders all Authors in the list according to authors sort
     def order_authors(self, entries, list_return=False, combined=False):
         for entry in entries:
@@ -1122,36 +1151,54 @@ class CalibreDB:
     # read search results from calibre-database and return it (function is used for feed and simple search
     def get_search_results(self, term, config, offset=None, order=None, limit=None, *join):
         order = order[0] if order else [Books.sort]
-        pagination = None
+        ids = self.get_search_ids("simple", strip_whitespaces(term).lower(), config, order,
+                                  lambda: self.search_query(term, config, *join).order_by(*order))
+        return self.get_search_page(ids, config, offset, limit)
 
+    # Entries, result count and pagination of one page of the ordered result ids of a search
+    def get_search_page(self, ids, config, offset=None, limit=None):
+        pagination = None
+        result_count = len(ids)
         if offset is not None and limit is not None:
             offset = int(offset)
             limit_int = int(limit)
-
-            # Use LIMIT+1 pattern to estimate total count without expensive count()
-            query = self.search_query(term, config, *join).order_by(*order)
-            result = query.limit(offset + limit_int + 1).all()
-
-            # Check if there are more results
-            has_more = len(result) > (offset + limit_int)
-            if has_more:
-                result_count = offset + limit_int + 1  # Estimate: at least this many
-            else:
-                result_count = len(result)
-
-            # Extract the page of results
-            result = result[offset:offset + limit_int]
+            ids_page = ids[offset:offset + limit_int]
             pagination = Pagination((offset / limit_int + 1), limit_int, result_count)
         else:
-            # No pagination, fetch all results
-            result = self.search_query(term, config, *join).order_by(*order).all()
-            result_count = len(result)
-
-        ub.store_combo_ids(result)
-        entries = self.order_authors(result, list_return=True, combined=True)
+            ids_page = ids
+        entries = self.order_authors(self.get_books_by_ids(ids_page, config), list_return=True, combined=True)
 
         return entries, result_count, pagination
 
+    # Ordered ids of all results of a search. They are served from the search cache while the library and the read
+    # status of the user are unchanged, build_query is only called on a miss
+    def get_search_ids(self, kind, term, config, order, build_query):
+        return self.get_cached_search_ids(kind, term, config, order,
+                                          lambda: (row[0] for row in build_query().with_entities(Books.id)))
+
+    # Same for searches whose results are not the rows of one query, find_ids returns the ordered book ids
+    def get_cached_search_ids(self, kind, term, config, order, find_ids):
+        from . import library_changes
+        from .search_cache import search_cache, visibility_profile
+        key = search_cache.make_key(kind, term, visibility_profile(current_user, config), order)
+        marker = library_changes.user_marker(config, self.session, current_user.id)
+        ids = search_cache.get(key, marker)
+        if ids is None:
+            ids = search_cache.set(key, marker, dict.fromkeys(find_ids()))
+        # used for adding all search results to a shelf
+        ub.searched_ids[current_user.id] = ids.tolist()
+        return ids
+
+    # Rows as returned by generate_linked_query for the given book ids, in the order of the ids
+    def get_books_by_ids(self, ids, config):
+        rows_by_id = dict()
+        for start in range(0, len(ids), SEARCH_ID_BATCH):
+            rows = (self.generate_linked_query(config.config_read_column, Books)
+                    .filter(Books.id.in_(list(ids[start:start + SEARCH_ID_BATCH])))
+                    .options(selectinload(Books.authors)).all())
+            rows_by_id.update((row[0].id, row) for row in rows)
+        return [rows_by_id[book_id] for book_id in ids if book_id in rows_by_id]
+
     # Creates for all stored languages a translated speaking name in the array for the UI
     def speaking_language(self, languages=None, return_all_languages=False, with_count=False, reverse_order=False):
 
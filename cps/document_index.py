@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+# Document identities for the KOReader progress sync. KOReader identifies a document by the md5 of samples of the
+# file (the "binary" checksum method, partial md5) or by the md5 of its file name. Both digests of every stored format,
+# for the stored file name and the name the file gets on download, are kept together with the uuid of the book in a
+# sqlite table in the cache directory, so a sync request costs one indexed lookup.
+# The index is built by a startup task and kept current from the library change feed by the same task, which sync
+# requests queue at most every REFRESH_INTERVAL seconds. Only files with a changed
+# modification time or size are read again, unchanged libraries only cost a stat call per file. Document ids which
+# match no book are recorded with the number of requests for diagnosis.
+
+import hashlib
+import os
+import sqlite3
+import time
+from threading import Lock
+
+from sqlalchemy.orm import selectinload
+
+from . import logger, constants, db, library_changes
+from .fs import FileSystem
+from .helper import get_valid_filename
+
+log = logger.create()
+
+KIND_PARTIAL_MD5 = 0
+KIND_FILENAME = 1
+KIND_UUID = 2
+
+# Minimum seconds between two checks of the change feed
+REFRESH_INTERVAL = 2
+# Changed books indexed incrementally, above all files of the library are checked
+MAX_INCREMENTAL = 2000
+# Books loaded and written in one transaction
+BATCH_SIZE = 200
+# Unmatched document ids kept, the least recently requested are dropped
+MAX_UNMATCHED = 1000
+
+
+def partial_md5(file_path):
+    """The file checksum of KOReader: md5 of 1 KB samples at offset 0 and 1 KB * 4^i for i up to 10"""
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as book_file:
+        for i in range(-1, 11):
+            # KOReader shifts by -2 for the first sample, which wraps around to offset 0
+            book_file.seek(0 if i < 0 else 1024 << (2 * i))
+            sample = book_file.read(1024)
+            if not sample:
+                break
+            md5.update(sample)
+    return md5.hexdigest()
+
+
+def filename_md5(file_name):
+    return hashlib.md5(file_name.encode("utf-8")).hexdigest()
+
+
+def download_names(book):
+    """File names (without extension) a downloaded book gets, see helper.get_download_link"""
+    file_name = book.title
+    if book.authors:
+        file_name = file_name + ' - ' + book.authors[0].name
+    return {get_valid_filename(file_name, replace_whitespace=False),
+            get_valid_filename(file_name, replace_whitespace=False, force_unidecode=True)}
+
+
+class DocumentIndex:
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = Lock()
+        self._build_lock = Lock()
+        self._last_refresh = 0
+        self._refresh_queued = False
+        # sequence number of the change feed the index is current with, None until it was built once
+        self.sequence = None
+        self.stats = {"lookups": 0, "matched": 0, "unmatched": 0}
+
+    @property
+    def path(self):
+        if not self._path:
+            self._path = os.path.join(FileSystem().get_cache_dir(constants.CACHE_TYPE_DOCUMENT_INDEX), "documents.db")
+        return self._path
+
+    @property
+    def ready(self):
+        return self.sequence is not None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS documents (book_id INTEGER, format TEXT, kind INTEGER, "
+                           "digest TEXT, mtime REAL, size INTEGER)")
+        connection.execute("CREATE INDEX IF NOT EXISTS documents_digest ON documents (digest)")
+        connection.execute("CREATE INDEX IF NOT EXISTS documents_book ON documents (book_id)")
+        connection.execute("CREATE TABLE IF NOT EXISTS unmatched (document_id TEXT PRIMARY KEY, requests INTEGER, "
+                           "first_seen REAL, last_seen REAL)")
+        return connection
+
+    def _count(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                self.stats[name] += value
+
+    @staticmethod
+    def _book_documents(book, book_path, previous):
+        """Returns the set of (format, kind, digest, mtime, size) of the book, the partial md5 of previous is reused
+        for files with unchanged modification time and size"""
+        documents = {("", KIND_UUID, book.uuid.lower(), None, None)} if book.uuid else set()
+        names = download_names(book)
+        for data in book.data:
+            extension = "." + data.format.lower()
+            for name in names | {data.name}:
+                documents.add((data.format, KIND_FILENAME, filename_md5(name + extension), None, None))
+            if book_path is None:
+                continue
+            try:
+                file_stat = os.stat(os.path.join(book_path, book.path, data.name + extension))
+            except OSError:
+                continue
+            known = previous.get(data.format)
+            if known and known[1:] == (file_stat.st_mtime, file_stat.st_size):
+                digest = known[0]
+            else:
+                try:
+                    digest = partial_md5(os.path.join(book_path, book.path, data.name + extension))
+                except OSError as ex:
+                    log.warning("Reading %s of book %d failed: %s", data.format, book.id, ex)
+                    continue
+            documents.add((data.format, KIND_PARTIAL_MD5, digest, file_stat.st_mtime, file_stat.st_size))
+        return documents
+
+    def update(self, session, book_path, book_ids=None):
+        """Indexes the given books or the whole library again, book_path is None if the files can't be read"""
+        connection = self._connect()
+        try:
+            if book_ids is None:
+                book_ids = [row[0] for row in session.query(db.Books.id)]
+                present = set(book_ids)
+                removed = [(row[0],) for row in connection.execute("SELECT DISTINCT book_id FROM documents")
+                           if row[0] not in present]
+            else:
+                book_ids = list(book_ids)
+                removed = []
+            changed = 0
+            for start in range(0, len(book_ids), BATCH_SIZE):
+                batch = book_ids[start:start + BATCH_SIZE]
+                books = (session.query(db.Books)
+                         .options(selectinload(db.Books.authors), selectinload(db.Books.data))
+                         .filter(db.Books.id.in_(batch)).all())
+                stored = dict()
+                for row in connection.execute("SELECT book_id, format, kind, digest, mtime, size FROM documents "
+                                              "WHERE book_id IN ({})".format(",".join("?" * len(batch))), batch):
+                    stored.setdefault(row[0], set()).add(tuple(row[1:]))
+                found = {book.id for book in books}
+                removed.extend((book_id,) for book_id in batch if book_id not in found and book_id in stored)
+                writes = []
+                for book in books:
+                    current = stored.get(book.id, set())
+                    previous = {document[0]: (document[2], document[3], document[4])
+                                for document in current if document[1] == KIND_PARTIAL_MD5}
+                    documents = self._book_documents(book, book_path, previous)
+                    if documents != current:
+                        writes.append((book.id, documents))
+                if writes or removed:
+                    with self._lock, connection:
+                        connection.executemany("DELETE FROM documents WHERE book_id = ?",
+                                               [(book_id,) for book_id, __ in writes] + removed)
+                        connection.executemany("INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?)",
+                                               [(book_id,) + document for book_id, documents in writes
+                                                for document in documents])
+                        # ids requested before the book was added are matched now
+                        connection.execute("DELETE FROM unmatched WHERE document_id IN "
+                                           "(SELECT digest FROM documents)")
+                    changed += len(writes)
+                    removed = []
+            return changed
+        finally:
+            connection.close()
+
+    def build(self, session, book_path):
+        """Checks all books of the library, only new and changed files are read"""
+        with self._build_lock:
+            start = time.perf_counter()
+            sequence = library_changes.latest_sequence()
+            changed = self.update(session, book_path)
+            self.sequence = sequence
+            self._last_refresh = time.time()
+            log.info("Document index checked in %.2fs, %d books updated", time.perf_counter() - start, changed)
+
+    def refresh_due(self):
+        """True if the library changes should be applied to the index by a background task. A due refresh is only
+        reported once until refresh_done was called, no database or file is accessed"""
+        with self._lock:
+            if not self.ready or self._refresh_queued or time.time() - self._last_refresh < REFRESH_INTERVAL:
+                return False
+            self._refresh_queued = True
+            return True
+
+    def refresh_done(self):
+        with self._lock:
+            self._refresh_queued = False
+            self._last_refresh = time.time()
+
+    def refresh(self, config, session):
+        """Applies the library changes to the index, nothing is done before the index was built. Many changed books
+        or changes which can't be assigned to books cause a check of the whole library"""
+        if not self.ready:
+            return
+        with self._build_lock:
+            library_changes.detect_external_changes(config, session)
+            sequence, book_ids = library_changes.changed_books_since(self.sequence)
+            if sequence == self.sequence:
+                return
+            book_path = None if config.config_use_google_drive else config.get_book_path()
+            if book_ids is not None and len(book_ids) > MAX_INCREMENTAL:
+                book_ids = None
+            self.update(session, book_path, book_ids)
+            self.sequence = sequence
+
+    def lookup(self, document_id):
+        """Returns the id of the book of the document, None if it is unknown"""
+        self._count(lookups=1)
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT book_id FROM documents WHERE digest = ? ORDER BY kind LIMIT 1",
+                                     (document_id.lower(),)).fetchone()
+        finally:
+            connection.close()
+        self._count(matched=row is not None)
+        return row[0] if row else None
+
+    def record_unmatched(self, document_id):
+        self._count(unmatched=1)
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute("INSERT INTO unmatched VALUES (?, 1, ?, ?) ON CONFLICT(document_id) DO "
+                                       "UPDATE SET requests = requests + 1, last_seen = excluded.last_seen",
+                                       (document_id, now, now))
+                    connection.execute("DELETE FROM unmatched WHERE document_id NOT IN (SELECT document_id FROM "
+                                       "unmatched ORDER BY last_seen DESC LIMIT ?)", (MAX_UNMATCHED,))
+            except sqlite3.Error as ex:
+                log.error("Recording unmatched document failed: %s", ex)
+            finally:
+                connection.close()
+
+    def clear(self):
+        with self._build_lock, self._lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute("DELETE FROM documents")
+                    connection.execute("DELETE FROM unmatched")
+                connection.execute("VACUUM")
+            finally:
+                connection.close()
+            self.sequence = None
+
+    def get_stats(self, unmatched_limit=10):
+        with self._lock:
+            stats = dict(self.stats)
+        stats.update(books=0, files=0, unmatched_documents=0, recent_unmatched=[])
+        if os.path.exists(self.path):
+            try:
+                connection = self._connect()
+                try:
+                    stats["books"], stats["files"] = connection.execute(
+                        "SELECT count(DISTINCT book_id), sum(kind = ?) FROM documents",
+                        (KIND_PARTIAL_MD5,)).fetchone()
+                    stats["files"] = stats["files"] or 0
+                    stats["unmatched_documents"] = connection.execute("SELECT count(*) FROM unmatched").fetchone()[0]
+                    stats["recent_unmatched"] = connection.execute(
+                        "SELECT document_id, requests, first_seen, last_seen FROM unmatched ORDER BY last_seen DESC "
+                        "LIMIT ?", (unmatched_limit,)).fetchall()
+                finally:
+                    connection.close()
+            except sqlite3.Error as ex:
+                log.error("Reading document index failed: %s", ex)
+        stats["ready"] = self.ready
+        return stats
+
+
+document_index = DocumentIndex()
@@ -35,14 +35,18 @@ from flask_babel import get_locale
 from .cw_login import current_user
 from sqlalchemy.exc import OperationalError, IntegrityError, InterfaceError
 from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm import selectinload
 from sqlalchemy.sql.expression import func
 
 from . import constants, logger, isoLanguages, gdriveutils, uploader, helper, kobo_sync_status, audit_helper
+from . import kobo_metadata_cache, library_changes
+from .epub_structure import structure_cache
+from .opds_links import link_cache
 from .clean_html import clean_string
 from . import config, ub, db, calibre_db
 from .services.worker import WorkerThread
-from .tasks.upload import TaskUpload
-from .tasks.metadata import TaskUpdateMetadata
+from .tasks.upload import TaskUpload, TaskImportUploads
+from .tasks.metadata import TaskUpdateMetadata, TaskBulkUpdateMetadata
 from .render_template import render_title_template
 from .kobo_sync_status import change_archived_books
 from .redirect import get_redirect_location
@@ -109,44 +113,24 @@ def upload():
     if len(request.files.getlist("btn-upload-format")):
         book_id = request.form.get('book_id', -1)
         return do_edit_book(book_id, request.files.getlist("btn-upload-format"))
+    elif len(request.files.getlist("btn-upload")) > 1:
+        return queue_uploads(request.files.getlist("btn-upload"))
     elif len(request.files.getlist("btn-upload")):
         for requested_file in request.files.getlist("btn-upload"):
             try:
-                modify_date = False
                 # create the function for sorting...
                 calibre_db.create_functions(config)
                 meta, error = file_handling_on_upload(requested_file)
                 if error:
                     return error
 
-                db_book, input_authors, title_dir = create_book_on_upload(modify_date, meta)
-
-                # Comments need book id therefore only possible after flush
-                modify_date |= edit_book_comments(Markup(meta.description).unescape(), db_book)
-
+                db_book, error = add_uploaded_book(meta)
                 book_id = db_book.id
                 title = db_book.title
-                if config.config_use_google_drive:
-                    helper.upload_new_file_gdrive(book_id,
-                                                  input_authors[0],
-                                                  title,
-                                                  title_dir,
-                                                  meta.file_path,
-                                                  meta.extension.lower())
-                    for file_format in db_book.data:
-                        file_format.name = (helper.get_valid_filename(title, chars=42) + ' - '
-                                            + helper.get_valid_filename(input_authors[0], chars=42))
-                else:
-                    error = helper.update_dir_structure(book_id,
-                                                        config.get_book_path(),
-                                                        input_authors[0],
-                                                        meta.file_path,
-                                                        title_dir + meta.extension.lower())
-                move_coverfile(meta, db_book)
-                if modify_date:
-                    calibre_db.set_metadata_dirty(book_id)
                 # save data to database, reread data
                 calibre_db.session.commit()
+                library_changes.record(book_id, ub.LibraryChange.TYPE_ADDED)
+                structure_cache.update_book(book_id)
 
                 if config.config_use_google_drive:
                     gdriveutils.updateGdriveCalibreFromLocal()
@@ -158,13 +142,12 @@ def upload():
                 helper.add_book_to_thumbnail_cache(book_id)
                 calibre_db.clear_cache()
 
-                if len(request.files.getlist("btn-upload")) < 2:
-                    if current_user.role_edit() or current_user.role_admin():
-                        resp = {"location": url_for('edit-book.show_edit_book', book_id=book_id)}
-                        return make_response(jsonify(resp))
-                    else:
-                        resp = {"location": url_for('web.show_book', book_id=book_id)}
-                        return Response(json.dumps(resp), mimetype='application/json')
+                if current_user.role_edit() or current_user.role_admin():
+                    resp = {"location": url_for('edit-book.show_edit_book', book_id=book_id)}
+                    return make_response(jsonify(resp))
+                else:
+                    resp = {"location": url_for('web.show_book', book_id=book_id)}
+                    return Response(json.dumps(resp), mimetype='application/json')
             except (OperationalError, IntegrityError, StaleDataError) as e:
                 calibre_db.session.rollback()
                 log.error_or_exception("Database error: {}".format(e))
@@ -174,6 +157,61 @@ def upload():
     abort(404)
 
 
+def queue_uploads(requested_files):
+    """Saves the files of a multi file upload and hands them to a background import, the request returns as soon as
+    the files are stored"""
+    files = list()
+    for requested_file in requested_files:
+        if check_upload_file(requested_file):
+            continue
+        try:
+            tmp_file_path, digest = uploader.save_upload(requested_file)
+        except (IOError, OSError):
+            log.error("File %s could not saved to temp dir", requested_file.filename)
+            flash(_("File %(filename)s could not saved to temp dir",
+                    filename=requested_file.filename), category="error")
+            continue
+        files.append((tmp_file_path, requested_file.filename, digest))
+    if not files:
+        return make_response(jsonify(location=url_for("web.index")))
+    WorkerThread.add(current_user.name, TaskImportUploads(files, current_user.id))
+    flash(_("%(count)d files are imported in the background, see the task list for the progress", count=len(files)),
+          category="success")
+    return make_response(jsonify(location=url_for("tasks.get_tasks_status")))
+
+
+def add_uploaded_book(meta):
+    """Creates the book of an uploaded file and moves the file and cover to the library, committing is left to the
+    caller. Returns the book and the error of moving the files"""
+    db_book, input_authors, title_dir = create_book_on_upload(False, meta)
+
+    # Comments need book id therefore only possible after flush
+    modify_date = edit_book_comments(Markup(meta.description).unescape(), db_book)
+
+    book_id = db_book.id
+    error = None
+    if config.config_use_google_drive:
+        helper.upload_new_file_gdrive(book_id,
+                                      input_authors[0],
+                                      db_book.title,
+                                      title_dir,
+                                      meta.file_path,
+                                      meta.extension.lower())
+        for file_format in db_book.data:
+            file_format.name = (helper.get_valid_filename(db_book.title, chars=42) + ' - '
+                                + helper.get_valid_filename(input_authors[0], chars=42))
+    else:
+        error = helper.update_dir_structure(book_id,
+                                            config.get_book_path(),
+                                            input_authors[0],
+                                            meta.file_path,
+                                            title_dir + meta.extension.lower())
+    move_coverfile(meta, db_book)
+    if modify_date:
+        calibre_db.set_metadata_dirty(book_id)
+    return db_book, error
+
+
 @editbook.route("/admin/book/convert/<int:book_id>", methods=['POST'])
 @login_required_if_no_ano
 @edit_required
@@ -230,75 +268,142 @@ def edit_list_book(param):
 def edit_selected_books():
     d = request.get_json()
     selections = d.get('selections')
-    title = d.get('title')
-    title_sort = d.get('title_sort')
-    author_sort = d.get('author_sort')
-    authors = d.get('authors')
-    categories = d.get('categories')
-    series = d.get('series')
-    languages = d.get('languages')
-    publishers = d.get('publishers')
-    comments = d.get('comments')
-
-    if not (
-      title or title_sort or authors or categories or series or languages or publishers or comments) or not selections:
+    changes = [(field, d.get(key)) for key, field in BULK_EDIT_FIELDS if d.get(key)]
+    if not changes or not selections:
         return _("Parameter not found"), 400
-    vals = {
-        "pk": selections,
-        "value": None,
-        "checkA": d.get('checkA'),
-        "checkT": d.get('checkT'),
-    }
-    res = list()
-    if title:
-        vals['value'] = title
-        out = edit_book_param('title', vals, True)
-        if out[0].get('success') != True:
-            res.extend(out)
-    if title_sort:
-        vals['value'] = title_sort
-        out = edit_book_param('sort', vals, True)
-        if out[0].get('success') != True:
-            res.extend(out)
-    if author_sort:
-        vals['value'] = author_sort
-        out = edit_book_param('author_sort', vals, True)
-        if out[0].get('success') != True:
-            res.extend(out)
-    if authors:
-        vals['value'] = authors
-        out = edit_book_param('authors', vals, True)
-        if out[0].get('success') != True:
-            res.extend(out)
-    if categories:
-        vals['value'] = categories
-        out = edit_book_param('tags', vals, True)
-        if out[0].get('success') != True:
-            res.extend(out)
-    if series:
-        vals['value'] = series
-        out = edit_book_param('series', vals, True)
-        if out[0].get('success') != True:
-            res.extend(out)
-    if languages:
-        vals['value'] = languages
-        out = edit_book_param('languages', vals, True)
-        if out[0].get('success') != True:
-            res.extend(out)
-    if publishers:
-        vals['value'] = publishers
-        out = edit_book_param('publishers', vals, True)
-        if out[0].get('success') != True:
-            res.extend(out)
-    if comments:
-        vals['value'] = comments
-        out = edit_book_param('comments', vals, True)
-        if out[0].get('success') != True:
-            res.extend(out)
-    if len(res) == 0:
-        return jsonify([{'success': True, "msg": _("Changes successfully applied")}])
-    else:
+    dry_run = d.get('dry_run') == True
+    success, report = bulk_edit_books(selections, changes, d.get('checkA', True) != False,
+                                      d.get('checkT', True) != False, dry_run)
+    changed = len([entry for entry in report if entry.get('changes')])
+    if not success:
+        res = [{'success': False, 'msg': "{}: {}".format(entry.get('title', entry['id']), entry['msg'])}
+               for entry in report if not entry['success']]
+        res.insert(0, {'success': False, 'msg': _("No changes applied, %(count)d books failed", count=len(res)),
+                       'report': report})
         return jsonify(res)
+    if dry_run:
+        return jsonify([{'success': True, 'dry_run': True, 'report': report,
+                         'msg': _("%(count)d books would be changed", count=changed)}])
+    return jsonify([{'success': True, 'report': report, 'msg': _("Changes successfully applied")}])
+
+
+# Request keys of the bulk edit dialog and the edited field, in the order the changes are applied
+BULK_EDIT_FIELDS = [('title', 'title'), ('title_sort', 'sort'), ('author_sort', 'author_sort'), ('authors', 'authors'),
+                    ('categories', 'tags'), ('series', 'series'), ('languages', 'languages'),
+                    ('publishers', 'publishers'), ('comments', 'comments')]
+
+
+def bulk_edit_field(book, field, value, update_title_sort):
+    """Applies one change of a bulk edit to the book (authors are handled by the caller), returns the new value if
+    the book changed, else None. Raises ValueError for invalid values"""
+    if field == 'title':
+        old_sort = book.sort
+        if not handle_title_on_edit(book, value):
+            return None
+        # the title_sort trigger of the library updates the sort on flush
+        calibre_db.session.flush()
+        calibre_db.session.expire(book, ['sort'])
+        if not update_title_sort:
+            book.sort = old_sort
+        return book.title
+    if field == 'sort':
+        value = strip_whitespaces(value)
+        if book.sort == value:
+            return None
+        book.sort = value
+        return book.sort
+    if field == 'author_sort':
+        if book.author_sort == value:
+            return None
+        book.author_sort = value
+        return book.author_sort
+    if field == 'tags':
+        return ', '.join([tag.name for tag in book.tags]) if edit_book_tags(value, book) else None
+    if field == 'series':
+        return ', '.join([serie.name for serie in book.series]) if edit_book_series(value, book) else None
+    if field == 'publishers':
+        return ', '.join([publisher.name for publisher in book.publishers]) \
+            if edit_book_publisher(value, book) else None
+    if field == 'languages':
+        invalid = list()
+        changed = edit_book_languages(value, book, invalid=invalid)
+        if invalid:
+            raise ValueError(_("Invalid languages in request: %(languages)s", languages=', '.join(invalid)))
+        return ', '.join([isoLanguages.get_language_name(get_locale(), lang.lang_code) for lang in book.languages]) \
+            if changed else None
+    if field == 'comments':
+        return book.comments[0].text if edit_book_comments(value, book) else None
+    raise ValueError(_("Parameter not found"))
+
+
+def bulk_edit_books(book_ids, changes, update_author_sort=True, update_title_sort=True, dry_run=False):
+    """Applies the list of (field, value) changes to all books in one transaction. Nothing is stored if a book fails
+    or in dry run mode. Folders of books with changed title or authors are renamed by one background task after the
+    commit. Returns success and the report per book (id, title, changed fields with their new value, error)"""
+    calibre_db.create_functions(config)
+    books = {book.id: book for book in calibre_db.session.query(db.Books)
+             .options(selectinload(db.Books.authors), selectinload(db.Books.tags), selectinload(db.Books.series),
+                      selectinload(db.Books.languages), selectinload(db.Books.publishers),
+                      selectinload(db.Books.comments))
+             .filter(db.Books.id.in_(book_ids)).all()}
+    report = list()
+    renames = list()
+    now = datetime.now(timezone.utc)
+    for book_id in book_ids:
+        book = books.get(int(book_id))
+        if not book:
+            report.append({'id': book_id, 'success': False,
+                           'msg': _("Oops! Selected book is unavailable. File does not exist or is not accessible")})
+            continue
+        entry = {'id': book.id, 'title': book.title, 'success': True, 'changes': dict()}
+        report.append(entry)
+        first_author = None
+        try:
+            for field, value in changes:
+                if field == 'authors':
+                    input_authors, changed = handle_author_on_edit(book, value, update_author_sort)
+                    if changed:
+                        first_author = input_authors[0]
+                        entry['changes'][field] = ' & '.join([author.replace('|', ',') for author in input_authors])
+                    continue
+                new_value = bulk_edit_field(book, field, value, update_title_sort)
+                if new_value is not None:
+                    entry['changes'][field] = new_value
+            # the session doesn't autoflush, tags and series created for this book must be found for the next ones
+            calibre_db.session.flush()
+        except ValueError as e:
+            entry.update(success=False, msg=str(e))
+            continue
+        except (OperationalError, IntegrityError, StaleDataError) as e:
+            # the transaction is lost, the remaining books aren't edited
+            log.error_or_exception("Database error: {}".format(e))
+            entry.update(success=False, msg='Database error: {}'.format(e.orig if hasattr(e, "orig") else e))
+            break
+        if entry['changes']:
+            book.last_modified = now
+            if 'title' in entry['changes'] or first_author:
+                renames.append((book.id, first_author))
+    success = all(entry['success'] for entry in report)
+    if dry_run or not success:
+        calibre_db.session.rollback()
+        return success, report
+    try:
+        calibre_db.session.commit()
+    except (OperationalError, IntegrityError, StaleDataError) as e:
+        calibre_db.session.rollback()
+        log.error_or_exception("Database error: {}".format(e))
+        error = 'Database error: {}'.format(e.orig if hasattr(e, "orig") else e)
+        for entry in report:
+            entry.update(success=False, msg=error)
+        return False, report
+    calibre_db.clear_cache()
+    changed = [entry['id'] for entry in report if entry['changes']]
+    if changed:
+        library_changes.record(changed, ub.LibraryChange.TYPE_MODIFIED)
+    if renames:
+        WorkerThread.add(current_user.name, TaskBulkUpdateMetadata(renames))
+    return True, report
+
 
 # Separated from /editbooks so that /editselectedbooks can also use this
 #
@@ -426,6 +531,7 @@ def edit_book_param(param, vals, multi=False):
 
             calibre_db.session.commit()
             calibre_db.clear_cache()
+            library_changes.record(book.id, ub.LibraryChange.TYPE_MODIFIED)
             # revert change for sort if automatic fields link is deactivated
             if param == 'title' and vals.get('checkT') == False:
                 book.sort = sort_param
@@ -870,7 +976,8 @@ def prepare_authors_on_upload(title, authr):
             if not db_author:
                 db_author = db.Authors(inp, helper.get_sorted_author(inp), "")
                 calibre_db.session.add(db_author)
-                calibre_db.session.commit()
+                # committed with the book, uploads of many books are written in batches
+                calibre_db.session.flush()
             sort_author = helper.get_sorted_author(inp)
         else:
             if not db_author:
@@ -944,24 +1051,33 @@ def create_book_on_upload(modify_date, meta):
     return db_book, input_authors, title_dir
 
 
-def file_handling_on_upload(requested_file):
-    # check if file extension is correct
+def check_upload_file(requested_file):
+    """Returns the error response if the type or extension of the file isn't allowed, None otherwise"""
     allowed_extensions = config.config_upload_formats.split(',')
     if requested_file:
         if config.config_check_extensions and allowed_extensions != ['']:
             if not validate_mime_type(requested_file, allowed_extensions):
                 flash(_("File type isn't allowed to be uploaded to this server"), category="error")
-                return None, make_response(jsonify(location=url_for("web.index")))
+                return make_response(jsonify(location=url_for("web.index")))
     if '.' in requested_file.filename:
         file_ext = requested_file.filename.rsplit('.', 1)[-1].lower()
         if file_ext not in allowed_extensions and '' not in allowed_extensions:
             flash(
                 _("File extension '%(ext)s' is not allowed to be uploaded to this server",
                   ext=file_ext), category="error")
-            return None, make_response(jsonify(location=url_for("web.index")))
+            return make_response(jsonify(location=url_for("web.index")))
     else:
         flash(_('File to be uploaded must have an extension'), category="error")
-        return None, make_response(jsonify(location=url_for("web.index")))
+        return make_response(jsonify(location=url_for("web.index")))
+    return None
+
+
+def file_handling_on_upload(requested_file):
+    # check if file extension is correct
+    error = check_upload_file(requested_file)
+    if error:
+        return None, error
+    file_ext = requested_file.filename.rsplit('.', 1)[-1].lower()
 
     # extract metadata from file
     try:
@@ -1004,6 +1120,10 @@ def delete_whole_book(book_id, book):
     # delete book from shelves, Downloads, Read list
     ub.session.query(ub.BookShelf).filter(ub.BookShelf.book_id == book_id).delete()
     ub.session.query(ub.ReadBook).filter(ub.ReadBook.book_id == book_id).delete()
+    kobo_metadata_cache.metadata_cache.invalidate(book_id)
+    structure_cache.invalidate(book_id)
+    link_cache.invalidate(book_id)
+    library_changes.record(book_id, ub.LibraryChange.TYPE_DELETED, commit=False)
     ub.delete_download(book_id)
     ub.session_commit()
 
@@ -1102,8 +1222,12 @@ def delete_book_from_UI(book_id, book_format, location=""):
             else:
                 calibre_db.session.query(db.Data).filter(db.Data.book == book.id). \
                     filter(db.Data.format == book_format).delete()
+                # bulk delete doesn't emit the mapper events of the link cache
+                link_cache.invalidate(book.id)
                 if book_format.upper() in ['KEPUB', 'EPUB', 'EPUB3']:
                     kobo_sync_status.remove_synced_book(book.id, True)
+                else:
+                    library_changes.record(book.id, ub.LibraryChange.TYPE_MODIFIED)
             calibre_db.session.commit()
         except Exception as ex:
             log.error_or_exception(ex)
@@ -1483,6 +1607,8 @@ def upload_book_formats(requested_files, book, book_id, no_cover=True):
                     db_format = db.Data(book_id, file_ext.upper(), file_size, file_name)
                     calibre_db.session.add(db_format)
                     calibre_db.session.commit()
+                    library_changes.record(book_id, ub.LibraryChange.TYPE_MODIFIED)
+                    structure_cache.update_book(book_id)
                     calibre_db.create_functions(config)
                 except (OperationalError, IntegrityError, StaleDataError) as e:
                     calibre_db.session.rollback()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# Structural metadata of the epub and kepub files of the library: rendition layout, number of spine items, estimated
+# page count, href of the cover image and OPF version. The content.opf of a file is parsed once and the result is
+# stored in app.db together with the size and modification time of the file. Kobo sync and OPDS feeds only read the
+# stored entries with one query per batch, the reader needs a query and a stat call. Entries are filled on upload, by
+# a backfill task and when a book is opened in the reader, an entry of a replaced file is parsed again.
+
+import os
+import posixpath
+import zipfile
+from collections import namedtuple
+
+from lxml import etree
+from sqlalchemy import exc
+
+from . import logger, config, ub, db, calibre_db
+
+log = logger.create()
+
+STRUCTURE_FORMATS = ('EPUB', 'KEPUB')
+# Bytes of xhtml markup per page of a reflowable book
+PAGE_BYTES = 2400
+# Books checked and written in one transaction by the backfill
+BATCH_SIZE = 200
+
+Structure = namedtuple("Structure", ["layout", "spine_length", "page_count", "cover_href", "opf_version", "size"])
+
+_container_ns = {'n': 'urn:oasis:names:tc:opendocument:xmlns:container'}
+_opf_ns = {'pkg': 'http://www.idpf.org/2007/opf'}
+
+
+def _cover_href(opf):
+    hrefs = opf.xpath("/pkg:package/pkg:manifest/pkg:item[contains(concat(' ', @properties, ' '), ' cover-image ')]"
+                      "/@href", namespaces=_opf_ns)
+    if not hrefs:
+        cover_id = opf.xpath("/pkg:package/pkg:metadata/pkg:meta[@name='cover']/@content", namespaces=_opf_ns)
+        if cover_id:
+            hrefs = opf.xpath("/pkg:package/pkg:manifest/pkg:item[@id=$id]/@href", namespaces=_opf_ns,
+                              id=cover_id[0])
+    if not hrefs:
+        hrefs = opf.xpath("/pkg:package/pkg:manifest/pkg:item[@id='cover-image']/@href", namespaces=_opf_ns)
+    return hrefs[0] if hrefs else None
+
+
+def parse_structure(file_path):
+    """Reads the structure of the epub file, the values of an unreadable file are None"""
+    size = os.path.getsize(file_path)
+    try:
+        with zipfile.ZipFile(file_path) as epub_zip:
+            container = etree.fromstring(epub_zip.read('META-INF/container.xml'))
+            opf_name = container.xpath('n:rootfiles/n:rootfile/@full-path', namespaces=_container_ns)[0]
+            opf = etree.fromstring(epub_zip.read(opf_name))
+            opf_dir = posixpath.dirname(opf_name)
+            members = {info.filename: info.file_size for info in epub_zip.infolist()}
+    except (zipfile.BadZipFile, etree.XMLSyntaxError, KeyError, IndexError, UnicodeDecodeError) as ex:
+        log.error("Could not parse epub structure of %s: %s", file_path, ex)
+        return Structure(None, None, None, None, None, size)
+    layout = opf.xpath('/pkg:package/pkg:metadata/pkg:meta[@property="rendition:layout"]/text()', namespaces=_opf_ns)
+    layout = layout[0].strip() if layout else None
+    manifest = {item.get('id'): item.get('href') for item in
+                opf.xpath('/pkg:package/pkg:manifest/pkg:item', namespaces=_opf_ns)}
+    spine = [manifest[ref] for ref in opf.xpath('/pkg:package/pkg:spine/pkg:itemref/@idref', namespaces=_opf_ns)
+             if ref in manifest]
+    if layout == 'pre-paginated':
+        page_count = len(spine)
+    else:
+        markup = sum(members.get(posixpath.normpath(posixpath.join(opf_dir, href)), 0) for href in spine)
+        page_count = max(1, round(markup / PAGE_BYTES)) if spine else None
+    cover_href = _cover_href(opf)
+    if cover_href:
+        cover_href = posixpath.normpath(posixpath.join(opf_dir, cover_href))
+    return Structure(layout, len(spine), page_count, cover_href, opf.get('version'), size)
+
+
+def _to_structure(row):
+    return Structure(row.layout, row.spine_length, row.page_count, row.cover_href, row.opf_version, row.size)
+
+
+class EpubStructureCache:
+    @staticmethod
+    def _file_path(book_path, book, book_data):
+        return os.path.join(book_path, book.path, book_data.name + "." + book_data.format.lower())
+
+    @staticmethod
+    def _store(session, row, book_id, book_format, file_stat, structure):
+        if row is None:
+            row = ub.EpubStructure(book_id=book_id, format=book_format)
+            session.add(row)
+        row.size = file_stat.st_size
+        row.mtime = file_stat.st_mtime
+        row.layout, row.spine_length, row.page_count, row.cover_href, row.opf_version, __ = structure
+        return row
+
+    def get(self, book, book_data, session=None):
+        """Returns the Structure of the format of the book, the file is only parsed if the stored entry doesn't match
+        its size and modification time. None for other formats and books stored on Google Drive. A parsed entry is
+        added to the session, committing is left to the caller"""
+        if book_data.format.upper() not in STRUCTURE_FORMATS or config.config_use_google_drive:
+            return None
+        session = session or ub.session
+        file_path = self._file_path(config.get_book_path(), book, book_data)
+        try:
+            file_stat = os.stat(file_path)
+        except OSError as ex:
+            log.error("Could not read epub structure of book %d: %s", book.id, ex)
+            return None
+        row = (session.query(ub.EpubStructure)
+               .filter(ub.EpubStructure.book_id == book.id, ub.EpubStructure.format == book_data.format.upper())
+               .first())
+        if row and row.size == file_stat.st_size and row.mtime == file_stat.st_mtime:
+            return _to_structure(row)
+        try:
+            structure = parse_structure(file_path)
+        except OSError as ex:
+            log.error("Could not read epub structure of book %d: %s", book.id, ex)
+            return None
+        self._store(session, row, book.id, book_data.format.upper(), file_stat, structure)
+        return structure
+
+    def lookup(self, books, session=None):
+        """Returns dict book_id -> Structure of the epub (or kepub) of the books with a stored entry. The entries and
+        the format sizes known to the library are loaded with one query each, no file is read"""
+        book_ids = [book.id for book in books]
+        found = dict()
+        if not book_ids:
+            return found
+        session = session or ub.session
+        try:
+            sizes = {(book_id, book_format): size for book_id, book_format, size in
+                     calibre_db.session.query(db.Data.book, db.Data.format, db.Data.uncompressed_size)
+                     .filter(db.Data.book.in_(book_ids), db.Data.format.in_(STRUCTURE_FORMATS))}
+            rows = session.query(ub.EpubStructure).filter(ub.EpubStructure.book_id.in_(book_ids)).all() \
+                if sizes else []
+        except exc.OperationalError as ex:
+            log.error_or_exception(ex)
+            return found
+        for row in sorted(rows, key=lambda r: r.format != 'EPUB'):
+            if row.book_id not in found and sizes.get((row.book_id, row.format)) == row.size:
+                found[row.book_id] = _to_structure(row)
+        return found
+
+    def update(self, session, calibre_session, book_path, book_ids=None, should_stop=None):
+        """Parses the new and changed epub files of the given books or the whole library and removes the entries of
+        deleted formats, returns the number of parsed files"""
+        query = (calibre_session.query(db.Books.id, db.Books.path, db.Data.name, db.Data.format)
+                 .join(db.Data, db.Data.book == db.Books.id)
+                 .filter(db.Data.format.in_(STRUCTURE_FORMATS)))
+        if book_ids is not None:
+            query = query.filter(db.Books.id.in_(list(book_ids)))
+        files = {(book_id, book_format): (path, name) for book_id, path, name, book_format in query}
+        stored = session.query(ub.EpubStructure)
+        if book_ids is not None:
+            stored = stored.filter(ub.EpubStructure.book_id.in_(list(book_ids)))
+        rows = dict()
+        for row in stored:
+            key = (row.book_id, row.format)
+            if key in files and key not in rows:
+                rows[key] = row
+            else:
+                session.delete(row)
+        parsed = 0
+        for key, (path, name) in files.items():
+            if should_stop and should_stop():
+                break
+            file_path = os.path.join(book_path, path, name + "." + key[1].lower())
+            try:
+                file_stat = os.stat(file_path)
+                row = rows.get(key)
+                if row and row.size == file_stat.st_size and row.mtime == file_stat.st_mtime:
+                    continue
+                self._store(session, row, key[0], key[1], file_stat, parse_structure(file_path))
+            except OSError as ex:
+                log.debug("Could not read epub structure of book %d: %s", key[0], ex)
+                continue
+            parsed += 1
+            if parsed % BATCH_SIZE == 0:
+                session.commit()
+        session.commit()
+        return parsed
+
+    def update_book(self, book_id):
+        """Fills the entries of a new or changed book, used after uploads"""
+        if config.config_use_google_drive:
+            return
+        try:
+            self.update(ub.session, calibre_db.session, config.get_book_path(), [book_id])
+        except (exc.OperationalError, exc.IntegrityError) as ex:
+            ub.session.rollback()
+            log.error_or_exception(ex)
+
+    @staticmethod
+    def invalidate(book_id):
+        # Remove entries of deleted books, committing is left to the caller
+        ub.session.query(ub.EpubStructure).filter(ub.EpubStructure.book_id == book_id).delete()
+
+
+structure_cache = EpubStructureCache()
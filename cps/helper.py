@@ -31,7 +31,8 @@ import unidecode
 from uuid import uuid4
 from functools import lru_cache
 
-from flask import send_from_directory, make_response, abort, url_for, Response, request, send_file, after_this_request
+from flask import send_from_directory, make_response, abort, url_for, Response, request, send_file, after_this_request, \
+    redirect
 from flask_babel import gettext as _
 from flask_babel import lazy_gettext as N_
 from flask_babel import get_locale
@@ -58,11 +59,11 @@ from .tasks.convert import TaskConvert
 from . import logger, config, db, ub, fs
 from . import gdriveutils as gd
 from .constants import (STATIC_DIR as _STATIC_DIR, CACHE_TYPE_THUMBNAILS, THUMBNAIL_TYPE_COVER, THUMBNAIL_TYPE_SERIES,
-                        SUPPORTED_CALIBRE_BINARIES)
+                        THUMBNAIL_TYPE_AUTHOR, SUPPORTED_CALIBRE_BINARIES)
 from .subproc_wrapper import process_wait
 from .services.worker import WorkerThread
 from .tasks.mail import TaskEmail
-from .tasks.thumbnail import TaskClearCoverThumbnailCache, TaskGenerateCoverThumbnails
+from .tasks.thumbnail import TaskClearCoverThumbnailCache, TaskGenerateCoverThumbnails, TaskGenerateAuthorThumbnails
 from .tasks.metadata_backup import TaskBackupMetadata
 from .file_helper import get_temp_dir
 from .epub_helper import get_content_opf, create_new_metadata_backup, updateEpub, replace_metadata
@@ -261,22 +262,6 @@ def get_valid_filename(value, replace_whitespace=True, chars=128, force_unidecod
     return value
 
 
-def split_authors(values):
-    authors_list = []
-    for value in values:
-        authors = re.split('[&;]', value)
-        for author in authors:
-            commas = author.count(',')
-            if commas == 1:
-                author_split = author.split(',')
-                authors_list.append(strip_whitespaces(author_split[1]) + ' ' + strip_whitespaces(author_split[0]))
-            elif commas > 1:
-                authors_list.extend([strip_whitespaces(x) for x in author.split(',')])
-            else:
-                authors_list.append(strip_whitespaces(author))
-    return authors_list
-
-
 def get_sorted_author(value):
     value2 = None
     try:
@@ -914,6 +899,35 @@ def get_series_thumbnail(series_id, resolution):
         .first())
 
 
+def get_author_thumbnails(author_id):
+    """Returns dict resolution -> thumbnail of the local images of the author, empty if they don't show the current
+    image_url"""
+    author_info = ub.session.query(ub.AuthorInfo).filter(ub.AuthorInfo.author_id == author_id).first()
+    if not author_info or not author_info.image_url or author_info.image_source != author_info.image_url:
+        return {}
+    thumbnails = (ub.session
+        .query(ub.Thumbnail)
+        .filter(ub.Thumbnail.type == THUMBNAIL_TYPE_AUTHOR)
+        .filter(ub.Thumbnail.entity_id == author_id)
+        .filter(or_(ub.Thumbnail.expiration.is_(None), ub.Thumbnail.expiration > datetime.now(timezone.utc)))
+        .all())
+    return {thumbnail.resolution: thumbnail for thumbnail in thumbnails}
+
+
+def get_author_image(author_id, resolution):
+    # The image urls contain the generation time of the thumbnail, a changed image gets a new url
+    thumbnail = get_author_thumbnails(author_id).get(resolution)
+    if thumbnail:
+        cache = fs.FileSystem()
+        if cache.get_cache_file_exists(thumbnail.filename, CACHE_TYPE_THUMBNAILS):
+            return send_from_directory(cache.get_cache_file_dir(thumbnail.filename, CACHE_TYPE_THUMBNAILS),
+                                       thumbnail.filename, max_age=31536000)
+    author_info = ub.session.query(ub.AuthorInfo).filter(ub.AuthorInfo.author_id == author_id).first()
+    if author_info and author_info.image_url:
+        return redirect(author_info.image_url)
+    abort(404)
+
+
 # saves book cover from url
 def save_cover_from_url(url, book_path):
     try:
@@ -1250,6 +1264,10 @@ def update_thumbnail_cache():
         WorkerThread.add(None, TaskGenerateCoverThumbnails())
 
 
+def update_author_thumbnails(author_id):
+    WorkerThread.add(None, TaskGenerateAuthorThumbnails(author_id), hidden=True)
+
+
 def set_all_metadata_dirty():
     WorkerThread.add(None, TaskBackupMetadata(export_language=get_locale(),
                                               translated_title=_("Cover"),
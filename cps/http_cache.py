@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+# On-disk cache for the GET requests of the metadata providers and the author enrichment sources, stored in a sqlite
+# database in the cache directory. Bodies are stored with their ETag and Last-Modified headers, responses are fresh
+# for the max-age of their Cache-Control (or until Expires, or 10% of their age if only Last-Modified is known). Stale
+# entries with validators are revalidated with If-None-Match/If-Modified-Since, a 304 answer serves the stored body.
+# Stale entries are also served if the request fails or the server answers with an error (5xx) and always in offline
+# mode, where nothing is sent at all. Responses naming request headers in Vary are stored per value of these headers.
+# The entries are pruned by last use when the stored bodies exceed MAX_SIZE.
+
+import json
+import os
+import re
+import sqlite3
+import time
+from email.utils import parsedate_to_datetime
+from threading import Lock
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from . import logger, constants, config
+from .fs import FileSystem
+
+log = logger.create()
+
+MAX_SIZE = 200 * 1024 * 1024
+MAX_BODY_SIZE = 5 * 1024 * 1024
+# Upper bound of the freshness guessed from Last-Modified
+MAX_HEURISTIC_TTL = 24 * 60 * 60
+PRUNE_INTERVAL = 200
+
+# Headers describing the transfer, the stored body is already decoded
+_transfer_headers = ("content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive")
+_max_age = re.compile(r"(?:^|,)\s*max-age\s*=\s*\"?(\d+)", re.IGNORECASE)
+_columns = "url, variant, vary, status, headers, body, etag, last_modified, fresh_until, size, last_used"
+
+
+def _parse_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def cache_control(headers):
+    return {part.strip().split("=")[0].lower() for part in headers.get("Cache-Control", "").split(",")}
+
+
+def freshness(headers, now):
+    """Returns the time until the response is fresh"""
+    directives = cache_control(headers)
+    if "no-cache" in directives:
+        return now
+    match = _max_age.search(headers.get("Cache-Control", ""))
+    if match:
+        return now + int(match.group(1))
+    expires = _parse_date(headers.get("Expires"))
+    if expires is not None:
+        date = _parse_date(headers.get("Date")) or now
+        return now + max(0.0, expires - date)
+    last_modified = _parse_date(headers.get("Last-Modified"))
+    if last_modified is not None:
+        return now + min(MAX_HEURISTIC_TTL, max(0.0, (now - last_modified) / 10))
+    return now
+
+
+def vary_names(headers):
+    """Request headers named in the Vary header of the response, None if it varies on everything (*)"""
+    names = sorted({name.strip().lower() for name in headers.get("Vary", "").split(",") if name.strip()})
+    return None if "*" in names else names
+
+
+def variant(names, request_headers):
+    """Key of the request among the stored variants of an url"""
+    request_headers = CaseInsensitiveDict(request_headers or {})
+    return json.dumps([[name, request_headers.get(name, "")] for name in names])
+
+
+def build_response(url, status, headers, body):
+    response = requests.Response()
+    response.status_code = status
+    response.url = url
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = body
+    response.reason = "OK" if status == 200 else ""
+    response.from_cache = True
+    return response
+
+
+class HttpCache:
+    def __init__(self, path=None, max_size=MAX_SIZE):
+        self._path = path
+        self.max_size = max_size
+        self._lock = Lock()
+        self._writes = 0
+        self._checked = False
+        self.stats = {"requests": 0, "hits": 0, "revalidated": 0, "stale": 0, "stored": 0, "bytes_saved": 0}
+
+    @property
+    def path(self):
+        if not self._path:
+            self._path = os.path.join(FileSystem().get_cache_dir(constants.CACHE_TYPE_HTTP), "http.db")
+        return self._path
+
+    @property
+    def offline(self):
+        return bool(getattr(config, "config_http_cache_offline", False))
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        if not self._checked:
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(responses)")]
+            if columns and "variant" not in columns:
+                # entries stored by url alone, the cache starts over
+                connection.execute("DROP TABLE responses")
+            self._checked = True
+        connection.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT, variant TEXT, vary TEXT, "
+                           "status INTEGER, headers TEXT, body BLOB, etag TEXT, last_modified TEXT, "
+                           "fresh_until REAL, size INTEGER, last_used REAL, PRIMARY KEY (url, variant))")
+        return connection
+
+    def _count(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                self.stats[name] += value
+
+    def _load(self, url, request_headers):
+        """Returns the stored variant of the url matching the request headers"""
+        try:
+            connection = self._connect()
+            try:
+                rows = connection.execute("SELECT variant, vary, status, headers, body, etag, last_modified, "
+                                          "fresh_until FROM responses WHERE url = ?", (url,)).fetchall()
+            finally:
+                connection.close()
+        except sqlite3.Error as ex:
+            log.error("Reading http cache failed: %s", ex)
+            return None
+        for row in rows:
+            if variant(json.loads(row[1]), request_headers) == row[0]:
+                return row
+        return None
+
+    def _execute(self, statement, parameters):
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute(statement, parameters)
+            finally:
+                connection.close()
+        except sqlite3.Error as ex:
+            log.error("Writing http cache failed: %s", ex)
+
+    def _store(self, url, response, request_headers):
+        names = vary_names(response.headers)
+        if response.status_code != 200 or "no-store" in cache_control(response.headers) or names is None \
+                or len(response.content) > MAX_BODY_SIZE:
+            return
+        now = time.time()
+        headers = {key: value for key, value in response.headers.items() if key.lower() not in _transfer_headers}
+        self._execute("INSERT OR REPLACE INTO responses ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                      .format(_columns),
+                      (url, variant(names, request_headers), json.dumps(names), response.status_code,
+                       json.dumps(headers), response.content,
+                       response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                       freshness(response.headers, now), len(response.content), now))
+        self._count(stored=1)
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % PRUNE_INTERVAL == 0
+        if prune:
+            self.prune()
+
+    def _serve(self, url, entry, **counters):
+        key, __, status, headers, body, __, __, __ = entry
+        self._count(bytes_saved=len(body), **counters)
+        self._execute("UPDATE responses SET last_used = ? WHERE url = ? AND variant = ?", (time.time(), url, key))
+        return build_response(url, status, json.loads(headers), body)
+
+    def get(self, url, send, headers=None):
+        """Returns the response of a GET request of the prepared url, send(headers) sends the request"""
+        self._count(requests=1)
+        entry = self._load(url, headers)
+        if entry is not None:
+            if entry[7] > time.time():
+                return self._serve(url, entry, hits=1)
+            if self.offline:
+                return self._serve(url, entry, stale=1)
+        elif self.offline:
+            raise requests.ConnectionError("Offline mode, {} is not cached".format(url))
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry[5]:
+                request_headers["If-None-Match"] = entry[5]
+            if entry[6]:
+                request_headers["If-Modified-Since"] = entry[6]
+        try:
+            response = send(request_headers)
+        except requests.RequestException:
+            if entry is None:
+                raise
+            log.debug("Request of %s failed, serving stored response", url)
+            return self._serve(url, entry, stale=1)
+        if entry is not None and response.status_code >= 500:
+            log.debug("Request of %s answered with %d, serving stored response", url, response.status_code)
+            response.close()
+            return self._serve(url, entry, stale=1)
+        if response.status_code == 304 and entry is not None:
+            self._execute("UPDATE responses SET fresh_until = ?, last_used = ? WHERE url = ? AND variant = ?",
+                          (freshness(response.headers, time.time()), time.time(), url, entry[0]))
+            response.close()
+            return self._serve(url, entry, revalidated=1)
+        self._store(url, response, headers)
+        return response
+
+    def prune(self):
+        with self._lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    total = connection.execute("SELECT coalesce(sum(size), 0) FROM responses").fetchone()[0]
+                    if total > self.max_size:
+                        # removes the least recently used entries down to 80% of the maximum size
+                        kept = 0
+                        drop = []
+                        for rowid, size in connection.execute("SELECT rowid, size FROM responses "
+                                                              "ORDER BY last_used DESC").fetchall():
+                            kept += size
+                            if kept > self.max_size * 0.8:
+                                drop.append((rowid,))
+                        connection.executemany("DELETE FROM responses WHERE rowid = ?", drop)
+            finally:
+                connection.close()
+
+    def clear(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                connection = self._connect()
+                try:
+                    with connection:
+                        connection.execute("DELETE FROM responses")
+                    connection.execute("VACUUM")
+                finally:
+                    connection.close()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        served = stats["hits"] + stats["revalidated"] + stats["stale"]
+        stats["hit_ratio"] = round(100.0 * served / stats["requests"], 1) if stats["requests"] else None
+        stats["entries"] = stats["size"] = 0
+        if os.path.exists(self.path):
+            try:
+                connection = self._connect()
+                try:
+                    stats["entries"], stats["size"] = connection.execute(
+                        "SELECT count(*), coalesce(sum(size), 0) FROM responses").fetchone()
+                finally:
+                    connection.close()
+            except sqlite3.Error as ex:
+                log.error("Reading http cache failed: %s", ex)
+        stats["offline"] = self.offline
+        return stats
+
+
+http_cache = HttpCache()
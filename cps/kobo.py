@@ -21,7 +21,6 @@ import base64
 from datetime import datetime, timezone
 import os
 import uuid
-import zipfile
 from time import gmtime, strftime
 import json
 from urllib.parse import unquote
@@ -38,15 +37,18 @@ from flask import (
 )
 from .cw_login import current_user
 from werkzeug.datastructures import Headers
-from sqlalchemy import func
+from sqlalchemy import func, insert
 from sqlalchemy.sql.expression import and_, or_
 from sqlalchemy.exc import StatementError
 from sqlalchemy.sql import select
+from sqlalchemy.orm import selectinload
 import requests
 
 from . import config, logger, kobo_auth, db, calibre_db, helper, shelf as shelf_lib, ub, csrf, kobo_sync_status
 from . import isoLanguages
-from .epub import get_epub_layout
+from . import library_changes
+from .kobo_metadata_cache import metadata_cache, URL_BASE
+from .epub_structure import structure_cache
 from .constants import COVER_THUMBNAIL_SMALL, COVER_THUMBNAIL_MEDIUM, COVER_THUMBNAIL_LARGE
 from .helper import get_download_link
 from .services import SyncToken as SyncToken
@@ -158,6 +160,7 @@ def HandleSyncRequest():
         sync_token.books_last_modified = datetime.min
         sync_token.books_last_created = datetime.min
         sync_token.reading_state_last_modified = datetime.min
+        sync_token.books_change_seq = -1
 
     new_books_last_modified = sync_token.books_last_modified  # needed for sync selected shelfs only
     new_books_last_created = sync_token.books_last_created  # needed to distinguish between new and changed entitlement
@@ -166,103 +169,136 @@ def HandleSyncRequest():
     new_archived_last_modified = datetime.min
     sync_results = []
 
-    # We reload the book database so that the user gets a fresh view of the library
-    # in case of external changes (e.g: adding a book through Calibre).
-    calibre_db.reconnect_db(config, ub.app_DB_path)
+    # External changes (e.g: adding a book through Calibre) are appended to the library change feed, so books only
+    # have to be searched if the feed has new entries for this user since the last complete sync of the device
+    library_changes.detect_external_changes(config, calibre_db.session)
+    change_seq = library_changes.latest_sequence()
+    books_changed = (sync_token.books_change_seq < 0
+                     or library_changes.has_changes_since(sync_token.books_change_seq, current_user.id))
 
     only_kobo_shelves = current_user.kobo_only_shelves_sync
+    reading_states_in_new_entitlements = []
+    book_count = 0
 
-    if only_kobo_shelves:
-        changed_entries = calibre_db.session.query(db.Books,
-                                                   ub.ArchivedBook.last_modified,
-                                                   ub.BookShelf.date_added,
-                                                   ub.ArchivedBook.is_archived)
-        changed_entries = (changed_entries
-                           .join(db.Data).outerjoin(ub.ArchivedBook, and_(db.Books.id == ub.ArchivedBook.book_id,
-                                                                          ub.ArchivedBook.user_id == current_user.id))
-                           .filter(db.Books.id.notin_(calibre_db.session.query(ub.KoboSyncedBooks.book_id)
-                                                      .filter(ub.KoboSyncedBooks.user_id == current_user.id)))
-                           .filter(ub.BookShelf.date_added > sync_token.books_last_modified)
-                           .filter(db.Data.format.in_(KOBO_FORMATS))
-                           .filter(calibre_db.common_filters(allow_show_archived=True))
-                           .order_by(db.Books.id)
-                           .order_by(ub.ArchivedBook.last_modified)
-                           .join(ub.BookShelf, db.Books.id == ub.BookShelf.book_id)
-                           .join(ub.Shelf)
-                           .filter(ub.Shelf.user_id == current_user.id)
-                           .filter(ub.Shelf.kobo_sync)
-                           .distinct())
+    if not books_changed:
+        log.debug("No library changes since last sync")
+        new_archived_last_modified = sync_token.archive_last_modified
     else:
-        changed_entries = calibre_db.session.query(db.Books,
-                                                   ub.ArchivedBook.last_modified,
-                                                   ub.ArchivedBook.is_archived)
-        changed_entries = (changed_entries
-                           .join(db.Data).outerjoin(ub.ArchivedBook, and_(db.Books.id == ub.ArchivedBook.book_id,
-                                                                          ub.ArchivedBook.user_id == current_user.id))
-                           .filter(db.Books.id.notin_(calibre_db.session.query(ub.KoboSyncedBooks.book_id)
-                                                      .filter(ub.KoboSyncedBooks.user_id == current_user.id)))
-                           .filter(calibre_db.common_filters(allow_show_archived=True))
-                           .filter(db.Data.format.in_(KOBO_FORMATS))
-                           .order_by(db.Books.last_modified)
-                           .order_by(db.Books.id))
-
-    reading_states_in_new_entitlements = []
-    books = changed_entries.limit(SYNC_ITEM_LIMIT)
-    log.debug("Books to Sync: {}".format(len(books.all())))
-    for book in books:
-        formats = [data.format for data in book.Books.data]
-        if 'KEPUB' not in formats and config.config_kepubifypath and 'EPUB' in formats:
-            helper.convert_book_format(book.Books.id, config.get_book_path(), 'EPUB', 'KEPUB', current_user.name)
-
-        kobo_reading_state = get_or_create_reading_state(book.Books.id)
-        entitlement = {
-            "BookEntitlement": create_book_entitlement(book.Books, archived=(book.is_archived==True)),
-            "BookMetadata": get_metadata(book.Books),
-        }
+        if only_kobo_shelves:
+            changed_entries = calibre_db.session.query(db.Books,
+                                                       ub.ArchivedBook.last_modified,
+                                                       ub.BookShelf.date_added,
+                                                       ub.ArchivedBook.is_archived)
+            changed_entries = (changed_entries
+                               .join(db.Data)
+                               .outerjoin(ub.ArchivedBook, and_(db.Books.id == ub.ArchivedBook.book_id,
+                                                                ub.ArchivedBook.user_id == current_user.id))
+                               .filter(db.Books.id.notin_(calibre_db.session.query(ub.KoboSyncedBooks.book_id)
+                                                          .filter(ub.KoboSyncedBooks.user_id == current_user.id)))
+                               .filter(ub.BookShelf.date_added > sync_token.books_last_modified)
+                               .filter(db.Data.format.in_(KOBO_FORMATS))
+                               .filter(calibre_db.common_filters(allow_show_archived=True))
+                               .order_by(db.Books.id)
+                               .order_by(ub.ArchivedBook.last_modified)
+                               .join(ub.BookShelf, db.Books.id == ub.BookShelf.book_id)
+                               .join(ub.Shelf)
+                               .filter(ub.Shelf.user_id == current_user.id)
+                               .filter(ub.Shelf.kobo_sync)
+                               .distinct())
+        else:
+            changed_entries = calibre_db.session.query(db.Books,
+                                                       ub.ArchivedBook.last_modified,
+                                                       ub.ArchivedBook.is_archived)
+            changed_entries = (changed_entries
+                               .join(db.Data)
+                               .outerjoin(ub.ArchivedBook, and_(db.Books.id == ub.ArchivedBook.book_id,
+                                                                ub.ArchivedBook.user_id == current_user.id))
+                               .filter(db.Books.id.notin_(calibre_db.session.query(ub.KoboSyncedBooks.book_id)
+                                                          .filter(ub.KoboSyncedBooks.user_id == current_user.id)))
+                               .filter(calibre_db.common_filters(allow_show_archived=True))
+                               .filter(db.Data.format.in_(KOBO_FORMATS))
+                               .order_by(db.Books.last_modified)
+                               .order_by(db.Books.id))
+
+        # Load the whole batch (including the relations needed for the metadata) at once, reading states and synced
+        # book entries are prefetched for the batch and written back with a single commit at the end
+        books = (changed_entries
+                 .options(selectinload(db.Books.data),
+                          selectinload(db.Books.authors),
+                          selectinload(db.Books.series),
+                          selectinload(db.Books.languages),
+                          selectinload(db.Books.publishers),
+                          selectinload(db.Books.comments))
+                 .limit(SYNC_ITEM_LIMIT).all())
+        log.debug("Books to Sync: {}".format(len(books)))
+        kobo_reading_states = get_or_create_reading_states([book.Books.id for book in books])
+        url_base = get_download_url_base()
+        cached_metadata = metadata_cache.lookup([book.Books for book in books])
+        # stored epub structure of the books without cached metadata only, sync never parses book files
+        structures = structure_cache.lookup([book.Books for book in books if book.Books.id not in cached_metadata])
+        new_metadata = []
+        for book in books:
+            formats = [data.format for data in book.Books.data]
+            if 'KEPUB' not in formats and config.config_kepubifypath and 'EPUB' in formats:
+                helper.convert_book_format(book.Books.id, config.get_book_path(), 'EPUB', 'KEPUB', current_user.name)
+
+            kobo_reading_state = kobo_reading_states[book.Books.id]
+            metadata_json = cached_metadata.get(book.Books.id)
+            if metadata_json is None:
+                metadata_json = json.dumps(get_metadata(book.Books, URL_BASE, structures), ensure_ascii=False)
+                new_metadata.append((book.Books, metadata_json))
+            entitlement = {
+                "BookEntitlement": create_book_entitlement(book.Books, archived=(book.is_archived==True)),
+                "BookMetadata": JsonFragment(metadata_cache.fill(metadata_json, url_base)),
+            }
 
-        if kobo_reading_state.last_modified > sync_token.reading_state_last_modified:
-            entitlement["ReadingState"] = get_kobo_reading_state_response(book.Books, kobo_reading_state)
-            new_reading_state_last_modified = max(new_reading_state_last_modified, kobo_reading_state.last_modified)
-            reading_states_in_new_entitlements.append(book.Books.id)
+            reading_state_last_modified = kobo_reading_state.last_modified.replace(tzinfo=None)
+            if reading_state_last_modified > sync_token.reading_state_last_modified:
+                entitlement["ReadingState"] = get_kobo_reading_state_response(book.Books, kobo_reading_state)
+                new_reading_state_last_modified = max(new_reading_state_last_modified, reading_state_last_modified)
+                reading_states_in_new_entitlements.append(book.Books.id)
 
-        ts_created = book.Books.timestamp.replace(tzinfo=None)
+            ts_created = book.Books.timestamp.replace(tzinfo=None)
 
-        try:
-            ts_created = max(ts_created, book.date_added)
-        except AttributeError:
-            pass
+            try:
+                ts_created = max(ts_created, book.date_added)
+            except AttributeError:
+                pass
 
-        if ts_created > sync_token.books_last_created:
-            sync_results.append({"NewEntitlement": entitlement})
-        else:
-            sync_results.append({"ChangedEntitlement": entitlement})
+            if ts_created > sync_token.books_last_created:
+                sync_results.append({"NewEntitlement": entitlement})
+            else:
+                sync_results.append({"ChangedEntitlement": entitlement})
 
-        new_books_last_modified = max(
-            book.Books.last_modified.replace(tzinfo=None), new_books_last_modified
-        )
-        try:
             new_books_last_modified = max(
-                new_books_last_modified, book.date_added
+                book.Books.last_modified.replace(tzinfo=None), new_books_last_modified
             )
-        except AttributeError:
-            pass
+            try:
+                new_books_last_modified = max(
+                    new_books_last_modified, book.date_added
+                )
+            except AttributeError:
+                pass
+
+            new_books_last_created = max(ts_created, new_books_last_created)
+        metadata_cache.store(new_metadata)
+        kobo_sync_status.add_synced_books_bulk([book.Books.id for book in books])
+        ub.session_commit()
 
-        new_books_last_created = max(ts_created, new_books_last_created)
-        kobo_sync_status.add_synced_books(book.Books.id)
+        max_change = changed_entries.filter(ub.ArchivedBook.is_archived)\
+            .filter(ub.ArchivedBook.user_id == current_user.id) \
+            .order_by(func.datetime(ub.ArchivedBook.last_modified).desc()).first()
 
-    max_change = changed_entries.filter(ub.ArchivedBook.is_archived)\
-        .filter(ub.ArchivedBook.user_id == current_user.id) \
-        .order_by(func.datetime(ub.ArchivedBook.last_modified).desc()).first()
+        max_change = max_change.last_modified if max_change else new_archived_last_modified
 
-    max_change = max_change.last_modified if max_change else new_archived_last_modified
+        new_archived_last_modified = max(new_archived_last_modified, max_change)
 
-    new_archived_last_modified = max(new_archived_last_modified, max_change)
+        # no. of books returned
+        book_count = changed_entries.count()
+        log.debug("Remaining books to Sync: {}".format(book_count))
 
-    # no. of books returned
-    book_count = changed_entries.count()
     # last entry:
     cont_sync = bool(book_count)
-    log.debug("Remaining books to Sync: {}".format(book_count))
     # generate reading state data
     changed_reading_states = ub.session.query(ub.KoboReadingState)
 
@@ -285,8 +321,15 @@ def HandleSyncRequest():
              ub.KoboReadingState.book_id.notin_(reading_states_in_new_entitlements)))\
         .order_by(ub.KoboReadingState.last_modified)
     cont_sync |= bool(changed_reading_states.count() > SYNC_ITEM_LIMIT)
-    for kobo_reading_state in changed_reading_states.limit(SYNC_ITEM_LIMIT).all():
-        book = calibre_db.session.query(db.Books).filter(db.Books.id == kobo_reading_state.book_id).one_or_none()
+    changed_reading_states = (changed_reading_states
+                              .options(selectinload(ub.KoboReadingState.current_bookmark),
+                                       selectinload(ub.KoboReadingState.statistics),
+                                       selectinload(ub.KoboReadingState.book_read_link))
+                              .limit(SYNC_ITEM_LIMIT).all())
+    state_books = {book.id: book for book in calibre_db.session.query(db.Books)
+                   .filter(db.Books.id.in_([state.book_id for state in changed_reading_states]))}
+    for kobo_reading_state in changed_reading_states:
+        book = state_books.get(kobo_reading_state.book_id)
         if book:
             sync_results.append({
                 "ChangedReadingState": {
@@ -303,6 +346,9 @@ def HandleSyncRequest():
     sync_token.books_last_modified = new_books_last_modified
     sync_token.archive_last_modified = new_archived_last_modified
     sync_token.reading_state_last_modified = new_reading_state_last_modified
+    # the device knows about all changes up to here once no books are remaining
+    if not book_count:
+        sync_token.books_change_seq = change_seq
 
     return generate_sync_response(sync_token, sync_results, cont_sync)
 
@@ -329,11 +375,29 @@ def generate_sync_response(sync_token, sync_results, set_cont=False):
 
     # log.debug("Kobo Sync Content: {}".format(sync_results))
     # jsonify decodes the Unicode string different to what kobo expects
-    response = make_response(json.dumps(sync_results), extra_headers)
+    response = make_response(dump_sync_results(sync_results), extra_headers)
     response.headers["Content-Type"] = "application/json; charset=utf-8"
     return response
 
 
+# Already serialized json (cached book metadata), which is inserted unchanged into the sync response
+class JsonFragment(str):
+    pass
+
+
+def dump_json_fragments(item):
+    if isinstance(item, JsonFragment):
+        return item
+    if isinstance(item, dict) and any(isinstance(value, (dict, JsonFragment)) for value in item.values()):
+        return "{" + ", ".join(json.dumps(str(key)) + ": " + dump_json_fragments(value)
+                               for key, value in item.items()) + "}"
+    return json.dumps(item)
+
+
+def dump_sync_results(sync_results):
+    return "[" + ", ".join(dump_json_fragments(item) for item in sync_results) + "]"
+
+
 @kobo.route("/v1/library/<book_uuid>/metadata")
 @requires_kobo_auth
 @download_required
@@ -346,8 +410,12 @@ def HandleMetadataRequest(book_uuid):
         log.info("Book %s not found in database", book_uuid)
         return redirect_or_proxy_request()
 
-    metadata = get_metadata(book)
-    response = make_response(json.dumps([metadata], ensure_ascii=False))
+    metadata_json = metadata_cache.lookup([book]).get(book.id)
+    if metadata_json is None:
+        metadata_json = json.dumps(get_metadata(book, URL_BASE), ensure_ascii=False)
+        metadata_cache.store([(book, metadata_json)])
+        ub.session_commit()
+    response = make_response("[" + metadata_cache.fill(metadata_json, get_download_url_base()) + "]")
     response.headers["Content-Type"] = "application/json; charset=utf-8"
     return response
 
@@ -376,6 +444,11 @@ def get_download_url_for_book(book_id, book_format):
     )
 
 
+# Download urls without book id and format, they contain host, port and auth token of the request
+def get_download_url_base():
+    return get_download_url_for_book(0, "epub").rsplit("/", 2)[0]
+
+
 def create_book_entitlement(book, archived):
     book_uuid = str(book.uuid)
     return {
@@ -437,7 +510,13 @@ def get_language(book):
     return isoLanguages.get(part3=book.languages[0].lang_code).part1
 
 
-def get_metadata(book):
+# url_base: download url base of the request (see get_download_url_base) or the URL_BASE placeholder of the cache
+# structures: stored epub structure of the book (see EpubStructureCache.lookup), books without a stored entry are
+# treated as reflowable until the backfill task has read them
+def get_metadata(book, url_base, structures=None):
+    if structures is None:
+        structures = structure_cache.lookup([book])
+    structure = structures.get(book.id)
     download_urls = []
     kepub = [data for data in book.data if data.format == 'KEPUB']
 
@@ -446,21 +525,18 @@ def get_metadata(book):
             continue
         for kobo_format in KOBO_FORMATS[book_data.format]:
             # log.debug('Id: %s, Format: %s' % (book.id, kobo_format))
-            try:
-                if get_epub_layout(book, book_data) == 'pre-paginated':
-                    kobo_format = 'EPUB3FL'
-                download_urls.append(
-                    {
-                        "Format": kobo_format,
-                        "Size": book_data.uncompressed_size,
-                        "Url": get_download_url_for_book(book.id, book_data.format),
-                        # The Kobo forma accepts platforms: (Generic, Android)
-                        "Platform": "Generic",
-                        # "DrmType": "None", # Not required
-                    }
-                )
-            except (zipfile.BadZipfile, FileNotFoundError) as e:
-                log.error(e)
+            if structure and structure.layout == 'pre-paginated':
+                kobo_format = 'EPUB3FL'
+            download_urls.append(
+                {
+                    "Format": kobo_format,
+                    "Size": book_data.uncompressed_size,
+                    "Url": "{}/{}/{}".format(url_base, book.id, book_data.format.lower()),
+                    # The Kobo forma accepts platforms: (Generic, Android)
+                    "Platform": "Generic",
+                    # "DrmType": "None", # Not required
+                }
+            )
 
     book_uuid = book.uuid
     metadata = {
@@ -853,6 +929,48 @@ def get_or_create_reading_state(book_id):
     return book_read.kobo_reading_state
 
 
+# Bulk variant of get_or_create_reading_state for a sync batch. Existing reading states are fetched with one query,
+# missing read links, reading states, bookmarks and statistics are inserted with one statement per table, committing
+# is left to the caller
+def get_or_create_reading_states(book_ids):
+    if not book_ids:
+        return dict()
+    user_id = int(current_user.id)
+    book_reads = {book_read.book_id: book_read for book_read in
+                  ub.session.query(ub.ReadBook)
+                  .filter(ub.ReadBook.book_id.in_(book_ids), ub.ReadBook.user_id == user_id)
+                  .options(selectinload(ub.ReadBook.kobo_reading_state)
+                           .selectinload(ub.KoboReadingState.current_bookmark),
+                           selectinload(ub.ReadBook.kobo_reading_state)
+                           .selectinload(ub.KoboReadingState.statistics))}
+    missing_reads = [book_id for book_id in dict.fromkeys(book_ids) if book_id not in book_reads]
+    missing_states = missing_reads + [book_id for book_id, book_read in book_reads.items()
+                                      if not book_read.kobo_reading_state]
+    if missing_reads:
+        ub.session.execute(insert(ub.ReadBook.__table__),
+                           [{"user_id": user_id, "book_id": book_id} for book_id in missing_reads])
+    if missing_states:
+        ub.session.execute(insert(ub.KoboReadingState.__table__),
+                           [{"user_id": user_id, "book_id": book_id} for book_id in missing_states])
+        # ordered by id, the newly inserted state wins over a leftover one of the book
+        state_ids = {book_id: state_id for state_id, book_id in
+                     ub.session.query(ub.KoboReadingState.id, ub.KoboReadingState.book_id)
+                     .filter(ub.KoboReadingState.book_id.in_(missing_states), ub.KoboReadingState.user_id == user_id)
+                     .order_by(ub.KoboReadingState.id)}
+        rows = [{"kobo_reading_state_id": state_ids[book_id]} for book_id in missing_states]
+        ub.session.execute(insert(ub.KoboBookmark.__table__), rows)
+        ub.session.execute(insert(ub.KoboStatistics.__table__), rows)
+        book_reads.update((book_read.book_id, book_read) for book_read in
+                          ub.session.query(ub.ReadBook)
+                          .filter(ub.ReadBook.book_id.in_(missing_states), ub.ReadBook.user_id == user_id)
+                          .options(selectinload(ub.ReadBook.kobo_reading_state)
+                                   .selectinload(ub.KoboReadingState.current_bookmark),
+                                   selectinload(ub.ReadBook.kobo_reading_state)
+                                   .selectinload(ub.KoboReadingState.statistics))
+                          .populate_existing())
+    return {book_id: book_read.kobo_reading_state for book_id, book_read in book_reads.items()}
+
+
 def get_kobo_reading_state_response(book, kobo_reading_state):
     return {
         "EntitlementId": book.uuid,
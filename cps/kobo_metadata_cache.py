@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Cache for the serialized "BookMetadata" part of kobo sync and metadata responses. Entries are kept in memory
+# (bounded, least recently used are dropped) and written to app.db, so they survive restarts. An entry is only valid
+# for the last_modified timestamp and formats of the book. The download urls contain the host, port and auth token of
+# the requesting device, they are stored with the placeholder URL_BASE, which is replaced when the entry is served.
+
+import json
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy import exc
+
+from . import logger, ub
+
+log = logger.create()
+
+MAX_MEMORY_ENTRIES = 10000
+# Written in place of the download url base, a serialized string only starts with an escaped NUL character if the
+# value does
+URL_BASE = "\x00url_base\x00"
+_url_base_json = json.dumps(URL_BASE)[:-1]
+
+
+class KoboMetadataCache:
+    def __init__(self, max_entries=MAX_MEMORY_ENTRIES):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.max_entries = max_entries
+
+    @staticmethod
+    def fill(metadata_json, url_base):
+        """Returns the serialized metadata with the download url base of the request"""
+        return metadata_json.replace(_url_base_json, json.dumps(url_base, ensure_ascii=False)[:-1])
+
+    @staticmethod
+    def _timestamp(book):
+        # Adding or converting formats doesn't touch last_modified of the book, so the formats are part of the stamp
+        return "{}|{}".format(book.last_modified,
+                              ",".join(sorted("{}:{}".format(data.format, data.uncompressed_size)
+                                              for data in book.data)))
+
+    def _get_memory(self, book_id, timestamp):
+        with self._lock:
+            entry = self._entries.get(book_id)
+            if entry and entry[0] == timestamp:
+                self._entries.move_to_end(book_id)
+                return entry[1]
+        return None
+
+    def _set_memory(self, book_id, timestamp, metadata_json):
+        with self._lock:
+            self._entries[book_id] = (timestamp, metadata_json)
+            self._entries.move_to_end(book_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def lookup(self, books):
+        """Returns dict book_id -> serialized metadata with the URL_BASE placeholder for all books with a valid cache
+        entry, entries not held in memory are loaded from app.db with one query"""
+        found = dict()
+        missing = dict()
+        for book in books:
+            timestamp = self._timestamp(book)
+            metadata_json = self._get_memory(book.id, timestamp)
+            if metadata_json is not None:
+                found[book.id] = metadata_json
+            else:
+                missing[book.id] = timestamp
+        if missing:
+            try:
+                rows = (ub.session.query(ub.KoboMetadataCache)
+                        .filter(ub.KoboMetadataCache.book_id.in_(list(missing))).all())
+            except exc.OperationalError as ex:
+                log.error_or_exception(ex)
+                rows = []
+            for row in rows:
+                if missing.get(row.book_id) == row.last_modified:
+                    found[row.book_id] = row.metadata_json
+                    self._set_memory(row.book_id, row.last_modified, row.metadata_json)
+        return found
+
+    def store(self, entries):
+        """Stores list of (book, serialized metadata with the URL_BASE placeholder) in memory and adds them to the
+        app.db session, committing is left to the caller"""
+        if not entries:
+            return
+        rows = {row.book_id: row for row in
+                ub.session.query(ub.KoboMetadataCache)
+                .filter(ub.KoboMetadataCache.book_id.in_([book.id for book, __ in entries]))}
+        for book, metadata_json in entries:
+            timestamp = self._timestamp(book)
+            self._set_memory(book.id, timestamp, metadata_json)
+            row = rows.get(book.id)
+            if not row:
+                row = ub.KoboMetadataCache(book_id=book.id)
+                ub.session.add(row)
+                rows[book.id] = row
+            row.last_modified = timestamp
+            row.metadata_json = metadata_json
+
+    def invalidate(self, book_id):
+        # Remove entries of deleted books
+        with self._lock:
+            self._entries.pop(book_id, None)
+        ub.session.query(ub.KoboMetadataCache).filter(ub.KoboMetadataCache.book_id == book_id).delete()
+
+
+metadata_cache = KoboMetadataCache()
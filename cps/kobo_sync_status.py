@@ -18,8 +18,9 @@
 
 
 from .cw_login import current_user
-from . import ub
+from . import ub, library_changes
 from datetime import datetime, timezone
+from sqlalchemy import insert
 from sqlalchemy.sql.expression import or_, and_, true
 # from sqlalchemy import exc
 
@@ -37,17 +38,36 @@ def add_synced_books(book_id):
         ub.session_commit()
 
 
+# Add all given book ids to kobo_synced_books table for current user with one lookup for already present entries and
+# one insert statement, committing is left to the caller, so that a whole sync batch is written in one transaction
+def add_synced_books_bulk(book_ids):
+    if not book_ids:
+        return
+    present = set(entry.book_id for entry in
+                  ub.session.query(ub.KoboSyncedBooks.book_id)
+                  .filter(ub.KoboSyncedBooks.book_id.in_(book_ids))
+                  .filter(ub.KoboSyncedBooks.user_id == current_user.id))
+    rows = [{"user_id": current_user.id, "book_id": book_id}
+            for book_id in dict.fromkeys(book_ids) if book_id not in present]
+    if rows:
+        ub.session.execute(insert(ub.KoboSyncedBooks.__table__), rows)
+
+
 # Select all entries of current book in kobo_synced_books table, which are from current user and delete them
 def remove_synced_book(book_id, all=False, session=None):
     if not all:
         user = ub.KoboSyncedBooks.user_id == current_user.id
     else:
         user = true()
+    # the book has to be transferred again, so it's a change for the kobo sync of the user(s)
+    change_user = None if all else current_user.id
     if not session:
         ub.session.query(ub.KoboSyncedBooks).filter(ub.KoboSyncedBooks.book_id == book_id).filter(user).delete()
+        library_changes.record(book_id, ub.LibraryChange.TYPE_MODIFIED, change_user, commit=False)
         ub.session_commit()
     else:
         session.query(ub.KoboSyncedBooks).filter(ub.KoboSyncedBooks.book_id == book_id).filter(user).delete()
+        library_changes.record(book_id, ub.LibraryChange.TYPE_MODIFIED, change_user, session=session, commit=False)
         ub.session_commit(_session=session)
 
 
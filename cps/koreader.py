@@ -3,33 +3,44 @@
 from flask import Blueprint, request, jsonify, abort
 from .usermanagement import requires_basic_auth_if_no_ano, auth
 from . import ub, calibre_db, logger, db
+from .document_index import document_index
+from .services.worker import WorkerThread
+from .tasks.database import TaskBuildDocumentIndex
 
 koreader = Blueprint('koreader', __name__)
 log = logger.create()
 
+
+def get_document_book_id(document_id):
+    # document_id is the partial MD5 of the file or the MD5 of its file name, some clients send the book uuid
+    if document_index.refresh_due():
+        WorkerThread.add(None, TaskBuildDocumentIndex(), hidden=True)
+    book_id = document_index.lookup(document_id)
+    if book_id is None and not document_index.ready:
+        # index isn't built yet, try uuid and title
+        book = calibre_db.session.query(db.Books).filter(db.Books.uuid == document_id).first()
+        if not book:
+            clean_id = document_id.replace('.epub', '').replace('.mobi', '').replace('.pdf', '')
+            book = calibre_db.session.query(db.Books).filter(db.Books.title == clean_id).first()
+        book_id = book.id if book else None
+    if book_id is None:
+        document_index.record_unmatched(document_id)
+    return book_id
+
+
 @koreader.route("/koreader/sync/v1/progress/<path:document_id>", methods=["GET", "PUT"])
 @requires_basic_auth_if_no_ano
 def koreader_sync(document_id):
     user_id = int(auth.current_user().id)
-    
-    # Try to find book_id from document_id
-    # document_id could be a UUID, filename, or MD5.
-    # We'll try to match by UUID first, then filename.
-    book = calibre_db.session.query(db.Books).filter(db.Books.uuid == document_id).first()
-    if not book:
-        # Try matching by filename (this is slow but might work for KOReader)
-        # Often document_id is title.epub
-        clean_id = document_id.replace('.epub', '').replace('.mobi', '').replace('.pdf', '')
-        book = calibre_db.session.query(db.Books).filter(db.Books.title == clean_id).first()
 
-    if not book:
-        # Fallback: search for any book that might match
-        log.debug(f"KOReader Sync: Document {document_id} not found by UUID or title")
+    book_id = get_document_book_id(document_id)
+    if book_id is None:
+        log.debug("KOReader Sync: Document %s not found", document_id)
         return jsonify({"status": "error", "message": "Book not found"}), 404
 
     read_book = ub.session.query(ub.ReadBook).filter(
         ub.ReadBook.user_id == user_id,
-        ub.ReadBook.book_id == book.id
+        ub.ReadBook.book_id == book_id
     ).first()
 
     if request.method == "GET":
@@ -58,7 +69,7 @@ def koreader_sync(document_id):
              return jsonify({"status": "error", "message": "No progress data"}), 400
 
         if not read_book:
-            read_book = ub.ReadBook(user_id=user_id, book_id=book.id)
+            read_book = ub.ReadBook(user_id=user_id, book_id=book_id)
             ub.session.add(read_book)
             
         read_book.progress_percent = max(0.0, min(100.0, float(percentage)))
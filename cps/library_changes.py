@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Change feed of the library. In-app edits append their changes directly, changes made outside of Calibre-Web
+# (e.g. adding books with Calibre) are detected by watching metadata.db. Consumers remember the last sequence number
+# they have seen and only need one indexed lookup to find out whether anything changed since.
+
+import os
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+
+from sqlalchemy import exc
+from sqlalchemy.sql.expression import exists, func, or_
+
+from . import logger, ub, db
+from .cache_manager import cache
+
+log = logger.create()
+
+# Entries older than this are removed by the clean up task, the newest entry is always kept
+RETENTION_DAYS = 90
+
+_detect_lock = Lock()
+_metadata_signature = None
+_last_modified_mark = None
+
+
+def record(book_ids, change_type, user_id=None, session=None, commit=True):
+    """Appends a change entry for each given book id (or one entry for book_id None)"""
+    s = session if session else ub.session
+    if not isinstance(book_ids, (list, tuple, set)):
+        book_ids = [book_ids]
+    s.add_all([ub.LibraryChange(book_id=book_id, user_id=user_id, change_type=change_type) for book_id in book_ids])
+    if commit:
+        ub.session_commit(_session=s)
+
+
+def latest_sequence():
+    try:
+        return ub.session.query(func.max(ub.LibraryChange.id)).scalar() or 0
+    except exc.OperationalError as ex:
+        log.error_or_exception(ex)
+        return 0
+
+
+def _pruned_since(sequence):
+    """True if entries appended after the sequence number were already removed, ids have no gaps otherwise"""
+    oldest = ub.session.query(func.min(ub.LibraryChange.id)).scalar()
+    return oldest is not None and sequence < oldest - 1
+
+
+def has_changes_since(sequence, user_id=None):
+    """True if entries relevant for all users or the given user were appended after the sequence number"""
+    try:
+        if _pruned_since(sequence):
+            return True
+        return ub.session.query(exists().where(ub.LibraryChange.id > sequence,
+                                               or_(ub.LibraryChange.user_id == None,
+                                                   ub.LibraryChange.user_id == user_id))).scalar()
+    except exc.OperationalError as ex:
+        log.error_or_exception(ex)
+        return True
+
+
+def changed_books_since(sequence):
+    """Returns the latest sequence number and the ids of books changed after the given sequence number, None instead
+    of the ids if changes can't be assigned to books (e.g. books deleted outside of Calibre-Web)"""
+    try:
+        if _pruned_since(sequence):
+            return latest_sequence(), None
+        rows = (ub.session.query(ub.LibraryChange.id, ub.LibraryChange.book_id)
+                .filter(ub.LibraryChange.id > sequence,
+                        ub.LibraryChange.change_type != ub.LibraryChange.TYPE_USER).all())
+    except exc.OperationalError as ex:
+        log.error_or_exception(ex)
+        return sequence, None
+    if not rows:
+        return sequence, set()
+    book_ids = set(row.book_id for row in rows)
+    return max(row.id for row in rows), None if None in book_ids else book_ids
+
+
+def prune(session, days=RETENTION_DAYS):
+    """Removes entries older than days, returns the number of removed entries. Committing is left to the caller"""
+    newest = session.query(func.max(ub.LibraryChange.id)).scalar()
+    if newest is None:
+        return 0
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    return (session.query(ub.LibraryChange)
+            .filter(ub.LibraryChange.timestamp < cutoff, ub.LibraryChange.id < newest)
+            .delete(synchronize_session=False))
+
+
+def user_marker(config, calibre_session, user_id):
+    """Marker for everything a user's view of the library depends on: the change feed including changes detected
+    in metadata.db and the read status of the user, which is not part of the change feed"""
+    detect_external_changes(config, calibre_session)
+    read_state = (ub.session.query(func.count(ub.ReadBook.id), func.max(ub.ReadBook.last_modified))
+                  .filter(ub.ReadBook.user_id == user_id).first())
+    return latest_sequence(), tuple(read_state)
+
+
+def _get_metadata_signature(calibre_dir):
+    signature = []
+    for filename in ("metadata.db", "metadata.db-wal"):
+        try:
+            stat = os.stat(os.path.join(calibre_dir, filename))
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def detect_external_changes(config, calibre_session):
+    """Checks if metadata.db was changed since the last call and appends the changed books to the feed.
+    Unchanged files cost one stat call, no database query is done in this case"""
+    global _metadata_signature, _last_modified_mark
+    if not config.config_calibre_dir:
+        return
+    signature = _get_metadata_signature(config.config_calibre_dir)
+    if signature == _metadata_signature:
+        return
+    with _detect_lock:
+        if signature == _metadata_signature:
+            return
+        try:
+            newest = calibre_session.query(func.max(db.Books.last_modified)).scalar()
+            if _last_modified_mark is None:
+                # First check after start, changes done while we were not running are unknown
+                record(None, ub.LibraryChange.TYPE_EXTERNAL)
+            else:
+                changed = [book.id for book in calibre_session.query(db.Books.id)
+                           .filter(db.Books.last_modified > _last_modified_mark)]
+                # Deleted books and changes not touching last_modified can't be assigned to a book
+                record(changed or None, ub.LibraryChange.TYPE_EXTERNAL)
+                cache.clear()
+            _last_modified_mark = newest or datetime.min
+            _metadata_signature = signature
+        except exc.SQLAlchemyError as ex:
+            log.error_or_exception(ex)
@@ -33,6 +33,7 @@ def main():
     from .web import web
     from .basic import basic
     from .opds import opds
+    from .opds2 import opds2
     from .admin import admi
     from .gdrive import gdrive
     from .editbooks import editbook
@@ -70,6 +71,8 @@ def main():
     app.register_blueprint(basic)
     app.register_blueprint(opds)
     limiter.limit("3/minute", key_func=request_username)(opds)
+    app.register_blueprint(opds2)
+    limiter.limit("3/minute", key_func=request_username)(opds2)
     app.register_blueprint(jinjia)
     app.register_blueprint(about)
     app.register_blueprint(shelf)
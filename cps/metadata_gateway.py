@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+
+# Gateway between the metadata search of the book editor and the metadata providers. Provider searches run on a
+# shared thread pool within a global time budget, the results of providers answering in time are returned and the
+# late ones are still stored when they finish. Results are kept in a sqlite cache in the cache directory per
+# provider, normalized query and locale for CACHE_TTL seconds, identical searches running at the same time share one
+# provider call. The providers send their http requests through provider_http, which keeps one connection pool per
+# host and sends a second (hedged) GET if the first one takes longer than usual for the host. GET requests are
+# answered from the on-disk http cache where possible.
+# Latency, cache hits, errors and timeouts are counted per provider and host for the admin page.
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from collections import deque
+from dataclasses import asdict
+from http.cookiejar import DefaultCookiePolicy
+from threading import Lock, RLock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import logger, constants
+from .fs import FileSystem
+from .http_cache import http_cache
+
+log = logger.create()
+
+# Seconds the metadata search waits for the providers, slower providers are left out of the result
+SEARCH_BUDGET = 10
+PROVIDER_WORKERS = 10
+# Seconds cached provider results are used, empty results are searched again earlier
+CACHE_TTL = 24 * 60 * 60
+CACHE_TTL_EMPTY = 60 * 60
+MAX_CACHE_ENTRIES = 5000
+PRUNE_INTERVAL = 100
+
+DEFAULT_TIMEOUT = 15
+POOL_SIZE = 10
+HTTP_WORKERS = 20
+# A hedged GET is sent after the 95th percentile latency of the host, once it is known from enough requests
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.5
+LATENCY_SAMPLES = 200
+
+_whitespace = re.compile(r"\s+")
+_isbn = re.compile(r"^[0-9][0-9\- ]{8,16}[0-9xX]$")
+
+
+def normalize_query(query):
+    query = _whitespace.sub(" ", (query or "").strip().lower())
+    if _isbn.match(query):
+        return query.replace("-", "").replace(" ", "")
+    return query
+
+
+def percentile(samples, share):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+class LatencyStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.cache_hits = 0
+        self.hedged = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def to_dict(self):
+        p50 = percentile(self.latencies, 0.5)
+        p95 = percentile(self.latencies, 0.95)
+        return {"requests": self.requests, "errors": self.errors, "timeouts": self.timeouts,
+                "cache_hits": self.cache_hits, "hedged": self.hedged,
+                "p50_ms": round(p50 * 1000) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000) if p95 is not None else None}
+
+
+class HostPools:
+    """Sends the http requests of the providers, one session with its connection pool per host"""
+    def __init__(self, pool_size=POOL_SIZE):
+        self.pool_size = pool_size
+        self._lock = Lock()
+        self._sessions = dict()
+        self._stats = dict()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=HTTP_WORKERS,
+                                                               thread_name_prefix="metadata_http")
+
+    def session(self, host):
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                # requests are independent of each other like with requests.get
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[host] = session
+                self._stats[host] = LatencyStats()
+            return session
+
+    def _send(self, host, method, url, kwargs):
+        stats = self._stats[host]
+        start = time.perf_counter()
+        try:
+            response = self._sessions[host].request(method, url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                stats.requests += 1
+                stats.errors += 1
+            raise
+        with self._lock:
+            stats.requests += 1
+            stats.latencies.append(time.perf_counter() - start)
+        return response
+
+    def hedge_delay(self, host):
+        with self._lock:
+            latencies = list(self._stats[host].latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, percentile(latencies, 0.95))
+
+    def request(self, method, url, hedge=False, cached=True, **kwargs):
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        if method == "GET" and cached:
+            # the cache key is the url with the query parameters
+            url = requests.Request(method, url, params=kwargs.pop("params", None)).prepare().url
+            headers = kwargs.pop("headers", None)
+
+            def send(request_headers):
+                return self._request(method, url, hedge, headers=request_headers, **kwargs)
+            return http_cache.get(url, send, headers)
+        return self._request(method, url, hedge, **kwargs)
+
+    def _request(self, method, url, hedge, **kwargs):
+        host = urlsplit(url).netloc.lower()
+        self.session(host)
+        delay = self.hedge_delay(host) if hedge else None
+        if delay is None:
+            return self._send(host, method, url, kwargs)
+        primary = self._executor.submit(self._send, host, method, url, kwargs)
+        try:
+            return primary.result(timeout=delay)
+        except concurrent.futures.TimeoutError:
+            pass
+        with self._lock:
+            self._stats[host].hedged += 1
+        hedged = self._executor.submit(self._send, host, method, url, kwargs)
+        error = None
+        for future in concurrent.futures.as_completed((primary, hedged)):
+            if future.exception() is None:
+                other = hedged if future is primary else primary
+                other.add_done_callback(_close_response)
+                return future.result()
+            error = future.exception()
+        raise error
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, hedge=True, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get_stats(self):
+        with self._lock:
+            return {host: stats.to_dict() for host, stats in sorted(self._stats.items())}
+
+
+def _close_response(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+class ResponseCache:
+    """Provider results by provider, normalized query and locale, stored as json of the records"""
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = Lock()
+        self._writes = 0
+
+    @property
+    def path(self):
+        if not self._path:
+            self._path = os.path.join(FileSystem().get_cache_dir(constants.CACHE_TYPE_METADATA), "responses.db")
+        return self._path
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, provider TEXT, "
+                           "expires REAL, records TEXT)")
+        return connection
+
+    @staticmethod
+    def make_key(provider_id, query, locale, generic_cover):
+        return hashlib.sha1(json.dumps([provider_id, normalize_query(query), str(locale), generic_cover])
+                            .encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        try:
+            connection = self._connect()
+            try:
+                row = connection.execute("SELECT records FROM responses WHERE key = ? AND expires > ?",
+                                         (key, time.time())).fetchone()
+            finally:
+                connection.close()
+        except sqlite3.Error as ex:
+            log.error("Reading metadata cache failed: %s", ex)
+            return None
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, provider_id, records):
+        expires = time.time() + (CACHE_TTL if records else CACHE_TTL_EMPTY)
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % PRUNE_INTERVAL == 0
+            try:
+                connection = self._connect()
+                try:
+                    with connection:
+                        connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                                           (key, provider_id, expires, json.dumps(records)))
+                        if prune:
+                            connection.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+                            connection.execute("DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses "
+                                               "ORDER BY expires DESC LIMIT ?)", (MAX_CACHE_ENTRIES,))
+                finally:
+                    connection.close()
+            except sqlite3.Error as ex:
+                log.error("Writing metadata cache failed: %s", ex)
+
+    def clear(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                connection = self._connect()
+                try:
+                    with connection:
+                        connection.execute("DELETE FROM responses")
+                finally:
+                    connection.close()
+
+    def count(self):
+        if not os.path.exists(self.path):
+            return 0
+        connection = self._connect()
+        try:
+            return connection.execute("SELECT count(*) FROM responses WHERE expires > ?",
+                                      (time.time(),)).fetchone()[0]
+        finally:
+            connection.close()
+
+
+class MetadataGateway:
+    def __init__(self, cache=None):
+        self.cache = cache or ResponseCache()
+        self._lock = RLock()
+        self._inflight = dict()
+        self._stats = dict()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=PROVIDER_WORKERS,
+                                                               thread_name_prefix="metadata")
+
+    def _provider_stats(self, provider):
+        stats = self._stats.get(provider.__id__)
+        if stats is None:
+            stats = self._stats[provider.__id__] = LatencyStats()
+        return stats
+
+    def _run(self, provider, query, generic_cover, locale, key):
+        start = time.perf_counter()
+        try:
+            records = provider.search(query, generic_cover, locale)
+        except Exception as ex:
+            log.error_or_exception("Metadata search of {} failed: {}".format(provider.__name__, ex))
+            records = None
+        with self._lock:
+            stats = self._provider_stats(provider)
+            stats.requests += 1
+            stats.latencies.append(time.perf_counter() - start)
+            # providers return None if their request failed
+            if records is None:
+                stats.errors += 1
+        if records is None:
+            return None
+        records = [asdict(record) for record in records if record]
+        self.cache.set(key, provider.__id__, records)
+        return records
+
+    def _finished(self, key, future):
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry and entry[0] is future:
+                del self._inflight[key]
+
+    def _acquire(self, provider, query, generic_cover, locale):
+        """Returns key, future of the records of the provider as dicts and whether they came from the cache"""
+        key = self.cache.make_key(provider.__id__, query, locale, generic_cover)
+        records = self.cache.get(key)
+        if records is not None:
+            with self._lock:
+                self._provider_stats(provider).cache_hits += 1
+            future = concurrent.futures.Future()
+            future.set_result(records)
+            return key, future, True
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is None:
+                entry = self._inflight[key] = [self._executor.submit(self._run, provider, query, generic_cover,
+                                                                     locale, key), 0]
+            entry[1] += 1
+            future = entry[0]
+        future.add_done_callback(lambda done: self._finished(key, done))
+        return key, future, False
+
+    def _release(self, key, future, cancel):
+        """Drops one waiter of a provider call, a call nobody waits for anymore is cancelled if it didn't start"""
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry and entry[0] is future:
+                entry[1] -= 1
+                if cancel and entry[1] <= 0:
+                    future.cancel()
+
+    def stream(self, providers, query, generic_cover="", locale="en", budget=SEARCH_BUDGET):
+        """Yields (provider, records, seconds since start, status) for every provider as soon as it finished, status
+        is "ok", "cached", "error" or "timeout". Closing the generator early cancels provider calls not started"""
+        start = time.perf_counter()
+        pending = dict()
+        for provider in providers:
+            key, future, cached = self._acquire(provider, query, generic_cover, locale)
+            pending[future] = (provider, key, cached)
+        cancel = True
+        try:
+            try:
+                for future in concurrent.futures.as_completed(list(pending), timeout=budget):
+                    provider, key, cached = pending.pop(future)
+                    self._release(key, future, False)
+                    records = None if future.cancelled() else future.result()
+                    status = "error" if records is None else "cached" if cached else "ok"
+                    yield provider, records or [], time.perf_counter() - start, status
+            except concurrent.futures.TimeoutError:
+                late = [provider for provider, __, __ in pending.values()]
+                with self._lock:
+                    for provider in late:
+                        self._provider_stats(provider).timeouts += 1
+                log.info("Metadata providers %s did not answer within %s seconds",
+                         ", ".join(provider.__name__ for provider in late), budget)
+                # late results are still stored in the cache for the next search
+                cancel = False
+                for provider in late:
+                    yield provider, [], time.perf_counter() - start, "timeout"
+            cancel = False
+        finally:
+            for future, (__, key, __) in pending.items():
+                self._release(key, future, cancel)
+
+    def search(self, providers, query, generic_cover="", locale="en", budget=SEARCH_BUDGET):
+        """Returns the records of all providers answering within budget seconds and the providers which did not"""
+        records = list()
+        late = list()
+        for provider, found, __, status in self.stream(providers, query, generic_cover, locale, budget):
+            records.extend(found)
+            if status == "timeout":
+                late.append(provider)
+        return records, late
+
+    def get_stats(self):
+        with self._lock:
+            providers = {provider_id: stats.to_dict() for provider_id, stats in sorted(self._stats.items())}
+        return {"providers": providers, "hosts": provider_http.get_stats(), "cached": self.cache.count(),
+                "http_cache": http_cache.get_stats()}
+
+
+provider_http = HostPools()
+metadata_gateway = MetadataGateway()
@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import requests
 import random
 import re
 from typing import List, Optional
@@ -7,6 +6,7 @@ from urllib.parse import quote
 from lxml.html import fromstring, tostring
 from multiprocessing.pool import ThreadPool
 from cps import logger
+from cps.metadata_gateway import provider_http
 from cps.services.Metadata import MetaRecord, MetaSourceInfo, Metadata
 
 log = logger.create()
@@ -46,7 +46,7 @@ class Amazon(Metadata):
 
         try:
             search_url = f"{base_url}/s?k={quote(query)}&i=stripbooks"
-            resp = requests.get(search_url, headers=self._get_headers(), timeout=15)
+            resp = provider_http.get(search_url, headers=self._get_headers(), timeout=15)
             resp.raise_for_status()
             root = fromstring(resp.content)
             
@@ -89,7 +89,7 @@ class Amazon(Metadata):
 
     def _parse_details(self, match: MetaRecord, base_url: str) -> Optional[MetaRecord]:
         try:
-            resp = requests.get(match.url, headers=self._get_headers(), timeout=15)
+            resp = provider_http.get(match.url, headers=self._get_headers(), timeout=15)
             root = fromstring(resp.content)
             
             # Title
@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from typing import List, Optional
-import requests
 from cps import logger
+from cps.metadata_gateway import provider_http
 from cps.services.Metadata import MetaRecord, MetaSourceInfo, Metadata
 
 log = logger.create()
@@ -64,7 +64,7 @@ class AniList(Metadata):
         variables = {'search': query}
 
         try:
-            response = requests.post(self.API_URL, json={'query': graphql_query, 'variables': variables}, timeout=10)
+            response = provider_http.post(self.API_URL, json={'query': graphql_query, 'variables': variables}, timeout=10)
             response.raise_for_status()
             data = response.json()
         except Exception as e:
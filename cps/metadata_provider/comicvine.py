@@ -20,8 +20,8 @@
 from typing import Dict, List, Optional
 from urllib.parse import quote
 
-import requests
 from cps import logger
+from cps.metadata_gateway import provider_http
 from cps.services.Metadata import MetaRecord, MetaSourceInfo, Metadata
 
 log = logger.create()
@@ -50,7 +50,7 @@ class ComicVine(Metadata):
                 tokens = [quote(t.encode("utf-8")) for t in title_tokens]
                 query = "%20".join(tokens)
             try:
-                result = requests.get(
+                result = provider_http.get(
                     f"{ComicVine.BASE_URL}{query}{ComicVine.QUERY_PARAMS}",
                     headers=ComicVine.HEADERS,
                 )
@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 import re
-import requests
 import random
 from typing import List, Optional
 from urllib.parse import quote
 from multiprocessing.pool import ThreadPool
 from lxml.html import fromstring, tostring
 from cps import logger
+from cps.metadata_gateway import provider_http
 from cps.services.Metadata import MetaRecord, MetaSourceInfo, Metadata
 
 log = logger.create()
@@ -30,7 +30,7 @@ class Databazeknih(Metadata):
         if not self.active: return []
         try:
             url = self.SEARCH_URL.format(quote(query))
-            resp = requests.get(url, headers=self._get_headers(), timeout=15)
+            resp = provider_http.get(url, headers=self._get_headers(), timeout=15)
             resp.raise_for_status()
             root = fromstring(resp.content)
             
@@ -79,7 +79,7 @@ class Databazeknih(Metadata):
 
     def _parse_book_page(self, match: MetaRecord, generic_cover: str) -> Optional[MetaRecord]:
         try:
-            resp = requests.get(match.url, headers=self._get_headers(), timeout=15)
+            resp = provider_http.get(match.url, headers=self._get_headers(), timeout=15)
             root = fromstring(resp.content)
             
             # Title & Authors
@@ -19,11 +19,11 @@ import re
 from concurrent import futures
 from typing import List, Optional
 
-import requests
 from html2text import HTML2Text
 from lxml import etree
 
 from cps import logger
+from cps.metadata_gateway import provider_http
 from cps.services.Metadata import Metadata, MetaRecord, MetaSourceInfo
 
 log = logger.create()
@@ -62,8 +62,7 @@ class Douban(Metadata):
     DESCRIPTION_XPATH = "//div[@id='link-report']//div[@class='intro']"
     RATING_XPATH = "//div[@class='rating_self clearfix']/strong"
 
-    session = requests.Session()
-    session.headers = {
+    HEADERS = {
         'user-agent':
         'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.102 Safari/537.36 Edg/98.0.1108.56',
     }
@@ -102,11 +101,12 @@ class Douban(Metadata):
 
     def _get_book_id_list_from_html(self, query: str) -> List[str]:
         try:
-            r = self.session.get(self.SEARCH_URL,
-                                 params={
-                                     "cat": 1001,
-                                     "q": query
-                                 })
+            r = provider_http.get(self.SEARCH_URL,
+                                  headers=self.HEADERS,
+                                  params={
+                                      "cat": 1001,
+                                      "q": query
+                                  })
             r.raise_for_status()
 
         except Exception as e:
@@ -124,11 +124,12 @@ class Douban(Metadata):
 
     def _get_book_id_list_from_json(self, query: str) -> List[str]:
         try:
-            r = self.session.get(self.SEARCH_JSON_URL,
-                                 params={
-                                     "cat": 1001,
-                                     "q": query
-                                 })
+            r = provider_http.get(self.SEARCH_JSON_URL,
+                                  headers=self.HEADERS,
+                                  params={
+                                      "cat": 1001,
+                                      "q": query
+                                  })
             r.raise_for_status()
 
         except Exception as e:
@@ -151,7 +152,7 @@ class Douban(Metadata):
         log.debug(f"start parsing {url}")
 
         try:
-            r = self.session.get(url)
+            r = provider_http.get(url, headers=self.HEADERS)
             r.raise_for_status()
         except Exception as e:
             log.warning(e)
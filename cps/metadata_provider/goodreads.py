@@ -21,10 +21,10 @@ from typing import List, Optional
 from urllib.parse import quote
 from multiprocessing.pool import ThreadPool
 
-import requests
 from lxml.html import fromstring, tostring
 
 from cps import logger
+from cps.metadata_gateway import provider_http
 from cps.services.Metadata import MetaRecord, MetaSourceInfo, Metadata
 
 log = logger.create()
@@ -49,7 +49,7 @@ class Goodreads_Provider(Metadata):
                 query_encoded = quote(query.replace(' ', '+'))
                 url = self.SEARCH_URL.format(query_encoded)
 
-                result = requests.get(url, headers=self.headers)
+                result = provider_http.get(url, headers=self.headers)
                 result.raise_for_status()
             except Exception as e:
                 log.warning(f"Goodreads search error: {e}")
@@ -123,7 +123,7 @@ class Goodreads_Provider(Metadata):
 
     def _parse_book_page(self, match: MetaRecord, generic_cover: str) -> Optional[MetaRecord]:
         try:
-            response = requests.get(match.url, headers=self.headers)
+            response = provider_http.get(match.url, headers=self.headers)
             response.raise_for_status()
         except Exception as e:
             log.warning(f"Goodreads detail error for {match.url}: {e}")
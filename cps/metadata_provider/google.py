@@ -21,10 +21,9 @@ from typing import Dict, List, Optional
 from urllib.parse import quote
 from datetime import datetime
 
-import requests
-
 from cps import logger, config
 from cps.isoLanguages import get_lang3, get_language_name
+from cps.metadata_gateway import provider_http
 from cps.services.Metadata import MetaRecord, MetaSourceInfo, Metadata
 
 log = logger.create()
@@ -51,7 +50,7 @@ class Google(Metadata):
                 tokens = [quote(t.encode("utf-8")) for t in title_tokens]
                 query = "+".join(tokens)
             try:
-                results = requests.get(Google.SEARCH_URL + query + Google.API_KEY)
+                results = provider_http.get(Google.SEARCH_URL + query + Google.API_KEY)
                 results.raise_for_status()
             except Exception as e:
                 log.warning(e)
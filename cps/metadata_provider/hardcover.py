@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from typing import List, Optional, Dict
-import requests
 from cps import logger, config
+from cps.metadata_gateway import provider_http
 from cps.services.Metadata import MetaRecord, MetaSourceInfo, Metadata
 
 log = logger.create()
@@ -56,7 +56,7 @@ class Hardcover(Metadata):
         }
 
         try:
-            response = requests.post(self.API_URL, json={'query': graphql_query, 'variables': variables}, headers=headers, timeout=10)
+            response = provider_http.post(self.API_URL, json={'query': graphql_query, 'variables': variables}, headers=headers, timeout=10)
             response.raise_for_status()
             data = response.json()
         except Exception as e:
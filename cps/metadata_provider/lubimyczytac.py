@@ -21,7 +21,6 @@ from multiprocessing.pool import ThreadPool
 from typing import List, Optional, Tuple, Union
 from urllib.parse import quote
 
-import requests
 from dateutil import parser
 from html2text import HTML2Text
 from lxml.html import HtmlElement, fromstring, tostring
@@ -29,6 +28,7 @@ from markdown2 import Markdown
 
 from cps import logger
 from cps.isoLanguages import get_language_name
+from cps.metadata_gateway import provider_http
 from cps.services.Metadata import MetaRecord, MetaSourceInfo, Metadata
 
 log = logger.create()
@@ -118,7 +118,7 @@ class LubimyCzytac(Metadata):
     ) -> Optional[List[MetaRecord]]:
         if self.active:
             try:
-                result = requests.get(self._prepare_query(title=query))
+                result = provider_http.get(self._prepare_query(title=query))
                 result.raise_for_status()
             except Exception as e:
                 log.warning(e)
@@ -212,7 +212,7 @@ class LubimyCzytacParser:
         self, match: MetaRecord, generic_cover: str, locale: str
     ) -> MetaRecord:
         try:
-            response = requests.get(match.url)
+            response = provider_http.get(match.url)
             response.raise_for_status()
         except Exception as e:
             log.warning(e)
@@ -1,18 +1,31 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import io
 import json
 import os
+import shutil
 import zipfile
 import subprocess
 import tempfile
 import sqlite3
+from datetime import datetime, timezone
 from flask import Blueprint, request, flash, redirect, url_for
 from flask_babel import gettext as _
 from flask_login import login_required, current_user
-from sqlalchemy import and_
-from . import db, ub, helper, calibre_db
+from sqlalchemy.exc import OperationalError
+from . import ub, calibre_db, logger
+from .title_matcher import TitleMatcher
 
 mobile = Blueprint('mobile', __name__, url_prefix='/mobile')
+log = logger.create()
+
+# Matches below this confidence are reported as uncertain
+LOW_CONFIDENCE = 0.8
+# ReadBook rows loaded per query when applying an import
+UPSERT_BATCH = 500
+HASH_CHUNK_SIZE = 1024 * 1024
+
 
 @mobile.route('/upload_progress', methods=['POST'])
 @login_required
@@ -34,20 +47,22 @@ def upload_progress():
         os.close(fd)
         file.save(path)
         
-        count = 0
+        progress = ProgressImport()
         if app_type == 'librera':
             with open(path, 'r', encoding='utf-8') as f:
                 content = json.load(f)
-                count = process_librera_progress(content)
+                process_librera_progress(content, progress)
         elif app_type == 'moon':
-            count = process_moon_progress(path)
+            process_moon_progress(path, progress)
         elif app_type == 'readera':
-            count = process_readera_progress(path)
+            process_readera_progress(path, progress)
         else:
             flash(_('Unknown app type'), 'error')
             return redirect(url_for('web.profile'))
-            
+        count = progress.apply()
+
         flash(_('Successfully updated progress for %(count)d books', count=count), 'success')
+        flash_import_report(progress)
             
     except Exception as e:
         flash(_('Error processing file: %(error)s', error=str(e)), 'error')
@@ -99,7 +114,7 @@ def sync_librera_usb():
     ls_out = subprocess.check_output(['adb', 'shell', 'ls', base_path], stderr=subprocess.STDOUT).decode('utf-8')
     profile_folders = [f.strip() for f in ls_out.splitlines() if f.strip().startswith('device.')]
     
-    count = 0
+    progress = ProgressImport()
     found = False
     
     for folder in profile_folders:
@@ -111,13 +126,12 @@ def sync_librera_usb():
             if os.path.getsize(local_path) > 0:
                 with open(local_path, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                    c = process_librera_progress(data)
-                    count += c
+                    process_librera_progress(data, progress)
                     found = True
         except: pass
         finally:
             if os.path.exists(local_path): os.remove(local_path)
-    return count, found
+    return progress.apply(), found
 
 def sync_moon_usb():
     # Moon+ Reader backups are usually in /sdcard/Books/MoonReader/ or user defined.
@@ -154,7 +168,9 @@ def sync_moon_usb():
     try:
         subprocess.check_call(['adb', 'pull', remote_path, local_path], stderr=subprocess.DEVNULL)
         if os.path.getsize(local_path) > 0:
-            count = process_moon_progress(local_path)
+            progress = ProgressImport()
+            process_moon_progress(local_path, progress)
+            count = progress.apply()
             found = True
     except: pass
     finally:
@@ -192,7 +208,9 @@ def sync_readera_usb():
     try:
         subprocess.check_call(['adb', 'pull', remote_path, local_path], stderr=subprocess.DEVNULL)
         if os.path.getsize(local_path) > 0:
-            count = process_readera_progress(local_path)
+            progress = ProgressImport()
+            process_readera_progress(local_path, progress)
+            count = progress.apply()
             found = True
     except: pass
     finally:
@@ -201,197 +219,262 @@ def sync_readera_usb():
     return count, found
 
 
-def process_librera_progress(data, user=None):
-    count = 0
-    from datetime import datetime
+class ProgressImport:
+    """Progress entries of one backup import. Entries are matched against a TitleMatcher built once per import, the
+    progress is written in one transaction by apply()"""
+    def __init__(self, user=None, matcher=None):
+        self.user = user or current_user
+        self.matcher = matcher
+        self.progress = dict()
+        self.matched = []
+        self.unmatched = []
+
+    def add(self, name, percentage, author=None):
+        if not name:
+            return
+        if self.matcher is None:
+            self.matcher = TitleMatcher(calibre_db.session)
+        match = self.matcher.match(name, author)
+        if match is None:
+            self.unmatched.append(name)
+            return
+        self.matched.append((name, match))
+        # a book listed more than once keeps the furthest progress
+        self.progress[match.book_id] = max(percentage, self.progress.get(match.book_id, 0))
+
+    def merge(self, other):
+        """Adds the entries of the import of another backup file"""
+        self.matcher = self.matcher or other.matcher
+        self.matched.extend(other.matched)
+        self.unmatched.extend(other.unmatched)
+        for book_id, percentage in other.progress.items():
+            self.progress[book_id] = max(percentage, self.progress.get(book_id, 0))
+
+    @property
+    def uncertain(self):
+        return [(name, match) for name, match in self.matched if match.confidence < LOW_CONFIDENCE]
+
+    def apply(self):
+        """Writes the progress of the matched books which differs from the stored one, returns the number of books"""
+        if not self.progress or not self.user:
+            return 0
+        book_ids = list(self.progress)
+        existing = dict()
+        for start in range(0, len(book_ids), UPSERT_BATCH):
+            for read_book in ub.session.query(ub.ReadBook).filter(
+                    ub.ReadBook.user_id == self.user.id,
+                    ub.ReadBook.book_id.in_(book_ids[start:start + UPSERT_BATCH])):
+                existing[read_book.book_id] = read_book
+        now = datetime.now(timezone.utc)
+        new_entries = []
+        changed = 0
+        for book_id, percentage in self.progress.items():
+            if percentage >= 99:
+                read_status, percentage = ub.ReadBook.STATUS_FINISHED, 100
+            else:
+                read_status = ub.ReadBook.STATUS_IN_PROGRESS
+            read_book = existing.get(book_id)
+            if read_book and read_book.read_status == read_status and read_book.progress_percent == percentage:
+                continue
+            if not read_book:
+                read_book = ub.ReadBook(user_id=self.user.id, book_id=book_id)
+                new_entries.append(read_book)
+            read_book.read_status = read_status
+            read_book.progress_percent = percentage
+            read_book.last_modified = now
+            changed += 1
+        if not changed:
+            return 0
+        ub.session.add_all(new_entries)
+        try:
+            ub.session.commit()
+        except OperationalError as ex:
+            ub.session.rollback()
+            log.error("Saving mobile progress failed: %s", ex)
+            return 0
+        log.debug("Mobile progress import: %d entries matched (%d uncertain), %d unmatched: %s, %d books changed",
+                  len(self.matched), len(self.uncertain), len(self.unmatched), ", ".join(self.unmatched[:20]),
+                  changed)
+        return changed
+
+
+def process_librera_progress(data, progress):
     for file_path, progress_data in data.items():
         if not isinstance(progress_data, dict): continue
         progress_ratio = progress_data.get('p', 0)
         percentage = int(progress_ratio * 100)
         percentage = max(0, min(100, percentage))
         if percentage == 0: continue
-        
-        filename = os.path.basename(file_path)
-        base_name, _ = os.path.splitext(filename)
-        if update_book_progress(base_name, percentage, user):
-            count += 1
-    ub.session.commit()
-    return count
-
-def process_moon_progress(file_path, user=None):
-    count = 0
-    import zipfile
-    import sqlite3
-    import tempfile
-    import shutil
-    
-    with tempfile.TemporaryDirectory() as tmpdir:
-        try:
-            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                zip_ref.extractall(tmpdir)
-                
-            # Moon+ Reader backups usually contain a .db file
-            db_file = None
-            for root, dirs, files in os.walk(tmpdir):
-                for f in files:
-                    if f.endswith('.db'):
-                        db_file = os.path.join(root, f)
-                        break
-                if db_file: break
-                
-            if db_file:
-                # Some versions use 'items' table, some 'books'
-                conn = sqlite3.connect(db_file)
-                cursor = conn.cursor()
-                
-                # Check for table 'items' (Moon+ Reader Pro standard)
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND (name='items' OR name='books')")
-                table_name = cursor.fetchone()
-                if table_name:
-                    table = table_name[0]
-                    # Columns: originalName (or filename), percentage
-                    cursor.execute(f"PRAGMA table_info({table})")
-                    columns = {col[1] for col in cursor.fetchall()}
-                    
-                    name_col = "originalName" if "originalName" in columns else "filename" if "filename" in columns else "title"
-                    perc_col = "percentage" if "percentage" in columns else "progress"
-                    
-                    if name_col in columns and perc_col in columns:
-                        cursor.execute(f"SELECT {name_col}, {perc_col} FROM {table}")
-                        rows = cursor.fetchall()
-                        for name, percentage in rows:
-                            if percentage and percentage > 0:
-                                # percentage is usually float 0-100 or int
-                                p = int(float(percentage))
-                                if update_book_progress(name, p, user):
-                                    count += 1
-                conn.close()
-        except Exception as e:
-            helper.log.error(f"Error parsing Moon+ Reader backup: {e}")
-            
-    ub.session.commit()
-    return count
+        progress.add(os.path.basename(file_path), percentage)
+
+
+def open_sqlite_member(archive, member):
+    """Opens a sqlite database stored in the zip archive in memory, older Pythons without deserialize get a copy of
+    just this member in a temporary file"""
+    if hasattr(sqlite3.Connection, 'deserialize'):
+        connection = sqlite3.connect(':memory:')
+        connection.deserialize(archive.read(member))
+        return connection, None
+    fd, path = tempfile.mkstemp(suffix='.db')
+    with os.fdopen(fd, 'wb') as db_file, archive.open(member) as source:
+        shutil.copyfileobj(source, db_file)
+    return sqlite3.connect(path), path
+
+
+# The parsers raise on unreadable backups, errors are reported by the callers
+def process_moon_progress(file_path, progress):
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        # Moon+ Reader backups usually contain a .db file
+        db_member = next((name for name in zip_ref.namelist() if name.endswith('.db')), None)
+        if not db_member:
+            return
+        conn, temp_path = open_sqlite_member(zip_ref, db_member)
+    try:
+        # Some versions use 'items' table, some 'books'
+        cursor = conn.cursor()
+
+        # Check for table 'items' (Moon+ Reader Pro standard)
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND (name='items' OR name='books')")
+        table_name = cursor.fetchone()
+        if table_name:
+            table = table_name[0]
+            # Columns: originalName (or filename), percentage
+            cursor.execute(f"PRAGMA table_info({table})")
+            columns = {col[1] for col in cursor.fetchall()}
+
+            name_col = "originalName" if "originalName" in columns else "filename" if "filename" in columns else "title"
+            perc_col = "percentage" if "percentage" in columns else "progress"
+
+            if name_col in columns and perc_col in columns:
+                cursor.execute(f"SELECT {name_col}, {perc_col} FROM {table}")
+                for name, percentage in cursor:
+                    if percentage and percentage > 0:
+                        # percentage is usually float 0-100 or int
+                        progress.add(name, int(float(percentage)))
+    finally:
+        conn.close()
+        if temp_path:
+            os.remove(temp_path)
+
+
+def process_readera_progress(file_path, progress):
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        if 'library.json' not in zip_ref.namelist():
+            return
+        with zip_ref.open('library.json') as f:
+            data = json.load(io.TextIOWrapper(f, encoding='utf-8'))
+    # ReadEra 'books' list
+    for b in data.get('books', []):
+        # title, author, reading_percentage
+        percentage = b.get('reading_percentage', 0)
+        if percentage > 0:
+            progress.add(b.get('title'), int(percentage), b.get('author'))
+
+
+def flash_import_report(progress):
+    if progress.uncertain:
+        flash(_('Uncertain matches: %(books)s', books=", ".join(
+            "{} ({}%)".format(name, int(match.confidence * 100)) for name, match in progress.uncertain[:10])),
+              'warning')
+    if progress.unmatched:
+        flash(_('%(count)d books could not be matched: %(books)s', count=len(progress.unmatched),
+                books=", ".join(progress.unmatched[:10])), 'warning')
+
+
+def file_hash(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as backup_file:
+        for chunk in iter(lambda: backup_file.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def process_backup_file(file_path, progress):
+    name = os.path.basename(file_path)
+    if name == 'app-Progress.json':
+        with open(file_path, 'r', encoding='utf-8') as jf:
+            process_librera_progress(json.load(jf), progress)
+    elif name.endswith('.mrpro'):
+        process_moon_progress(file_path, progress)
+    elif name.endswith('.bak'):
+        process_readera_progress(file_path, progress)
+
+
+def is_backup_file(name):
+    return name == 'app-Progress.json' or name.endswith(('.mrpro', '.bak'))
+
+
+def sync_user_backups(progress):
+    """Reads the new and changed backup files below the sync folder of the user of the import, returns the number of
+    books with changed progress"""
+    user = progress.user
+    ledger = {entry.path: entry for entry in
+              ub.session.query(ub.MobileBackup).filter(ub.MobileBackup.user_id == user.id)}
+    present = set()
+    processed = []
+    for root, __, files in os.walk(user.mobile_sync_path):
+        for f in files:
+            if not is_backup_file(f):
+                continue
+            f_path = os.path.join(root, f)
+            try:
+                file_stat = os.stat(f_path)
+            except OSError:
+                continue
+            present.add(f_path)
+            entry = ledger.get(f_path)
+            if entry and entry.size == file_stat.st_size and entry.mtime == file_stat.st_mtime:
+                continue
+            try:
+                content_hash = file_hash(f_path)
+            except OSError as ex:
+                log.warning("Reading mobile backup %s failed: %s", f_path, ex)
+                continue
+            if entry is not None and entry.content_hash == content_hash:
+                # touched or copied again without changes
+                entry.size, entry.mtime = file_stat.st_size, file_stat.st_mtime
+                continue
+            # entries of a file are only taken if the whole file could be read
+            file_progress = ProgressImport(user, progress.matcher)
+            try:
+                process_backup_file(f_path, file_progress)
+            except Exception as ex:
+                # not recorded in the ledger, the file is read again on the next run
+                log.error("Error parsing mobile backup %s: %s", f_path, ex)
+                progress.matcher = progress.matcher or file_progress.matcher
+                continue
+            progress.merge(file_progress)
+            if entry is None:
+                entry = ub.MobileBackup(user_id=user.id, path=f_path)
+                ub.session.add(entry)
+            entry.size, entry.mtime, entry.content_hash = file_stat.st_size, file_stat.st_mtime, content_hash
+            entry.entries = len(file_progress.matched) + len(file_progress.unmatched)
+            entry.processed_at = datetime.now(timezone.utc)
+            processed.append(f_path)
+    for f_path, entry in ledger.items():
+        if f_path not in present:
+            ub.session.delete(entry)
+    changed = progress.apply()
+    try:
+        ub.session.commit()
+    except OperationalError as ex:
+        ub.session.rollback()
+        log.error("Saving mobile backup ledger failed: %s", ex)
+    if processed:
+        log.debug("Auto-sync: %d of %d backup files of user %s read, %d books changed", len(processed), len(present),
+                  user.name, changed)
+    return changed
+
 
-def process_readera_progress(file_path, user=None):
-    count = 0
-    import zipfile
-    import json
-    import tempfile
-    
-    with tempfile.TemporaryDirectory() as tmpdir:
-        try:
-            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                zip_ref.extractall(tmpdir)
-            
-            json_path = os.path.join(tmpdir, 'library.json')
-            if os.path.exists(json_path):
-                with open(json_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # ReadEra 'books' list
-                    books_data = data.get('books', [])
-                    for b in books_data:
-                        # title, author, reading_percentage
-                        title = b.get('title')
-                        author = b.get('author')
-                        percentage = b.get('reading_percentage', 0)
-                        
-                        search_name = f"{title} - {author}" if author else title
-                        if percentage > 0:
-                            if update_book_progress(search_name, int(percentage), user):
-                                count += 1
-        except Exception as e:
-            helper.log.error(f"Error parsing ReadEra backup: {e}")
-            
-    ub.session.commit()
-    return count
-
-def update_book_progress(search_name, percentage, user=None):
-    # Clean name: remove extensions, underscores, and common Calibre-style segments
-    search_name = search_name.replace('_', ' ').strip()
-    for ext in ['.epub', '.mobi', '.azw3', '.pdf', '.docx', '.html', '.txt']:
-        if search_name.lower().endswith(ext):
-            search_name = search_name[:-len(ext)].strip()
-            
-    # Try extracting Calibre ID from name if it follows "Title (ID)" pattern
-    import re
-    id_match = re.search(r'\((\d+)\)$', search_name)
-    if id_match:
-        book_id = int(id_match.group(1))
-        book = calibre_db.session.query(db.Books).filter(db.Books.id == book_id).first()
-        if book:
-            books = [book]
-            
-    # Try exact match first
-    if not books:
-        books = calibre_db.session.query(db.Books).filter(db.Books.title.ilike(search_name)).all()
-    
-    # Try splitting if it's "Title - Author" format
-    if not books and ' - ' in search_name:
-        parts = search_name.split(' - ')
-        # Try title part
-        books = calibre_db.session.query(db.Books).filter(db.Books.title.ilike(parts[0].strip())).all()
-        # If still no, try matching both Title AND Author for precision
-        if not books and len(parts) > 1:
-            books = calibre_db.session.query(db.Books).join(db.books_authors_link).join(db.Authors).filter(
-                and_(db.Books.title.ilike(parts[0].strip()), db.Authors.name.ilike(f"%{parts[1].strip()}%"))
-            ).all()
-            
-    if books:
-        book = books[0]
-        # Fallback to current_user if no specific user provided (for manual uploads)
-        target_user = user or current_user
-        if not target_user:
-            return False
-
-        current_status = ub.session.query(ub.ReadBook).filter(
-            ub.ReadBook.user_id == target_user.id,
-            ub.ReadBook.book_id == book.id
-        ).first()
-        
-        if not current_status:
-            current_status = ub.ReadBook(user_id=target_user.id, book_id=book.id)
-            ub.session.add(current_status)
-        
-        status = ub.ReadBook.STATUS_IN_PROGRESS
-        if percentage >= 99:
-             status = ub.ReadBook.STATUS_FINISHED
-             percentage = 100
-        
-        current_status.progress_percent = percentage
-        current_status.read_status = status
-        from datetime import datetime
-        current_status.last_modified = datetime.utcnow()
-        return True
-    return False
 def auto_sync_mobile_progress():
-    """Background task to scan user-defined folders for progress files"""
+    """Background task to scan user-defined folders for progress files, only files not read before are processed"""
     users = ub.session.query(ub.User).filter(ub.User.mobile_sync_path != "").all()
+    # the matching index is built once for all users of this run, and only if a backup file has to be read
+    matcher = None
     for user in users:
-        path = user.mobile_sync_path
-        if not os.path.isdir(path):
+        if not os.path.isdir(user.mobile_sync_path):
             continue
-            
-        helper.log.debug(f"Auto-sync: Scanning {path} for user {user.name}")
-        
-        # 1. Librera (app-Progress.json)
-        # Search recursively or in known subpaths
-        for root, dirs, files in os.walk(path):
-            for f in files:
-                f_path = os.path.join(root, f)
-                
-                # Librera
-                if f == 'app-Progress.json':
-                    try:
-                        with open(f_path, 'r', encoding='utf-8') as jf:
-                            process_librera_progress(json.load(jf), user)
-                    except: pass
-                
-                # Moon+ (.mrpro or .po)
-                elif f.endswith('.mrpro'):
-                    process_moon_progress(f_path, user)
-                
-                # ReadEra (.bak)
-                elif f.endswith('.bak'):
-                    process_readera_progress(f_path, user)
-    
-    ub.session.commit()
+        log.debug(f"Auto-sync: Scanning {user.mobile_sync_path} for user {user.name}")
+        progress = ProgressImport(user, matcher)
+        sync_user_backups(progress)
+        matcher = progress.matcher
@@ -21,18 +21,23 @@
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+from functools import wraps
+from itertools import islice
 from urllib.parse import unquote_plus
 
-from flask import Blueprint, request, render_template, make_response, abort, g, jsonify, url_for
+from flask import Blueprint, request, render_template, stream_template, make_response, abort, g, jsonify, url_for
 from flask_babel import get_locale
 from flask_babel import gettext as _
 
 
 from sqlalchemy.sql.expression import func, text, or_, and_, true
 from sqlalchemy.exc import InvalidRequestError, OperationalError
+from sqlalchemy.orm import selectinload
 
-from . import logger, config, db, calibre_db, ub, isoLanguages, constants, helper
-import mimetypes
+from . import logger, config, db, calibre_db, ub, isoLanguages, constants, library_changes
+from .opds_cache import feed_cache
+from .opds_links import link_cache, resolve_client_profile
+from .epub_structure import structure_cache
 from .usermanagement import requires_basic_auth_if_no_ano, auth
 from .helper import get_download_link, get_book_cover
 from .pagination import Pagination
@@ -43,16 +48,136 @@ opds = Blueprint('opds', __name__)
 
 log = logger.create()
 
+# Rows fetched from the database at once while streaming a feed
+STREAM_BATCH_SIZE = 100
+
+
+# Client profile of the reader app, the acquisition links of the feeds depend on it
+def get_opds_client():
+    return resolve_client_profile(request.headers.get('User-Agent', ''))
+
+
+# Everything besides the library content the rendered feed depends on. Read status and progress of the user are
+# part of the book entries, so profiles are not shared between users
+def get_feed_profile(user):
+    return (user.id, user.role, user.sidebar_view, user.filter_language(), user.list_allowed_tags(),
+            user.list_denied_tags(), user.allowed_column_value, user.denied_column_value, str(get_locale()),
+            get_opds_client(), request.host, request.script_root, config.config_books_per_page,
+            config.config_read_column, config.config_restricted_column, config.config_calibre_web_title)
+
+
+def get_feed_marker(user):
+    return library_changes.user_marker(config, calibre_db.session, user.id)
+
+
+def get_download_marker(user):
+    return ub.session.query(func.max(ub.Downloads.id)).scalar()
+
+
+# Serves feeds from the feed cache and answers conditional requests with 304, additional_marker returns
+# state the feed depends on, which is not part of the library change feed
+def cached_feed(additional_marker=None):
+    def decorator(f):
+        @wraps(f)
+        def inner(*args, **kwargs):
+            user = auth.current_user()
+            marker = get_feed_marker(user)
+            if additional_marker:
+                marker += (additional_marker(user),)
+            feed = request.endpoint
+            etag = feed_cache.make_etag(feed, request.full_path, get_feed_profile(user), marker)
+            entry = feed_cache.get(etag)
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = bool(entry and request.if_modified_since
+                                    and request.if_modified_since >= entry[2])
+            if not_modified:
+                feed_cache.count(feed, "not_modified")
+                response = make_response("", 304)
+            elif entry:
+                feed_cache.count(feed, "hit")
+                response = make_response(entry[0])
+                response.headers["Content-Type"] = entry[1]
+            else:
+                feed_cache.count(feed, "miss")
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                # Streamed feeds are not held in memory, they only profit from conditional requests
+                if not response.is_streamed:
+                    entry = feed_cache.set(etag, response.get_data(), response.headers["Content-Type"])
+            response.set_etag(etag)
+            if entry:
+                response.last_modified = entry[2]
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return inner
+    return decorator
+
+
+# Relations of the books shown in feed entries, loaded with one query per relation for all books of a batch
+def get_entry_load_options(cc=None):
+    options = [selectinload(db.Books.authors), selectinload(db.Books.tags), selectinload(db.Books.comments),
+               selectinload(db.Books.series), selectinload(db.Books.ratings),
+               selectinload(db.Books.languages), selectinload(db.Books.publishers),
+               selectinload(db.Books.identifiers)]
+    for c in cc or []:
+        options.append(selectinload(getattr(db.Books, 'custom_column_' + str(c.id))))
+    return options
+
+
+# Book entries of a feed, which are fetched batchwise from the query while the feed is written. The query is only
+# started once the template accesses the entries, as the view has already returned and torn down its database
+# session at this point. The first row is fetched in advance, the feed template checks it before writing the entries.
+# The page counts of the books are looked up per batch, before the entries of the batch are rendered
+class FeedEntries:
+    def __init__(self, query, cc=None):
+        self._query = query.options(*get_entry_load_options(cc)).yield_per(STREAM_BATCH_SIZE)
+        self._rows = None
+        self._first = None
+        self.page_counts = dict()
+
+    def _start(self):
+        if self._rows is None:
+            self._rows = iter(self._query)
+            self._first = next(self._rows, None)
+
+    def __bool__(self):
+        self._start()
+        return self._first is not None
+
+    def __getitem__(self, index):
+        self._start()
+        if index == 0 and self._first is not None:
+            return self._first
+        raise IndexError(index)
+
+    def __iter__(self):
+        self._start()
+        if self._first is None:
+            return
+        batch = [self._first]
+        while batch:
+            prefetch_download_links([row.Books for row in batch])
+            self.page_counts.update(get_page_counts([row.Books for row in batch]))
+            for row in batch:
+                yield calibre_db.order_authors([row], True, True)[0]
+            batch = list(islice(self._rows, STREAM_BATCH_SIZE))
+
 
 @opds.route("/opds/")
 @opds.route("/opds")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_index():
     return render_xml_template('index.xml')
 
 
 @opds.route("/opds/osd")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_osd():
     return render_xml_template('osd.xml', lang='en-EN')
 
@@ -74,12 +199,14 @@ def feed_normal_search():
 
 @opds.route("/opds/books")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_booksindex():
     return render_element_index(db.Books.sort, None, 'opds.feed_letter_books')
 
 
 @opds.route("/opds/books/letter/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_letter_books(book_id):
     off = request.args.get("offset") or 0
     letter = true() if book_id == "00" else func.upper(db.Books.sort).startswith(book_id)
@@ -94,6 +221,7 @@ def feed_letter_books(book_id):
 
 @opds.route("/opds/new")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_new():
     if not auth.current_user().check_visibility(constants.SIDEBAR_RECENT):
         abort(404)
@@ -119,6 +247,7 @@ def feed_discover():
 
 @opds.route("/opds/rated")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_best_rated():
     if not auth.current_user().check_visibility(constants.SIDEBAR_BEST_RATED):
         abort(404)
@@ -133,31 +262,23 @@ def feed_best_rated():
 
 @opds.route("/opds/hot")
 @requires_basic_auth_if_no_ano
+@cached_feed(get_download_marker)
 def feed_hot():
     if not auth.current_user().check_visibility(constants.SIDEBAR_HOT):
         abort(404)
     off = request.args.get("offset") or 0
-    all_books = ub.session.query(ub.Downloads, func.count(ub.Downloads.book_id)).order_by(
-        func.count(ub.Downloads.book_id).desc()).group_by(ub.Downloads.book_id)
-    hot_books = all_books.offset(off).limit(config.config_books_per_page)
-    entries = list()
-    for book in hot_books:
-        query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-        download_book = query.filter(calibre_db.common_filters()).filter(
-            book.Downloads.book_id == db.Books.id).first()
-        if download_book:
-            entries.append(download_book)
-        else:
-            ub.delete_download(book.Downloads.book_id)
-    num_books = entries.__len__()
-    pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1),
-                            config.config_books_per_page, num_books)
+    entries, pagination = calibre_db.fill_indexpage_hot_books((int(off) / (int(config.config_books_per_page)) + 1),
+                                                              config.config_books_per_page,
+                                                              [func.count(ub.Downloads.book_id).desc()],
+                                                              config.config_read_column,
+                                                              offset=off)
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     return render_xml_template('feed.xml', entries=entries, pagination=pagination, cc=cc)
 
 
 @opds.route("/opds/author")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_authorindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_AUTHOR):
         abort(404)
@@ -166,6 +287,7 @@ def feed_authorindex():
 
 @opds.route("/opds/author/letter/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_letter_author(book_id):
     if not auth.current_user().check_visibility(constants.SIDEBAR_AUTHOR):
         abort(404)
@@ -184,12 +306,14 @@ def feed_letter_author(book_id):
 
 @opds.route("/opds/author/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_author(book_id):
     return render_xml_dataset(db.Authors, book_id)
 
 
 @opds.route("/opds/publisher")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_publisherindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_PUBLISHER):
         abort(404)
@@ -208,12 +332,14 @@ def feed_publisherindex():
 
 @opds.route("/opds/publisher/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_publisher(book_id):
     return render_xml_dataset(db.Publishers, book_id)
 
 
 @opds.route("/opds/category")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_categoryindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_CATEGORY):
         abort(404)
@@ -222,6 +348,7 @@ def feed_categoryindex():
 
 @opds.route("/opds/category/letter/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_letter_category(book_id):
     if not auth.current_user().check_visibility(constants.SIDEBAR_CATEGORY):
         abort(404)
@@ -242,12 +369,14 @@ def feed_letter_category(book_id):
 
 @opds.route("/opds/category/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_category(book_id):
     return render_xml_dataset(db.Tags, book_id)
 
 
 @opds.route("/opds/series")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_seriesindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_SERIES):
         abort(404)
@@ -256,6 +385,7 @@ def feed_seriesindex():
 
 @opds.route("/opds/series/letter/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_letter_series(book_id):
     if not auth.current_user().check_visibility(constants.SIDEBAR_SERIES):
         abort(404)
@@ -276,6 +406,7 @@ def feed_letter_series(book_id):
 
 @opds.route("/opds/series/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_series(book_id):
     off = request.args.get("offset") or 0
     entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
@@ -289,6 +420,7 @@ def feed_series(book_id):
 
 @opds.route("/opds/ratings")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_ratingindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_RATING):
         abort(404)
@@ -312,12 +444,14 @@ def feed_ratingindex():
 
 @opds.route("/opds/ratings/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_ratings(book_id):
     return render_xml_dataset(db.Ratings, book_id)
 
 
 @opds.route("/opds/formats")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_formatindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_FORMAT):
         abort(404)
@@ -337,6 +471,7 @@ def feed_formatindex():
 
 @opds.route("/opds/formats/<book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_format(book_id):
     off = request.args.get("offset") or 0
     entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
@@ -351,6 +486,7 @@ def feed_format(book_id):
 @opds.route("/opds/language")
 @opds.route("/opds/language/")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_languagesindex():
     if not auth.current_user().check_visibility(constants.SIDEBAR_LANGUAGE):
         abort(404)
@@ -369,6 +505,7 @@ def feed_languagesindex():
 
 @opds.route("/opds/language/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_languages(book_id):
     off = request.args.get("offset") or 0
     entries, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1), 0,
@@ -382,6 +519,7 @@ def feed_languages(book_id):
 
 @opds.route("/opds/shelfindex")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_shelfindex():
     if not (auth.current_user().is_authenticated or g.allow_anonymous):
         abort(404)
@@ -397,6 +535,7 @@ def feed_shelfindex():
 
 @opds.route("/opds/shelf/<int:book_id>")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_shelf(book_id):
     if not (auth.current_user().is_authenticated or g.allow_anonymous):
         abort(404)
@@ -411,15 +550,16 @@ def feed_shelf(book_id):
                                                            ub.Shelf.id == book_id))).first()
     result = list()
     pagination = list()
+    cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
     # user is allowed to access shelf
     if shelf:
-        result, __, pagination = calibre_db.fill_indexpage((int(off) / (int(config.config_books_per_page)) + 1),
-                                                           config.config_books_per_page,
-                                                           db.Books,
-                                                           ub.BookShelf.shelf == shelf.id,
-                                                           [ub.BookShelf.order.asc()],
-                                                           True, config.config_read_column,
-                                                           ub.BookShelf, ub.BookShelf.book_id == db.Books.id)
+        query = calibre_db.generate_indexpage_query(db.Books, ub.BookShelf.shelf == shelf.id, False, True,
+                                                    config.config_read_column,
+                                                    ub.BookShelf, ub.BookShelf.book_id == db.Books.id)
+        pagination = Pagination((int(off) / (int(config.config_books_per_page)) + 1), config.config_books_per_page,
+                                query.count())
+        result = FeedEntries(query.order_by(ub.BookShelf.order.asc())
+                             .offset(int(off)).limit(config.config_books_per_page), cc)
         # delete shelf entries where book is not existent anymore, can happen if book is deleted outside calibre-web
         wrong_entries = calibre_db.session.query(ub.BookShelf) \
             .join(db.Books, ub.BookShelf.book_id == db.Books.id, isouter=True) \
@@ -432,8 +572,18 @@ def feed_shelf(book_id):
             except (OperationalError, InvalidRequestError) as e:
                 ub.session.rollback()
                 log.error_or_exception("Settings Database error: {}".format(e))
+    return render_xml_template('feed.xml', entries=result, pagination=pagination, cc=cc, stream=True)
+
+
+# Unpaginated feed of all visible books for clients mirroring the catalog, it's written while the books are read
+@opds.route("/opds/catalog")
+@requires_basic_auth_if_no_ano
+@cached_feed()
+def feed_catalog():
     cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
-    return render_xml_template('feed.xml', entries=result, pagination=pagination, cc=cc)
+    query = calibre_db.generate_indexpage_query(db.Books, true(), False, True, config.config_read_column)
+    return render_xml_template('feed.xml', entries=FeedEntries(query.order_by(db.Books.id), cc), cc=cc,
+                               stream=True)
 
 
 @opds.route("/opds/download/<book_id>/<book_format>", defaults={'anyname': None})
@@ -544,6 +694,14 @@ def get_database_stats():
     return make_response(jsonify(stat))
 
 
+@opds.route("/opds/cachestats")
+@requires_basic_auth_if_no_ano
+def get_feed_cache_stats():
+    if not auth.current_user().role_admin():
+        abort(403)
+    return make_response(jsonify(feed_cache.get_stats()))
+
+
 @opds.route("/opds/thumb_240_240/<book_id>")
 @opds.route("/opds/cover_240_240/<book_id>")
 @opds.route("/opds/cover_90_90/<book_id>")
@@ -555,6 +713,7 @@ def feed_get_cover(book_id):
 
 @opds.route("/opds/readbooks")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_read_books():
     if not (auth.current_user().check_visibility(constants.SIDEBAR_READ_AND_UNREAD) and not auth.current_user().is_anonymous):
         return abort(403)
@@ -566,6 +725,7 @@ def feed_read_books():
 
 @opds.route("/opds/unreadbooks")
 @requires_basic_auth_if_no_ano
+@cached_feed()
 def feed_unread_books():
     if not (auth.current_user().check_visibility(constants.SIDEBAR_READ_AND_UNREAD) and not auth.current_user().is_anonymous):
         return abort(403)
@@ -600,80 +760,37 @@ def feed_search(term):
         return render_xml_template('feed.xml', searchterm="")
 
 
+# Acquisition links of a book for the requesting reader app
+def get_opds_download_link(book):
+    return link_cache.lookup([book], get_opds_client()).get(book.id, [])
+
+
+# Builds the missing acquisition links of a list of books with one query, instead of one per rendered entry
+def prefetch_download_links(books):
+    if books:
+        link_cache.lookup(books, get_opds_client())
+
+
+# Page counts of the books from the stored epub structure only, rendering a feed never opens a book file
+def get_page_counts(books):
+    return {book_id: structure.page_count for book_id, structure in structure_cache.lookup(books).items()
+            if structure.page_count}
 
-def render_xml_template(*args, **kwargs):
-    def get_opds_download_link(book):
-        from flask import url_for
-        try:
-            ua = request.headers.get('User-Agent', '').lower()
-            client = 'generic'
-            if 'kindle' in ua or 'amazon' in ua: client = 'kindle'
-            elif 'kobo' in ua: client = 'kobo'
-            elif 'librera' in ua: client = 'librera'
-            elif 'moonreader' in ua or 'moon+' in ua: client = 'moonreader'
-            
-            supported = helper.CLIENT_FORMATS.get(client, helper.CLIENT_FORMATS['generic'])
-            links = []
-            
-            # Filter existing formats against blacklist
-            existing_formats = {f.format.upper(): f for f in book.data if f.format.upper() not in helper.BLACKLIST_FORMATS}
-            
-            # 1. Direct matches from 'supported' list in priority order
-            found_direct = False
-            for fmt in supported:
-                if fmt in existing_formats:
-                    f = existing_formats[fmt]
-                    links.append({
-                        'rel': 'http://opds-spec.org/acquisition',
-                        'href': url_for('opds.opds_download_link', book_id=book.id, book_format=f.format.lower()),
-                        'type': mimetypes.types_map.get('.'+f.format.lower(), 'application/octet-stream'),
-                        'title': fmt,
-                        'length': f.uncompressed_size,
-                        'mtime': book.atom_timestamp
-                    })
-                    found_direct = True
-                    break 
-            # 2. Conversion options: If no direct match but we have EPUB
-            if not found_direct:
-                epub_f = next((f for f in book.data if f.format.upper() == 'EPUB'), None)
-                if epub_f:
-                    target_fmt = None
-                    if client == 'kindle':
-                        target_fmt = 'AZW3'
-                    elif client == 'kobo':
-                        target_fmt = 'KEPUB'
-                    
-                    if target_fmt:
-                        links.append({
-                            'rel': 'http://opds-spec.org/acquisition',
-                            'href': url_for('opds.opds_download_link', book_id=book.id, book_format=target_fmt.lower()),
-                            'type': mimetypes.types_map.get('.'+target_fmt.lower(), 'application/octet-stream'),
-                            'title': target_fmt + ' (Convert)',
-                            'length': epub_f.uncompressed_size,
-                            'mtime': book.atom_timestamp
-                        })
-
-            # 3. Last resort: show any non-blacklisted format
-            if not links:
-                for fmt, f in existing_formats.items():
-                    links.append({
-                        'rel': 'http://opds-spec.org/acquisition',
-                        'href': url_for('opds.opds_download_link', book_id=book.id, book_format=f.format.lower()),
-                        'type': mimetypes.types_map.get('.'+f.format.lower(), 'application/octet-stream'),
-                        'title': fmt,
-                        'length': f.uncompressed_size,
-                        'mtime': book.atom_timestamp
-                    })
-            
-            return links
-        except Exception as e:
-            log.error("Error generating OPDS links for book %s: %s", book.id, e)
-            return []
 
+def render_xml_template(*args, stream=False, **kwargs):
     currtime = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S+00:00")
-    xml = render_template(current_time=currtime, instance=config.config_calibre_web_title, 
-                          constants=constants.sidebar_settings, get_opds_download_link=get_opds_download_link,
-                          *args, **kwargs)
+    # Streamed templates send the feed header right away and the entries while they are rendered
+    render = stream_template if stream else render_template
+    page_counts = dict()
+    if isinstance(kwargs.get('entries'), list):
+        prefetch_download_links([entry.Books for entry in kwargs['entries']])
+        page_counts = get_page_counts([entry.Books for entry in kwargs['entries']])
+    elif isinstance(kwargs.get('entries'), FeedEntries):
+        # filled batchwise while the entries are rendered
+        page_counts = kwargs['entries'].page_counts
+    xml = render(current_time=currtime, instance=config.config_calibre_web_title,
+                 constants=constants.sidebar_settings, get_opds_download_link=get_opds_download_link,
+                 page_counts=page_counts, *args, **kwargs)
     response = make_response(xml)
     response.headers["Content-Type"] = "application/atom+xml; charset=utf-8"
     return response
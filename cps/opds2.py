@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+
+# OPDS 2.0 (JSON) catalog. Feeds are built from the same queries as the OPDS 1.x Atom feeds in opds.py, book lists
+# are paginated with cursors (the sort value and id of the last book on the page), so no count queries are needed
+# and following "next" links stays cheap on large libraries.
+
+import base64
+import binascii
+import json
+
+from flask import Blueprint, request, make_response, abort, url_for
+from flask_babel import gettext as _
+from sqlalchemy import String
+from sqlalchemy.sql.expression import func, and_, or_, true, type_coerce
+
+from . import logger, config, db, calibre_db, ub, constants
+from .usermanagement import requires_basic_auth_if_no_ano, auth
+from .opds import (cached_feed, get_opds_download_link, prefetch_download_links, get_entry_load_options,
+                   get_download_marker)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+opds2 = Blueprint('opds2', __name__)
+
+log = logger.create()
+
+OPDS2_TYPE = "application/opds+json"
+
+
+def dump_json(data):
+    if orjson:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def render_json_feed(data):
+    response = make_response(dump_json(data))
+    response.headers["Content-Type"] = OPDS2_TYPE + "; charset=utf-8"
+    return response
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def decode_cursor(*checks):
+    """Returns the values of the cursor of the request, None without cursor. A cursor which can't be decoded or whose
+    values don't pass the checks (one per value) is answered with 400"""
+    cursor = request.args.get("cursor")
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (ValueError, TypeError, binascii.Error):
+        abort(400)
+    if not isinstance(values, list) or len(values) != len(checks) \
+            or not all(check(value) for check, value in zip(checks, values)):
+        abort(400)
+    return values
+
+
+# Sort values are compared as stored, text or numbers, NULL for books without a value
+def is_sort_value(value):
+    return value is None or isinstance(value, (str, float)) or is_int(value)
+
+
+def is_offset(value):
+    return is_int(value) and value >= 0
+
+
+def page_size():
+    return int(config.config_books_per_page)
+
+
+# Keyset pagination: the rows following the cursor are selected by sort value and id, the sort value is compared
+# as stored in the database (timestamps are text in metadata.db)
+def paginate_keyset(query, sort_column, id_column, descending=False):
+    raw_value = type_coerce(sort_column, String)
+    cursor = decode_cursor(is_sort_value, is_int)
+    if cursor:
+        value, last_id = cursor
+        if descending:
+            query = query.filter(or_(raw_value < value, and_(raw_value == value, id_column < last_id)))
+        else:
+            query = query.filter(or_(raw_value > value, and_(raw_value == value, id_column > last_id)))
+    if descending:
+        query = query.order_by(sort_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(sort_column.asc(), id_column.asc())
+    rows = query.add_columns(raw_value.label("cursor_value")).limit(page_size() + 1).all()
+    next_cursor = None
+    if len(rows) > page_size():
+        rows = rows[:page_size()]
+        next_cursor = encode_cursor([rows[-1].cursor_value, getattr(rows[-1][0], id_column.key)])
+    return [row[0] for row in rows], next_cursor
+
+
+# Offset pagination for rankings, which can't be continued by a sort value (hot books, search results)
+def paginate_offset(query):
+    cursor = decode_cursor(is_offset)
+    offset = cursor[0] if cursor else 0
+    rows = query.offset(offset).limit(page_size() + 1).all()
+    next_cursor = None
+    if len(rows) > page_size():
+        rows = rows[:page_size()]
+        next_cursor = encode_cursor([offset + page_size()])
+    return rows, next_cursor
+
+
+def feed_links(next_cursor=None):
+    links = [{"rel": "self", "href": request.full_path.rstrip("?"), "type": OPDS2_TYPE},
+             {"rel": "start", "href": url_for("opds2.feed_index"), "type": OPDS2_TYPE},
+             {"rel": "search", "href": url_for("opds2.feed_search") + "{?query}", "type": OPDS2_TYPE,
+              "templated": True}]
+    if next_cursor:
+        args = dict(request.args.to_dict(), **request.view_args)
+        args["cursor"] = next_cursor
+        links.append({"rel": "next", "href": url_for(request.endpoint, **args), "type": OPDS2_TYPE})
+    return links
+
+
+def get_publication(book):
+    metadata = {
+        "@type": "http://schema.org/Book",
+        "identifier": "urn:uuid:{}".format(book.uuid),
+        "title": book.title,
+        "sortAs": book.sort,
+        "modified": book.last_modified.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "author": [{"name": author.name,
+                    "links": [{"href": url_for("opds2.feed_author", book_id=author.id), "type": OPDS2_TYPE}]}
+                   for author in getattr(book, "ordered_authors", book.authors)],
+        "language": [language.lang_code for language in book.languages],
+    }
+    if book.pubdate and book.pubdate > db.Books.DEFAULT_PUBDATE:
+        metadata["published"] = book.pubdate.strftime("%Y-%m-%d")
+    if book.publishers:
+        metadata["publisher"] = [{"name": publisher.name} for publisher in book.publishers]
+    if book.tags:
+        metadata["subject"] = [{"name": tag.name,
+                                "links": [{"href": url_for("opds2.feed_category", book_id=tag.id),
+                                           "type": OPDS2_TYPE}]}
+                               for tag in book.tags]
+    if book.series:
+        metadata["belongsTo"] = {"series": [{"name": serie.name, "position": float(book.series_index),
+                                             "links": [{"href": url_for("opds2.feed_series", book_id=serie.id),
+                                                        "type": OPDS2_TYPE}]}
+                                            for serie in book.series]}
+    if book.comments and book.comments[0].text:
+        metadata["description"] = book.comments[0].text
+    publication = {
+        "metadata": metadata,
+        "links": [{"rel": link["rel"], "href": link["href"], "type": link["type"], "title": link["title"]}
+                  for link in get_opds_download_link(book)],
+    }
+    if book.has_cover:
+        cover = url_for("opds.feed_get_cover", book_id=book.id)
+        publication["images"] = [{"href": cover, "type": "image/jpeg"}]
+    return publication
+
+
+def render_publications(title, books, next_cursor, facets=None):
+    prefetch_download_links(books)
+    feed = {
+        "metadata": {"title": title, "itemsPerPage": page_size()},
+        "links": feed_links(next_cursor),
+        "publications": [get_publication(book) for book in calibre_db.order_authors(books, True)],
+    }
+    if facets:
+        feed["facets"] = facets
+    return render_json_feed(feed)
+
+
+def render_navigation(title, navigation, next_cursor=None):
+    return render_json_feed({
+        "metadata": {"title": title},
+        "links": feed_links(next_cursor),
+        "navigation": navigation,
+    })
+
+
+def book_query(db_filter=true()):
+    return (calibre_db.generate_indexpage_query(db.Books, db_filter, False, False, 0)
+            .options(*get_entry_load_options()))
+
+
+def render_dataset(data_table, book_id):
+    element = calibre_db.session.query(data_table).filter(data_table.id == book_id).first()
+    if not element:
+        abort(404)
+    books, next_cursor = paginate_keyset(
+        book_query(getattr(db.Books, data_table.__tablename__).any(data_table.id == book_id)),
+        db.Books.timestamp, db.Books.id, descending=True)
+    return render_publications(element.name, books, next_cursor)
+
+
+def render_element_list(title, table, link_table, name_column, endpoint):
+    query = (calibre_db.session.query(table)
+             .join(link_table)
+             .join(db.Books)
+             .filter(calibre_db.common_filters())
+             .group_by(table.id))
+    elements, next_cursor = paginate_keyset(query, name_column, table.id)
+    navigation = [{"href": url_for(endpoint, book_id=element.id), "title": element.name, "type": OPDS2_TYPE,
+                   "rel": "subsection"} for element in elements]
+    return render_navigation(title, navigation, next_cursor)
+
+
+def check_visibility(sidebar_value):
+    if not auth.current_user().check_visibility(sidebar_value):
+        abort(404)
+
+
+@opds2.route("/opds2")
+@opds2.route("/opds2/")
+@requires_basic_auth_if_no_ano
+@cached_feed()
+def feed_index():
+    user = auth.current_user()
+    entries = [
+        (constants.SIDEBAR_RECENT, "opds2.feed_new", _('Recently added Books')),
+        (constants.SIDEBAR_HOT, "opds2.feed_hot", _('Hot Books')),
+        (constants.SIDEBAR_BEST_RATED, "opds2.feed_best_rated", _('Top Rated Books')),
+        (constants.SIDEBAR_AUTHOR, "opds2.feed_authorindex", _('Authors')),
+        (constants.SIDEBAR_SERIES, "opds2.feed_seriesindex", _('Series')),
+        (constants.SIDEBAR_CATEGORY, "opds2.feed_categoryindex", _('Categories')),
+    ]
+    navigation = [{"href": url_for("opds2.feed_publications"), "title": _('Books'), "type": OPDS2_TYPE,
+                   "rel": "subsection"}]
+    navigation.extend({"href": url_for(endpoint), "title": title, "type": OPDS2_TYPE, "rel": "subsection"}
+                      for sidebar_value, endpoint, title in entries if user.check_visibility(sidebar_value))
+    return render_navigation(config.config_calibre_web_title, navigation)
+
+
+# All books, the facets select the order and restrict the list to a format or language
+@opds2.route("/opds2/publications")
+@requires_basic_auth_if_no_ano
+@cached_feed()
+def feed_publications():
+    sort = request.args.get("sort", "new")
+    book_format = request.args.get("format", "").upper()
+    language = request.args.get("language", "")
+    db_filter = true()
+    if book_format:
+        db_filter = and_(db_filter, db.Books.data.any(db.Data.format == book_format))
+    if language:
+        db_filter = and_(db_filter, db.Books.languages.any(db.Languages.lang_code == language))
+    if sort == "title":
+        books, next_cursor = paginate_keyset(book_query(db_filter), db.Books.sort, db.Books.id)
+    else:
+        books, next_cursor = paginate_keyset(book_query(db_filter), db.Books.timestamp, db.Books.id,
+                                             descending=True)
+
+    def facet_link(title, active, **args):
+        params = dict(sort=sort, format=book_format, language=language)
+        params.update(args)
+        link = {"href": url_for("opds2.feed_publications", **{k: v for k, v in params.items() if v}),
+                "title": title, "type": OPDS2_TYPE}
+        if active:
+            link["rel"] = "self"
+        return link
+
+    formats = (calibre_db.session.query(db.Data.format)
+               .join(db.Books)
+               .filter(calibre_db.common_filters())
+               .group_by(db.Data.format)
+               .order_by(db.Data.format).all())
+    facets = [
+        {"metadata": {"title": _('Sort')},
+         "links": [facet_link(_('Recently added Books'), sort != "title", sort="new"),
+                   facet_link(_('Title'), sort == "title", sort="title")]},
+        {"metadata": {"title": _('File formats')},
+         "links": [facet_link(_('All'), not book_format, format="")] +
+                  [facet_link(entry.format, entry.format == book_format, format=entry.format)
+                   for entry in formats]},
+        {"metadata": {"title": _('Languages')},
+         "links": [facet_link(_('All'), not language, language="")] +
+                  [facet_link(lang.name, lang.lang_code == language, language=lang.lang_code)
+                   for lang in calibre_db.speaking_language()]},
+    ]
+    return render_publications(_('Books'), books, next_cursor, facets)
+
+
+@opds2.route("/opds2/new")
+@requires_basic_auth_if_no_ano
+@cached_feed()
+def feed_new():
+    check_visibility(constants.SIDEBAR_RECENT)
+    books, next_cursor = paginate_keyset(book_query(), db.Books.timestamp, db.Books.id, descending=True)
+    return render_publications(_('Recently added Books'), books, next_cursor)
+
+
+@opds2.route("/opds2/rated")
+@requires_basic_auth_if_no_ano
+@cached_feed()
+def feed_best_rated():
+    check_visibility(constants.SIDEBAR_BEST_RATED)
+    books, next_cursor = paginate_keyset(book_query(db.Books.ratings.any(db.Ratings.rating > 9)),
+                                         db.Books.timestamp, db.Books.id, descending=True)
+    return render_publications(_('Top Rated Books'), books, next_cursor)
+
+
+@opds2.route("/opds2/hot")
+@requires_basic_auth_if_no_ano
+@cached_feed(get_download_marker)
+def feed_hot():
+    check_visibility(constants.SIDEBAR_HOT)
+    query = (book_query()
+             .join(ub.Downloads, ub.Downloads.book_id == db.Books.id)
+             .group_by(db.Books.id)
+             .order_by(func.count(ub.Downloads.book_id).desc(), db.Books.id))
+    books, next_cursor = paginate_offset(query)
+    return render_publications(_('Hot Books'), books, next_cursor)
+
+
+@opds2.route("/opds2/search")
+@requires_basic_auth_if_no_ano
+def feed_search():
+    term = request.args.get("query", "").strip()
+    if not term:
+        return render_publications(_('Search'), [], None)
+    query = (calibre_db.search_query(term, config)
+             .options(*get_entry_load_options())
+             .order_by(db.Books.sort, db.Books.id))
+    rows, next_cursor = paginate_offset(query)
+    return render_publications(_('Search'), [row[0] for row in rows], next_cursor)
+
+
+@opds2.route("/opds2/author")
+@requires_basic_auth_if_no_ano
+@cached_feed()
+def feed_authorindex():
+    check_visibility(constants.SIDEBAR_AUTHOR)
+    return render_element_list(_('Authors'), db.Authors, db.books_authors_link, db.Authors.sort,
+                               "opds2.feed_author")
+
+
+@opds2.route("/opds2/author/<int:book_id>")
+@requires_basic_auth_if_no_ano
+@cached_feed()
+def feed_author(book_id):
+    return render_dataset(db.Authors, book_id)
+
+
+@opds2.route("/opds2/series")
+@requires_basic_auth_if_no_ano
+@cached_feed()
+def feed_seriesindex():
+    check_visibility(constants.SIDEBAR_SERIES)
+    return render_element_list(_('Series'), db.Series, db.books_series_link, db.Series.sort, "opds2.feed_series")
+
+
+@opds2.route("/opds2/series/<int:book_id>")
+@requires_basic_auth_if_no_ano
+@cached_feed()
+def feed_series(book_id):
+    serie = calibre_db.session.query(db.Series).filter(db.Series.id == book_id).first()
+    if not serie:
+        abort(404)
+    books, next_cursor = paginate_keyset(book_query(db.Books.series.any(db.Series.id == book_id)),
+                                         db.Books.series_index, db.Books.id)
+    return render_publications(serie.name, books, next_cursor)
+
+
+@opds2.route("/opds2/category")
+@requires_basic_auth_if_no_ano
+@cached_feed()
+def feed_categoryindex():
+    check_visibility(constants.SIDEBAR_CATEGORY)
+    return render_element_list(_('Categories'), db.Tags, db.books_tags_link, db.Tags.name, "opds2.feed_category")
+
+
+@opds2.route("/opds2/category/<int:book_id>")
+@requires_basic_auth_if_no_ano
+@cached_feed()
+def feed_category(book_id):
+    return render_dataset(db.Tags, book_id)
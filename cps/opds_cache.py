@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Cache for rendered OPDS feeds. Entries are stored per feed page and user profile together with the library change
+# marker they were rendered for, the ETag is derived from the same values, so readers polling the catalog get a
+# 304 answer without touching the database for the feed content. The least recently used entries are dropped once the
+# stored feeds exceed MAX_SIZE bytes. Hit/miss counters are kept per feed.
+
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from threading import Lock
+
+MAX_SIZE = 32 * 1024 * 1024
+
+
+class OpdsFeedCache:
+    def __init__(self, max_size=MAX_SIZE):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._stats = dict()
+        self._size = 0
+        self.max_size = max_size
+
+    @staticmethod
+    def make_etag(feed, path, profile, marker):
+        return hashlib.sha1(repr((feed, path, profile, marker)).encode("utf-8")).hexdigest()
+
+    def get(self, etag):
+        with self._lock:
+            entry = self._entries.get(etag)
+            if entry:
+                self._entries.move_to_end(etag)
+            return entry
+
+    def set(self, etag, data, content_type):
+        # Last-Modified has only second resolution
+        entry = (data, content_type, datetime.now(timezone.utc).replace(microsecond=0))
+        if len(data) > self.max_size:
+            return entry
+        with self._lock:
+            previous = self._entries.pop(etag, None)
+            if previous:
+                self._size -= len(previous[0])
+            self._entries[etag] = entry
+            self._size += len(data)
+            while self._size > self.max_size:
+                __, dropped = self._entries.popitem(last=False)
+                self._size -= len(dropped[0])
+        return entry
+
+    def count(self, feed, result):
+        # result is one of "hit", "miss" or "not_modified"
+        with self._lock:
+            feed_stats = self._stats.setdefault(feed, {"hit": 0, "miss": 0, "not_modified": 0})
+            feed_stats[result] += 1
+
+    def get_stats(self):
+        with self._lock:
+            feeds = {feed: dict(values) for feed, values in self._stats.items()}
+            return {"entries": len(self._entries),
+                    "size": self._size,
+                    "max_size": self.max_size,
+                    "feeds": feeds,
+                    "hit": sum(values["hit"] for values in feeds.values()),
+                    "miss": sum(values["miss"] for values in feeds.values()),
+                    "not_modified": sum(values["not_modified"] for values in feeds.values())}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+feed_cache = OpdsFeedCache()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# Acquisition links of the OPDS feeds. The user agent of the reader app is resolved once to a client profile, the
+# links of a book are built once per profile and kept in memory afterwards, so rendering a feed entry is a lookup.
+# Entries are valid for the last_modified timestamp of the book. Adding, converting or deleting formats doesn't touch
+# last_modified, so changes of the data table drop the entries of the book.
+
+import mimetypes
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+
+from flask import url_for, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from . import logger, db, calibre_db, helper
+
+log = logger.create()
+
+MAX_ENTRIES = 20000
+DEFAULT_PROFILE = "generic"
+ACQUISITION_REL = "http://opds-spec.org/acquisition"
+
+# Client profiles in detection order: profile id, lowercase user agent parts, format offered for conversion if the
+# book has an epub but none of the formats of the profile. Supported formats are taken from helper.CLIENT_FORMATS
+CLIENT_PROFILES = [
+    ("kindle", ("kindle", "amazon"), "AZW3"),
+    ("kobo", ("kobo",), "KEPUB"),
+    ("librera", ("librera",), None),
+    ("moonreader", ("moonreader", "moon+"), None),
+]
+
+
+@lru_cache(maxsize=512)
+def resolve_client_profile(user_agent):
+    user_agent = (user_agent or "").lower()
+    for profile, markers, __ in CLIENT_PROFILES:
+        if any(marker in user_agent for marker in markers):
+            return profile
+    return DEFAULT_PROFILE
+
+
+def get_convert_format(profile):
+    return next((convert for name, __, convert in CLIENT_PROFILES if name == profile), None)
+
+
+def _format_link(book, book_format, title, length):
+    return {
+        'rel': ACQUISITION_REL,
+        'href': url_for('opds.opds_download_link', book_id=book.id, book_format=book_format.lower()),
+        'type': mimetypes.types_map.get('.' + book_format.lower(), 'application/octet-stream'),
+        'title': title,
+        'length': length,
+        'mtime': book.atom_timestamp
+    }
+
+
+def build_links(book, formats, profile):
+    """Builds the acquisition links for the given list of data entries of the book"""
+    supported = helper.CLIENT_FORMATS.get(profile, helper.CLIENT_FORMATS[DEFAULT_PROFILE])
+    existing_formats = {f.format.upper(): f for f in formats if f.format.upper() not in helper.BLACKLIST_FORMATS}
+    # Direct match in priority order of the profile
+    for fmt in supported:
+        if fmt in existing_formats:
+            f = existing_formats[fmt]
+            return [_format_link(book, f.format, fmt, f.uncompressed_size)]
+    # Conversion from epub
+    convert_format = get_convert_format(profile)
+    epub_f = next((f for f in formats if f.format.upper() == 'EPUB'), None)
+    if convert_format and epub_f:
+        return [_format_link(book, convert_format, convert_format + ' (Convert)', epub_f.uncompressed_size)]
+    # Last resort: any format which is not blacklisted
+    return [_format_link(book, f.format, fmt, f.uncompressed_size) for fmt, f in existing_formats.items()]
+
+
+class AcquisitionLinkCache:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        # book id -> keys of its entries, so a book is invalidated without scanning all entries
+        self._book_keys = dict()
+        self.max_entries = max_entries
+
+    def _drop(self, key):
+        # lock is held by the caller
+        del self._entries[key]
+        keys = self._book_keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._book_keys[key[0]]
+
+    def _get(self, key, stamp):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == stamp:
+                self._entries.move_to_end(key)
+                return entry[1]
+        return None
+
+    def _set(self, key, stamp, links):
+        with self._lock:
+            self._entries[key] = (stamp, links)
+            self._entries.move_to_end(key)
+            self._book_keys.setdefault(key[0], set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def lookup(self, books, profile):
+        """Returns dict book_id -> acquisition links, the formats of books without valid entry are loaded with one
+        query"""
+        script_root = request.script_root
+        found = dict()
+        missing = dict()
+        for book in books:
+            links = self._get((book.id, profile, script_root), book.last_modified)
+            if links is not None:
+                found[book.id] = links
+            else:
+                missing[book.id] = book
+        if missing:
+            formats = dict()
+            try:
+                for data in calibre_db.session.query(db.Data).filter(db.Data.book.in_(list(missing))):
+                    formats.setdefault(data.book, []).append(data)
+            except Exception as ex:
+                log.error("Error loading formats for OPDS links: %s", ex)
+                return found
+            for book_id, book in missing.items():
+                links = build_links(book, formats.get(book_id, []), profile)
+                self._set((book_id, profile, script_root), book.last_modified, links)
+                found[book_id] = links
+        return found
+
+    def invalidate(self, book_id):
+        with self._lock:
+            for key in list(self._book_keys.get(book_id, ())):
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._book_keys.clear()
+
+
+link_cache = AcquisitionLinkCache()
+
+
+# Entries are dropped on flush and again after the commit, so a feed rendered in between can't keep the old formats
+def _data_changed(mapper, connection, target):
+    book_id = target.book.id if isinstance(target.book, db.Books) else target.book
+    link_cache.invalidate(book_id)
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("opds_link_changes", set()).add(book_id)
+
+
+def _after_commit(session):
+    for book_id in session.info.pop("opds_link_changes", ()):
+        link_cache.invalidate(book_id)
+
+
+for _mapper_event in ("after_insert", "after_update", "after_delete"):
+    event.listen(db.Data, _mapper_event, _data_changed)
+event.listen(Session, "after_commit", _after_commit)
@@ -20,11 +20,14 @@ import datetime
 
 from . import config, constants
 from .services.background_scheduler import BackgroundScheduler, CronTrigger, use_APScheduler
-from .tasks.database import TaskReconnectDatabase, TaskDatabaseHealthCheck
-from .tasks.clean import TaskClean
-from .tasks.thumbnail import TaskGenerateCoverThumbnails, TaskGenerateSeriesThumbnails, TaskClearCoverThumbnailCache
+from .tasks.database import TaskReconnectDatabase, TaskDatabaseHealthCheck, TaskBuildSearchIndex, \
+    TaskBuildDocumentIndex, TaskBuildEpubStructure
+from .tasks.clean import TaskClean, TaskCleanDownloads
+from .tasks.thumbnail import TaskGenerateCoverThumbnails, TaskGenerateSeriesThumbnails, TaskClearCoverThumbnailCache, \
+    TaskGenerateAuthorThumbnails
 from .services.worker import WorkerThread
 from .tasks.metadata_backup import TaskBackupMetadata
+from .tasks.content_index import TaskUpdateContentIndex
 from cps.tasks.author import TaskRefreshAuthorDashboard, TaskEnrichAuthors
 from .tasks.watched_folder import TaskWatchedFolder
 from .tasks.mobile_sync import TaskMobileSync
@@ -39,10 +42,17 @@ def get_scheduled_tasks(reconnect=True):
     # Delete temp folder
     tasks.append([lambda: TaskClean(), 'delete temp', True])
 
+    # Delete download entries of books removed from the library
+    tasks.append([lambda: TaskCleanDownloads(), 'delete stale downloads', True])
+
     # Generate metadata.opf file for each changed book
     if config.schedule_metadata_backup:
         tasks.append([lambda: TaskBackupMetadata("en"), 'backup metadata', False])
 
+    # Extract the text of new and changed books for the full-text index
+    if config.schedule_content_index:
+        tasks.append([lambda: TaskUpdateContentIndex(), 'update content index', False])
+
     # Generate all missing book cover thumbnails
     if config.schedule_generate_book_covers:
         tasks.append([lambda: TaskClearCoverThumbnailCache(0), 'delete superfluous book covers', True])
@@ -65,6 +75,8 @@ def get_scheduled_tasks(reconnect=True):
     # Enrich Author Metadata (Background Fetch)
     if config.config_author_enrichment:
         tasks.append([lambda: TaskEnrichAuthors(), 'enrich author metadata', False])
+        # Download new and changed author images, delete the ones of removed authors
+        tasks.append([lambda: TaskGenerateAuthorThumbnails(), 'generate author thumbnails', False])
         from . import logger
         log = logger.create()
         log.info("Author Enrichment task ENABLED - checks Wikipedia every 7 days, updates only on content change")
@@ -120,6 +132,9 @@ def register_startup_tasks():
             scheduler.schedule_tasks_immediately(tasks=get_scheduled_tasks(False))
         else:
             scheduler.schedule_tasks_immediately(tasks=[[lambda: TaskClean(), 'delete temp', True]])
+        scheduler.schedule_tasks_immediately(tasks=[[lambda: TaskBuildSearchIndex(), 'build search index', True]])
+        scheduler.schedule_tasks_immediately(tasks=[[lambda: TaskBuildDocumentIndex(), 'build document index', True]])
+        scheduler.schedule_tasks_immediately(tasks=[[lambda: TaskBuildEpubStructure(), 'read epub structure', True]])
 
 
 def should_task_be_running(start, duration):
@@ -17,12 +17,13 @@
 import json
 from datetime import datetime
 
-from flask import Blueprint, request, redirect, url_for, flash
+from flask import Blueprint, request, redirect, url_for, flash, abort, jsonify
 from flask import session as flask_session
 from .cw_login import current_user
 from flask_babel import format_date
 from flask_babel import gettext as _
-from sqlalchemy.sql.expression import func, not_, and_, or_, text, true
+from sqlalchemy import select
+from sqlalchemy.sql.expression import func, and_, or_, text, true, false, case
 from sqlalchemy.sql.functions import coalesce
 
 from . import logger, db, calibre_db, config, ub
@@ -30,6 +31,11 @@ from .string_helper import strip_whitespaces
 from .usermanagement import login_required_if_no_ano
 from .render_template import render_title_template
 from .pagination import Pagination
+from .helper import tags_filters
+from .search_index import search_index, request_coalescer, KINDS
+from .content_index import content_index
+from .search_planner import (SearchPlanner, Predicate, TIER_INDEXED, TIER_COLUMN, TIER_SCAN, TEXT_SELECTIVITY,
+                             RANGE_SELECTIVITY, STATUS_SELECTIVITY)
 
 
 search = Blueprint('search', __name__)
@@ -71,65 +77,142 @@ def advanced_search_form():
     return render_prepare_search_form(cc)
 
 
-def adv_search_custom_columns(cc, term, q):
+@search.route("/advsearch/explain", methods=['GET'])
+@login_required_if_no_ano
+def advanced_search_explain():
+    # Plan of the last advanced search with row counts and timings per predicate
+    if not current_user.role_admin():
+        abort(403)
+    if 'query' not in flask_session:
+        abort(404)
+    term = json.loads(flask_session['query'])
+    cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
+    q, planner, search_term = plan_adv_search(term, cc)
+    plan = planner.explain(q)
+    plan["search_term"] = search_term
+    return jsonify(plan)
+
+
+@search.route("/search/instant", methods=["GET"])
+@login_required_if_no_ano
+def instant_search():
+    # Search-as-you-type, the client sends an increasing seq per keystroke, answers to overtaken requests are dropped
+    term = strip_whitespaces(request.args.get("q", ""))
+    limit = min(max(request.args.get("limit", 5, type=int), 1), 20)
+    client = (current_user.id, request.args.get("client") or request.remote_addr)
+    seq = request_coalescer.begin(client, request.args.get("seq", type=int))
+    if seq is None:
+        return jsonify(superseded=True)
+    result = {"seq": seq, "term": term}
+    result.update({kind: [] for kind in KINDS})
+    if not term:
+        return jsonify(result)
+    try:
+        search_index.refresh(config, calibre_db.session)
+        matches = search_index.search(term, limit * 2)
+    except Exception as ex:
+        log.error_or_exception(ex)
+        return jsonify(result)
+    if not request_coalescer.is_current(client, seq):
+        return jsonify(superseded=True, seq=seq)
+    result.update(resolve_instant_matches(matches, limit))
+    return jsonify(result)
+
+
+# Loads display names of the matches in index order, entries hidden for the user are skipped
+def resolve_instant_matches(matches, limit):
+    def ordered(rows, ids):
+        rows = {row.id: row for row in rows}
+        return [rows[entry_id] for entry_id in ids if entry_id in rows][:limit]
+
+    result = {}
+    ids = matches["book"]
+    books = ordered(calibre_db.session.query(db.Books.id, db.Books.title)
+                    .filter(db.Books.id.in_(ids)).filter(calibre_db.common_filters()), ids) if ids else []
+    result["book"] = [{"id": book.id, "name": book.title,
+                       "url": url_for('web.show_book', book_id=book.id)} for book in books]
+    for kind, table, data, filters in (("author", db.Authors, "author", true()),
+                                       ("series", db.Series, "series", true()),
+                                       ("tag", db.Tags, "category", tags_filters())):
+        ids = matches[kind]
+        rows = ordered(calibre_db.session.query(table.id, table.name)
+                       .filter(table.id.in_(ids)).filter(filters), ids) if ids else []
+        result[kind] = [{"id": row.id, "name": row.name,
+                         "url": url_for('web.books_list', data=data, sort_param='stored', book_id=row.id)}
+                        for row in rows]
+    return result
+
+
+def adv_search_custom_columns(cc, term, planner):
     for c in cc:
+        column = getattr(db.Books, 'custom_column_' + str(c.id), None)
+        name = "custom column " + c.name
         if c.datatype == "datetime":
             custom_start = term.get('custom_column_' + str(c.id) + '_start')
             custom_end = term.get('custom_column_' + str(c.id) + '_end')
             if custom_start:
-                q = q.filter(getattr(db.Books, 'custom_column_' + str(c.id)).any(
-                    func.datetime(db.cc_classes[c.id].value) >= func.datetime(custom_start)))
+                planner.add(name + " >= " + custom_start, column.any(
+                    func.datetime(db.cc_classes[c.id].value) >= func.datetime(custom_start)),
+                    TIER_SCAN, RANGE_SELECTIVITY)
             if custom_end:
-                q = q.filter(getattr(db.Books, 'custom_column_' + str(c.id)).any(
-                    func.datetime(db.cc_classes[c.id].value) <= func.datetime(custom_end)))
+                planner.add(name + " <= " + custom_end, column.any(
+                    func.datetime(db.cc_classes[c.id].value) <= func.datetime(custom_end)),
+                    TIER_SCAN, RANGE_SELECTIVITY)
         elif c.datatype in ["int", "float"]:
             custom_low = term.get('custom_column_' + str(c.id) + '_low')
             custom_high = term.get('custom_column_' + str(c.id) + '_high')
             if custom_low:
-                q = q.filter(getattr(db.Books, 'custom_column_' + str(c.id)).any(
-                    db.cc_classes[c.id].value >= custom_low))
+                planner.add(name + " >= " + custom_low, column.any(db.cc_classes[c.id].value >= custom_low),
+                            TIER_SCAN, RANGE_SELECTIVITY)
             if custom_high:
-                q = q.filter(getattr(db.Books, 'custom_column_' + str(c.id)).any(
-                    db.cc_classes[c.id].value <= custom_high))
+                planner.add(name + " <= " + custom_high, column.any(db.cc_classes[c.id].value <= custom_high),
+                            TIER_SCAN, RANGE_SELECTIVITY)
         else:
             custom_query = term.get('custom_column_' + str(c.id))
             if c.datatype == 'bool':
                 if custom_query != "Any":
                     if custom_query == "":
-                        q = q.filter(~getattr(db.Books, 'custom_column_' + str(c.id)).
-                                     any(db.cc_classes[c.id].value >= 0))
+                        planner.add(name + " empty", ~column.any(db.cc_classes[c.id].value >= 0),
+                                    TIER_SCAN, STATUS_SELECTIVITY)
                     else:
-                        q = q.filter(getattr(db.Books, 'custom_column_' + str(c.id)).any(
-                            db.cc_classes[c.id].value == bool(custom_query == "True")))
+                        planner.add(name + " = " + custom_query,
+                                    column.any(db.cc_classes[c.id].value == bool(custom_query == "True")),
+                                    TIER_SCAN, STATUS_SELECTIVITY)
             elif custom_query != '' and custom_query is not None:
                 if c.datatype == 'rating':
-                    q = q.filter(getattr(db.Books, 'custom_column_' + str(c.id)).any(
-                        db.cc_classes[c.id].value == int(float(custom_query) * 2)))
+                    planner.add(name + " = " + custom_query,
+                                column.any(db.cc_classes[c.id].value == int(float(custom_query) * 2)),
+                                TIER_SCAN, RANGE_SELECTIVITY)
                 else:
-                    q = q.filter(getattr(db.Books, 'custom_column_' + str(c.id)).any(
-                        func.lower(db.cc_classes[c.id].value).ilike("%" + custom_query + "%")))
-    return q
+                    planner.add(name + " like " + custom_query,
+                                column.any(func.lower(db.cc_classes[c.id].value).ilike("%" + custom_query + "%")),
+                                TIER_SCAN, TEXT_SELECTIVITY)
 
 
-def adv_search_language(q, include_languages_inputs, exclude_languages_inputs):
+def adv_search_language(planner, include_languages_inputs, exclude_languages_inputs):
     if current_user.filter_language() != "all":
-        q = q.filter(db.Books.languages.any(db.Languages.lang_code == current_user.filter_language()))
+        planner.add("user language", db.Books.languages.any(db.Languages.lang_code == current_user.filter_language()),
+                    TIER_SCAN, STATUS_SELECTIVITY)
     else:
-        for language in include_languages_inputs:
-            q = q.filter(db.Books.languages.any(db.Languages.id == language))
-        for language in exclude_languages_inputs:
-            q = q.filter(not_(db.Books.series.any(db.Languages.id == language)))
-    return q
-
-
-def adv_search_ratings(q, rating_high, rating_low):
-    if rating_high:
-        rating_high = int(rating_high) * 2
-        q = q.filter(db.Books.ratings.any(db.Ratings.rating <= rating_high))
-    if rating_low:
-        rating_low = int(rating_low) * 2
-        q = q.filter(db.Books.ratings.any(db.Ratings.rating >= rating_low))
-    return q
+        planner.include_all("include languages", db.books_languages_link.c.book,
+                            db.books_languages_link.c.lang_code, category_ids(include_languages_inputs))
+        planner.exclude_any("exclude languages", db.books_languages_link.c.book,
+                            db.books_languages_link.c.lang_code, category_ids(exclude_languages_inputs))
+
+
+def adv_search_ratings(planner, rating_high, rating_low):
+    if rating_high or rating_low:
+        condition = []
+        if rating_high:
+            condition.append(db.Ratings.rating <= int(rating_high) * 2)
+        if rating_low:
+            condition.append(db.Ratings.rating >= int(rating_low) * 2)
+        books = select(db.books_ratings_link.c.book)\
+            .join(db.Ratings, db.books_ratings_link.c.rating == db.Ratings.id).where(*condition)
+        # ratings are few, counting the matching books is as cheap as the filter itself
+        planner.predicates.append(Predicate("ratings", db.Books.id.in_(books), TIER_INDEXED,
+                                            lambda: planner.session.query(func.count())
+                                            .select_from(books.subquery()).scalar()))
 
 
 def adv_search_read_status(read_status):
@@ -154,35 +237,41 @@ def adv_search_read_status(read_status):
     return db_filter
 
 
-def adv_search_extension(q, include_extension_inputs, exclude_extension_inputs):
-    for extension in include_extension_inputs:
-        q = q.filter(db.Books.data.any(db.Data.format == extension))
-    for extension in exclude_extension_inputs:
-        q = q.filter(not_(db.Books.data.any(db.Data.format == extension)))
-    return q
+def adv_search_extension(planner, include_extension_inputs, exclude_extension_inputs):
+    planner.include_all("include formats", db.Data.book, db.Data.format, include_extension_inputs)
+    planner.exclude_any("exclude formats", db.Data.book, db.Data.format, exclude_extension_inputs)
+
+
+def adv_search_tag(planner, include_tag_inputs, exclude_tag_inputs):
+    planner.include_all("include tags", db.books_tags_link.c.book, db.books_tags_link.c.tag,
+                        category_ids(include_tag_inputs))
+    planner.exclude_any("exclude tags", db.books_tags_link.c.book, db.books_tags_link.c.tag,
+                        category_ids(exclude_tag_inputs))
+
 
+def adv_search_serie(planner, include_series_inputs, exclude_series_inputs):
+    planner.include_all("include series", db.books_series_link.c.book, db.books_series_link.c.series,
+                        category_ids(include_series_inputs))
+    planner.exclude_any("exclude series", db.books_series_link.c.book, db.books_series_link.c.series,
+                        category_ids(exclude_series_inputs))
 
-def adv_search_tag(q, include_tag_inputs, exclude_tag_inputs):
-    for tag in include_tag_inputs:
-        q = q.filter(db.Books.tags.any(db.Tags.id == tag))
-    for tag in exclude_tag_inputs:
-        q = q.filter(not_(db.Books.tags.any(db.Tags.id == tag)))
-    return q
 
+def adv_search_shelf(planner, include_shelf_inputs, exclude_shelf_inputs):
+    planner.include_any("include shelves", ub.BookShelf.book_id, ub.BookShelf.shelf,
+                        category_ids(include_shelf_inputs))
+    planner.exclude_any("exclude shelves", ub.BookShelf.book_id, ub.BookShelf.shelf,
+                        category_ids(exclude_shelf_inputs))
 
-def adv_search_serie(q, include_series_inputs, exclude_series_inputs):
-    for serie in include_series_inputs:
-        q = q.filter(db.Books.series.any(db.Series.id == serie))
-    for serie in exclude_series_inputs:
-        q = q.filter(not_(db.Books.series.any(db.Series.id == serie)))
-    return q
 
-def adv_search_shelf(q, include_shelf_inputs, exclude_shelf_inputs):
-    q = q.outerjoin(ub.BookShelf, db.Books.id == ub.BookShelf.book_id)\
-        .filter(or_(ub.BookShelf.shelf == None, ub.BookShelf.shelf.notin_(exclude_shelf_inputs)))
-    if len(include_shelf_inputs) > 0:
-        q = q.filter(ub.BookShelf.shelf.in_(include_shelf_inputs))
-    return q
+def category_ids(values):
+    ids = []
+    for value in values or []:
+        try:
+            ids.append(int(value))
+        except ValueError:
+            ids.append(value)
+    return ids
+
 
 def extend_search_term(searchterm,
                        author_name,
@@ -255,28 +344,26 @@ def extend_search_term(searchterm,
     return searchterm, pub_start, pub_end, added_start, added_end
 
 
-def render_adv_search_results(term, offset=None, order=None, limit=None):
-    sort = order[0] if order else [db.Books.sort]
-    pagination = None
-
-    cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
+def plan_adv_search(term, cc):
+    """Returns the base query, the planner with the filters of the search term and the readable search term"""
     calibre_db.create_functions()
     # calibre_db.session.connection().connection.connection.create_function("lower", 1, db.lcase)
     query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
     q = query.outerjoin(db.books_series_link, db.Books.id == db.books_series_link.c.book)\
         .outerjoin(db.Series)\
         .filter(calibre_db.common_filters(True))
+    planner = SearchPlanner(calibre_db.session)
 
     # parse multi selects to a complete dict
     tags = dict()
     elements = ['tag', 'serie', 'shelf', 'language', 'extension']
     for element in elements:
-        tags['include_' + element] = term.get('include_' + element)
-        tags['exclude_' + element] = term.get('exclude_' + element)
+        tags['include_' + element] = term.get('include_' + element) or []
+        tags['exclude_' + element] = term.get('exclude_' + element) or []
 
-    author_name = term.get("authors")
-    book_title = term.get("title")
-    publisher = term.get("publisher")
+    author_name = term.get("authors") or ""
+    book_title = term.get("title") or ""
+    publisher = term.get("publisher") or ""
     pub_start = term.get("publishstart")
     pub_end = term.get("publishend")
     rating_low = term.get("ratinghigh")
@@ -284,7 +371,7 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
     added_start = term.get("addedstart")
     added_end = term.get("addedend")
     description = term.get("comments")
-    read_status = term.get("read_status")
+    read_status = term.get("read_status") or "Any"
     if author_name:
         author_name = strip_whitespaces(author_name).lower().replace(',', '|')
     if book_title:
@@ -320,7 +407,7 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
                 search_term.extend(["{} <= {}".format(c.name,column_high)])
                 cc_present = True
         elif c.datatype == "bool":
-            if term.get('custom_column_' + str(c.id)) != "Any":
+            if term.get('custom_column_' + str(c.id), "Any") != "Any":
                 search_term.extend([("{}: {}".format(c.name, term.get('custom_column_' + str(c.id))))])
                 cc_present = True
         elif term.get('custom_column_' + str(c.id)):
@@ -342,42 +429,62 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
                                                               added_start,
                                                               added_end)
         if author_name:
-            q = q.filter(db.Books.authors.any(func.lower(db.Authors.name).ilike("%" + author_name + "%")))
+            planner.include_matching("authors like " + author_name, db.books_authors_link.c.book,
+                                     func.lower(db.Authors.name).ilike("%" + author_name + "%"),
+                                     (db.Authors, db.books_authors_link.c.author == db.Authors.id))
         if book_title:
-            q = q.filter(func.lower(db.Books.title).ilike("%" + book_title + "%"))
+            planner.add("title like " + book_title, func.lower(db.Books.title).ilike("%" + book_title + "%"),
+                        TIER_COLUMN, TEXT_SELECTIVITY)
         if pub_start:
-            q = q.filter(func.datetime(db.Books.pubdate) > func.datetime(pub_start))
+            planner.add("published after " + pub_start, func.datetime(db.Books.pubdate) > func.datetime(pub_start),
+                        TIER_COLUMN, RANGE_SELECTIVITY)
         if pub_end:
-            q = q.filter(func.datetime(db.Books.pubdate) < func.datetime(pub_end))
+            planner.add("published before " + pub_end, func.datetime(db.Books.pubdate) < func.datetime(pub_end),
+                        TIER_COLUMN, RANGE_SELECTIVITY)
         if added_start:
-            q = q.filter(func.datetime(db.Books.timestamp) > func.datetime(added_start))
+            planner.add("added after " + added_start,
+                        func.datetime(db.Books.timestamp) > func.datetime(added_start),
+                        TIER_COLUMN, RANGE_SELECTIVITY)
         if added_end:
-            q = q.filter(func.datetime(db.Books.timestamp) < func.datetime(added_end))
+            planner.add("added before " + added_end, func.datetime(db.Books.timestamp) < func.datetime(added_end),
+                        TIER_COLUMN, RANGE_SELECTIVITY)
         if read_status != "Any":
-            q = q.filter(adv_search_read_status(read_status))
+            planner.add("read status " + read_status, adv_search_read_status(read_status),
+                        TIER_COLUMN, STATUS_SELECTIVITY)
         if publisher:
-            q = q.filter(db.Books.publishers.any(func.lower(db.Publishers.name).ilike("%" + publisher + "%")))
-        q = adv_search_tag(q, tags['include_tag'], tags['exclude_tag'])
-        q = adv_search_serie(q, tags['include_serie'], tags['exclude_serie'])
-        q = adv_search_shelf(q, tags['include_shelf'], tags['exclude_shelf'])
-        q = adv_search_extension(q, tags['include_extension'], tags['exclude_extension'])
-        q = adv_search_language(q, tags['include_language'], tags['exclude_language'])
-        q = adv_search_ratings(q, rating_high, rating_low)
+            planner.include_matching("publisher like " + publisher, db.books_publishers_link.c.book,
+                                     func.lower(db.Publishers.name).ilike("%" + publisher + "%"),
+                                     (db.Publishers, db.books_publishers_link.c.publisher == db.Publishers.id))
+        adv_search_tag(planner, tags['include_tag'], tags['exclude_tag'])
+        adv_search_serie(planner, tags['include_serie'], tags['exclude_serie'])
+        adv_search_shelf(planner, tags['include_shelf'], tags['exclude_shelf'])
+        adv_search_extension(planner, tags['include_extension'], tags['exclude_extension'])
+        adv_search_language(planner, tags['include_language'], tags['exclude_language'])
+        adv_search_ratings(planner, rating_high, rating_low)
 
         if description:
-            q = q.filter(db.Books.comments.any(func.lower(db.Comments.text).ilike("%" + description + "%")))
+            planner.include_matching("comments like " + description, db.Comments.book,
+                                     func.lower(db.Comments.text).ilike("%" + description + "%"))
 
         # search custom columns
         try:
-            q = adv_search_custom_columns(cc, term, q)
+            adv_search_custom_columns(cc, term, planner)
         except AttributeError as ex:
             log.debug_or_exception(ex)
             flash(_("Error on search for custom columns, please restart Calibre-Web"), category="error")
+    return q, planner, search_term
 
-    q = q.order_by(*sort).all()
+
+def render_adv_search_results(term, offset=None, order=None, limit=None):
+    sort = order[0] if order else [db.Books.sort]
+    pagination = None
+
+    cc = calibre_db.get_cc_columns(config, filter_config_custom_read=True)
+    q, planner, search_term = plan_adv_search(term, cc)
+    ids = calibre_db.get_search_ids("advanced", json.dumps(term, sort_keys=True), config, sort,
+                                    lambda: planner.apply(q).order_by(*sort))
     flask_session['query'] = json.dumps(term)
-    ub.store_combo_ids(q)
-    result_count = len(q)
+    result_count = len(ids)
     if offset is not None and limit is not None:
         offset = int(offset)
         limit_all = offset + int(limit)
@@ -385,7 +492,8 @@ def render_adv_search_results(term, offset=None, order=None, limit=None):
     else:
         offset = 0
         limit_all = result_count
-    entries = calibre_db.order_authors(q[offset:limit_all], list_return=True, combined=True)
+    entries = calibre_db.order_authors(calibre_db.get_books_by_ids(ids[offset:limit_all], config),
+                                       list_return=True, combined=True)
     view_type = current_user.get_view_property('advsearch', 'view_type')
     template = 'search.html' if view_type != 'table' else 'list.html'
     return render_title_template(template,
@@ -430,14 +538,22 @@ def render_prepare_search_form(cc):
 
 
 def render_search_results(term, offset=None, order=None, limit=None):
+    suggestion = None
+    snippets = dict()
     if term:
         join = db.books_series_link, db.Books.id == db.books_series_link.c.book, db.Series
-        entries, result_count, pagination = calibre_db.get_search_results(term,
-                                                                          config,
-                                                                          offset,
-                                                                          order,
-                                                                          limit,
-                                                                          *join)
+        if config.schedule_content_index and content_index.available:
+            entries, result_count, pagination, snippets = get_content_search_results(term, offset, order, limit,
+                                                                                     join)
+        else:
+            entries, result_count, pagination = calibre_db.get_search_results(term,
+                                                                              config,
+                                                                              offset,
+                                                                              order,
+                                                                              limit,
+                                                                              *join)
+        if not result_count and config.config_fuzzy_search:
+            entries, result_count, pagination, suggestion = get_fuzzy_search_results(term, offset, limit)
     else:
         entries = list()
         order = [None, None]
@@ -452,9 +568,56 @@ def render_search_results(term, offset=None, order=None, limit=None):
                                  adv_searchterm=term,
                                  entries=entries,
                                  result_count=result_count,
+                                 suggestion=suggestion,
+                                 snippets=snippets,
                                  title=_("Search"),
                                  page="search",
                                  data="search",
                                  order=order[1] if order else None)
 
 
+# Simple search combined with the full-text index of the book contents. Books only matching by their contents follow
+# the metadata hits, best matches first
+def get_content_search_results(term, offset=None, order=None, limit=None, join=()):
+    sort = order[0] if order else [db.Books.sort]
+
+    def find_ids():
+        ids = [row[0] for row in calibre_db.search_query(term, config, *join).order_by(*sort)
+               .with_entities(db.Books.id)]
+        content_ids = content_index.search(term)
+        if content_ids:
+            visible = set(row[0] for row in calibre_db.session.query(db.Books.id)
+                          .filter(db.Books.id.in_(content_ids)).filter(calibre_db.common_filters(True)))
+            ids.extend(book_id for book_id in content_ids if book_id in visible)
+        return ids
+
+    # the index version is part of the key, results are computed again after the index was updated
+    key = json.dumps([strip_whitespaces(term).lower(), content_index.version()])
+    ids = calibre_db.get_cached_search_ids("content", key, config, sort, find_ids)
+    entries, result_count, pagination = calibre_db.get_search_page(ids, config, offset, limit)
+    return entries, result_count, pagination, content_index.snippets(term, [entry[0].id for entry in entries])
+
+
+# Typo tolerant search used if the simple search has no results, books are ranked by the edit distance of the search
+# words to the words of their title, authors and series
+def get_fuzzy_search_results(term, offset=None, limit=None):
+    try:
+        search_index.refresh(config, calibre_db.session)
+        suggestion = search_index.suggest(term)
+    except Exception as ex:
+        log.error_or_exception(ex)
+        return list(), 0, None, None
+
+    def ranked_query():
+        book_ids = search_index.fuzzy_book_ids(calibre_db.session, term)
+        query = calibre_db.session.query(db.Books).filter(calibre_db.common_filters(True))
+        if not book_ids:
+            return query.filter(false())
+        return (query.filter(db.Books.id.in_(book_ids))
+                .order_by(case({book_id: rank for rank, book_id in enumerate(book_ids)}, value=db.Books.id)))
+
+    ids = calibre_db.get_search_ids("fuzzy", strip_whitespaces(term).lower(), config, [], ranked_query)
+    entries, result_count, pagination = calibre_db.get_search_page(ids, config, offset, limit)
+    return entries, result_count, pagination, suggestion
+
+
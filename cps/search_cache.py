@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Cache for the ordered result ids of simple and advanced searches. An entry is stored per normalized search term,
+# visibility profile of the user and sort order together with the library change marker it was computed for, so
+# paging, the result count and "add all results to shelf" are served from the id list without running the search
+# again. Ids are kept in compact arrays, the cache is bounded by the total number of stored ids.
+
+import hashlib
+import json
+from array import array
+from collections import OrderedDict
+from threading import Lock
+
+MAX_IDS = 2000000
+
+
+# Everything besides the library content and sort order the result list of a user depends on
+def visibility_profile(user, config):
+    return (user.id, user.filter_language(), user.list_allowed_tags(), user.list_denied_tags(),
+            user.allowed_column_value, user.denied_column_value, config.config_read_column,
+            config.config_restricted_column, config.config_columns_to_ignore)
+
+
+class SearchResultCache:
+    def __init__(self, max_ids=MAX_IDS):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self.max_ids = max_ids
+
+    @staticmethod
+    def make_key(kind, term, profile, order):
+        order = [str(clause) for clause in order]
+        return hashlib.sha1(json.dumps([kind, term, repr(profile), order], sort_keys=True, default=str)
+                            .encode("utf-8")).hexdigest()
+
+    def get(self, key, marker):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == marker:
+                self._entries.move_to_end(key)
+                return entry[1]
+        return None
+
+    def set(self, key, marker, ids):
+        ids = array("q", ids)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._size -= len(old[1])
+            if len(ids) <= self.max_ids:
+                self._entries[key] = (marker, ids)
+                self._size += len(ids)
+            while self._size > self.max_ids:
+                __, (__, dropped) = self._entries.popitem(last=False)
+                self._size -= len(dropped)
+        return ids
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+search_cache = SearchResultCache()
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+
+# In-memory token index for search-as-you-type over book titles, authors, series and tags. Names are normalized like
+# the lcase function of the database (lowercase, unidecode) and split into tokens, every token points to the entries
+# containing it. Tokens are kept sorted, so all tokens starting with the typed prefix are found by bisection. Only ids,
+# normalized names and a weight are held in memory, display names are read from the database for the returned entries
+# together with the visibility filters of the user.
+# The index is built by a startup task (or the first request) and updated from the library change feed: changed books
+# are indexed again, authors, series and tags are reloaded completely as they are few compared to the books.
+# For the typo tolerant search the tokens are also indexed by their trigrams. Tokens sharing enough trigrams with a
+# search word are compared by edit distance, books are ranked by the sum of the distances of all search words to
+# words of their title, authors and series.
+
+import re
+import heapq
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from threading import Lock, RLock
+
+from sqlalchemy.sql.expression import func
+
+from . import logger, db, library_changes
+
+log = logger.create()
+
+KINDS = ("book", "author", "series", "tag")
+BOOK, AUTHOR, SERIES, TAG = range(len(KINDS))
+
+# Tokens scanned for one prefix and candidates collected for one query, bounds the work done for short prefixes
+MAX_SCAN_TOKENS = 5000
+MAX_CANDIDATES = 20000
+# Minimum seconds between two checks of the change feed
+REFRESH_INTERVAL = 2
+# Changed books indexed incrementally, above the index is rebuilt
+MAX_INCREMENTAL = 2000
+# Search words shorter than this and numbers are only matched exactly or by prefix, fuzzy matching is limited to the
+# tokens sharing the most trigrams with the word
+FUZZY_MIN_LENGTH = 3
+MAX_FUZZY_CANDIDATES = 2000
+MAX_FUZZY_PREFIX_TOKENS = 200
+MAX_FUZZY_RESULTS = 500
+# Score of a token starting with the search word, between an exact match and one edit
+PREFIX_SCORE = 0.5
+
+_token_split = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize(name):
+    return db.lcase(name or "").strip()
+
+
+def tokenize(name):
+    return list(dict.fromkeys(_token_split.findall(normalize(name))))
+
+
+def trigrams(token):
+    padded = "$" + token + "$"
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def max_distance(word):
+    if len(word) < FUZZY_MIN_LENGTH or word.isdigit():
+        return 0
+    return 1 if len(word) < 7 else 2
+
+
+def edit_distance(first, second, limit):
+    """Optimal string alignment distance (a swap of two neighbouring characters is one edit), limit + 1 if the
+    distance exceeds the limit"""
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    before_previous = None
+    previous = list(range(len(second) + 1))
+    for i, char in enumerate(first, 1):
+        current = [i] + [0] * len(second)
+        for j, other in enumerate(second, 1):
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other))
+            if i > 1 and j > 1 and char == second[j - 2] and first[i - 2] == other:
+                value = min(value, before_previous[j - 2] + 1)
+            current[j] = value
+        if min(current) > limit:
+            return limit + 1
+        before_previous, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+def pattern_masks(word):
+    masks = dict()
+    for position, char in enumerate(word):
+        masks[char] = masks.get(char, 0) | (1 << position)
+    return masks
+
+
+def levenshtein(masks, length, text):
+    """Levenshtein distance of the word given by its pattern_masks and length to text, bit-parallel (Myers/Hyyrö),
+    about ten times faster than edit_distance and used to sort out candidates before"""
+    full = (1 << length) - 1
+    high = 1 << (length - 1)
+    positive, negative, score = full, 0, length
+    for char in text:
+        equal = masks.get(char, 0)
+        vertical = equal | negative
+        horizontal = ((((equal & positive) + positive) & full) ^ positive) | equal
+        horizontal_positive = negative | (~(horizontal | positive) & full)
+        horizontal_negative = positive & horizontal
+        if horizontal_positive & high:
+            score += 1
+        elif horizontal_negative & high:
+            score -= 1
+        horizontal_positive = ((horizontal_positive << 1) | 1) & full
+        horizontal_negative = (horizontal_negative << 1) & full
+        positive = horizontal_negative | (~(vertical | horizontal_positive) & full)
+        negative = horizontal_positive & vertical
+    return score
+
+
+def make_key(kind, entry_id):
+    return entry_id * len(KINDS) + kind
+
+
+def split_key(key):
+    return key % len(KINDS), key // len(KINDS)
+
+
+class SearchIndex:
+    def __init__(self):
+        self._lock = RLock()
+        self._build_lock = Lock()
+        self._postings = dict()
+        self._tokens = []
+        self._entries = dict()
+        self._trigrams = dict()
+        self.sequence = None
+        self._last_refresh = 0
+
+    @property
+    def ready(self):
+        return self.sequence is not None
+
+    # write access, callers hold self._lock
+    def _add(self, key, name, weight):
+        normalized = normalize(name)
+        self._entries[key] = (normalized, weight)
+        for token in tokenize(normalized):
+            postings = self._postings.get(token)
+            if postings is None:
+                self._postings[token] = array("q", [key])
+                insort(self._tokens, token)
+                self._add_trigrams(self._trigrams, token)
+            elif key not in postings:
+                postings.append(key)
+
+    @staticmethod
+    def _add_trigrams(index, token):
+        if len(token) >= FUZZY_MIN_LENGTH - 1 and not token.isdigit():
+            for gram in trigrams(token):
+                index.setdefault(gram, []).append(token)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            for token in tokenize(entry[0]):
+                postings = self._postings.get(token)
+                if postings is not None and key in postings:
+                    postings.remove(key)
+
+    @staticmethod
+    def _load_books(session, book_ids=None):
+        query = session.query(db.Books.id, db.Books.title)
+        if book_ids is not None:
+            query = query.filter(db.Books.id.in_(book_ids))
+        return query.all()
+
+    @staticmethod
+    def _load_categories(session):
+        categories = []
+        for kind, table, link, column in ((AUTHOR, db.Authors, db.books_authors_link, "author"),
+                                          (SERIES, db.Series, db.books_series_link, "series"),
+                                          (TAG, db.Tags, db.books_tags_link, "tag")):
+            counts = dict(session.query(link.c[column], func.count(link.c.book)).group_by(link.c[column]).all())
+            categories.extend((kind, entry.id, entry.name, counts.get(entry.id, 0))
+                              for entry in session.query(table.id, table.name))
+        return categories
+
+    def build(self, session):
+        """Builds the complete index, the previous index keeps serving requests until the new one is ready"""
+        with self._build_lock:
+            start = time.perf_counter()
+            sequence = library_changes.latest_sequence()
+            postings = dict()
+            entries = dict()
+            # book ids are increasing with the time books are added, newer books rank first
+            items = [(BOOK, book.id, book.title, book.id) for book in self._load_books(session)]
+            items.extend(self._load_categories(session))
+            for kind, entry_id, name, weight in items:
+                key = make_key(kind, entry_id)
+                normalized = normalize(name)
+                entries[key] = (normalized, weight)
+                for token in tokenize(normalized):
+                    postings.setdefault(token, []).append(key)
+            postings = {token: array("q", keys) for token, keys in postings.items()}
+            grams = dict()
+            for token in postings:
+                self._add_trigrams(grams, token)
+            with self._lock:
+                self._postings = postings
+                self._tokens = sorted(postings)
+                self._entries = entries
+                self._trigrams = grams
+                self.sequence = sequence
+                self._last_refresh = time.time()
+            log.info("Search index built with %d entries and %d tokens in %.2fs",
+                     len(entries), len(postings), time.perf_counter() - start)
+
+    def refresh(self, config, session):
+        """Applies library changes to the index, builds it if it doesn't exist yet"""
+        if not self.ready:
+            self.build(session)
+            return
+        if time.time() - self._last_refresh < REFRESH_INTERVAL:
+            return
+        self._last_refresh = time.time()
+        library_changes.detect_external_changes(config, session)
+        sequence, book_ids = library_changes.changed_books_since(self.sequence)
+        if sequence == self.sequence:
+            return
+        if book_ids is None or len(book_ids) > MAX_INCREMENTAL:
+            self.build(session)
+            return
+        books = self._load_books(session, list(book_ids))
+        categories = self._load_categories(session)
+        with self._lock:
+            for book_id in book_ids:
+                self._remove(make_key(BOOK, book_id))
+            for book in books:
+                self._add(make_key(BOOK, book.id), book.title, book.id)
+            current = set()
+            for kind, entry_id, name, weight in categories:
+                key = make_key(kind, entry_id)
+                current.add(key)
+                entry = self._entries.get(key)
+                if entry and entry[0] == normalize(name):
+                    self._entries[key] = (entry[0], weight)
+                else:
+                    self._remove(key)
+                    self._add(key, name, weight)
+            for key in [key for key in self._entries if key % len(KINDS) != BOOK and key not in current]:
+                self._remove(key)
+            self.sequence = sequence
+
+    def _prefix_candidates(self, prefix):
+        candidates = set()
+        index = bisect_left(self._tokens, prefix)
+        for token in self._tokens[index:index + MAX_SCAN_TOKENS]:
+            if not token.startswith(prefix):
+                break
+            candidates.update(self._postings[token])
+            if len(candidates) >= MAX_CANDIDATES:
+                break
+        return candidates
+
+    def search(self, term, limit):
+        """Returns dict kind -> list of ids of the best matches, ranked by matching the beginning of the name,
+        weight and name. Every word of the term has to match the beginning of a token of the name"""
+        normalized = normalize(term)
+        words = tokenize(normalized)
+        result = {kind: [] for kind in KINDS}
+        if not words:
+            return result
+        with self._lock:
+            candidates = None
+            # longest word first, it usually has the fewest matches
+            for word in sorted(words, key=len, reverse=True):
+                matches = self._prefix_candidates(word)
+                candidates = matches if candidates is None else candidates & matches
+                if not candidates:
+                    return result
+            # words typed completely rank above words which are only a prefix ("book 1" before "book 12")
+            exact = dict()
+            for word in words:
+                for key in self._postings.get(word, ()):
+                    exact[key] = exact.get(key, 0) + 1
+            by_kind = {kind: [] for kind in range(len(KINDS))}
+            for key in candidates:
+                by_kind[key % len(KINDS)].append(key)
+            for kind, keys in by_kind.items():
+                ranked = heapq.nsmallest(limit, keys, key=lambda key: (not self._entries[key][0].startswith(normalized),
+                                                                       -exact.get(key, 0),
+                                                                       -self._entries[key][1],
+                                                                       self._entries[key][0]))
+                result[KINDS[kind]] = [split_key(key)[1] for key in ranked]
+        return result
+
+    # callers hold self._lock
+    def _near_tokens(self, word):
+        """Returns dict token -> score of the indexed tokens matching the word exactly, by prefix or within the
+        allowed edit distance"""
+        near = dict()
+        if self._postings.get(word):
+            near[word] = 0
+        index = bisect_left(self._tokens, word)
+        for token in self._tokens[index:index + MAX_FUZZY_PREFIX_TOKENS]:
+            if not token.startswith(word):
+                break
+            near.setdefault(token, PREFIX_SCORE)
+        limit = max_distance(word)
+        if not limit:
+            return near
+        grams = trigrams(word)
+        counts = dict()
+        for gram in grams:
+            for token in self._trigrams.get(gram, ()):
+                counts[token] = counts.get(token, 0) + 1
+        # every edit changes at most four trigrams (swapping two characters)
+        required = max(1, len(grams) - 4 * limit)
+        candidates = [token for token, count in counts.items()
+                      if count >= required and abs(len(token) - len(word)) <= limit and token not in near]
+        if len(candidates) > MAX_FUZZY_CANDIDATES:
+            candidates = heapq.nlargest(MAX_FUZZY_CANDIDATES, candidates, key=counts.get)
+        masks = pattern_masks(word)
+        for token in candidates:
+            # a swap of two characters counts as two edits in the levenshtein distance
+            if levenshtein(masks, len(word), token) <= 2 * limit:
+                distance = edit_distance(word, token, limit)
+                if distance <= limit:
+                    near[token] = distance
+        return near
+
+    def suggest(self, term):
+        """Returns the term with unknown words replaced by the closest indexed word, None if there is nothing to
+        correct"""
+        words = tokenize(term)
+        corrected = []
+        with self._lock:
+            for word in words:
+                near = {token: score for token, score in self._near_tokens(word).items() if self._postings.get(token)}
+                if not near or word in near:
+                    corrected.append(word)
+                else:
+                    corrected.append(min(near, key=lambda token: (near[token], -len(self._postings[token]), token)))
+        return " ".join(corrected) if corrected != words else None
+
+    def fuzzy_book_ids(self, session, term):
+        """Returns ids of the books matching every word of the term within the allowed edit distance in title,
+        authors or series, best matches first"""
+        words = tokenize(term)
+        if not words:
+            return []
+        matches = []
+        with self._lock:
+            for word in words:
+                books = dict()
+                categories = {AUTHOR: dict(), SERIES: dict()}
+                for token, score in self._near_tokens(word).items():
+                    for key in self._postings.get(token, ()):
+                        kind, entry_id = split_key(key)
+                        target = books if kind == BOOK else categories.get(kind)
+                        if target is not None and score < target.get(entry_id, score + 1):
+                            target[entry_id] = score
+                matches.append((books, categories))
+        scores = None
+        # on equal scores books matching more words in their own title rank first
+        title_hits = dict()
+        for books, categories in matches:
+            for book_id in books:
+                title_hits[book_id] = title_hits.get(book_id, 0) + 1
+            for kind, link, column in ((AUTHOR, db.books_authors_link, "author"),
+                                       (SERIES, db.books_series_link, "series")):
+                found = categories[kind]
+                if found:
+                    for book_id, entry_id in (session.query(link.c.book, link.c[column])
+                                              .filter(link.c[column].in_(list(found)))):
+                        if found[entry_id] < books.get(book_id, found[entry_id] + 1):
+                            books[book_id] = found[entry_id]
+            if scores is None:
+                scores = books
+            else:
+                scores = {book_id: scores[book_id] + score for book_id, score in books.items() if book_id in scores}
+            if not scores:
+                return []
+        return heapq.nsmallest(MAX_FUZZY_RESULTS, scores,
+                               key=lambda book_id: (scores[book_id], -title_hits.get(book_id, 0), -book_id))
+
+    def get_stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "tokens": len(self._tokens), "trigrams": len(self._trigrams),
+                    "sequence": self.sequence}
+
+
+class RequestCoalescer:
+    """Tracks the newest request of every client, requests which were overtaken by a newer one of the same client
+    are answered without (further) work"""
+    def __init__(self, max_clients=10000):
+        self._lock = Lock()
+        self._latest = OrderedDict()
+        self.max_clients = max_clients
+
+    def begin(self, client, sequence=None):
+        """Registers a request, returns its sequence number or None if a newer request of the client is known"""
+        with self._lock:
+            latest = self._latest.get(client, 0)
+            if sequence is None:
+                sequence = latest + 1
+            elif sequence <= latest:
+                return None
+            self._latest[client] = sequence
+            self._latest.move_to_end(client)
+            while len(self._latest) > self.max_clients:
+                self._latest.popitem(last=False)
+            return sequence
+
+    def is_current(self, client, sequence):
+        with self._lock:
+            return self._latest.get(client) == sequence
+
+
+search_index = SearchIndex()
+request_coalescer = RequestCoalescer()
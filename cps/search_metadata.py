@@ -16,21 +16,22 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-import concurrent.futures
 import importlib
 import inspect
 import json
 import os
 import sys
+import time
 
-from flask import Blueprint, request, url_for, make_response, jsonify
+from flask import Blueprint, request, url_for, make_response, jsonify, Response
 from .cw_login import current_user
 from flask_babel import get_locale
 from sqlalchemy.exc import InvalidRequestError, OperationalError
 from sqlalchemy.orm.attributes import flag_modified
 
 from cps.services.Metadata import Metadata
-from . import constants, logger, ub, web_server
+from . import constants, logger, ub
+from .metadata_gateway import metadata_gateway
 from .usermanagement import user_login_required
 
 
@@ -38,14 +39,6 @@ meta = Blueprint("metadata", __name__)
 
 log = logger.create()
 
-try:
-    from dataclasses import asdict
-except ImportError:
-    log.info('*** "dataclasses" is needed for calibre-web to run. Please install it using pip: "pip install dataclasses" ***')
-    print('*** "dataclasses" is needed for calibre-web to run. Please install it using pip: "pip install dataclasses" ***')
-    web_server.stop(True)
-    sys.exit(6)
-
 new_list = list()
 meta_dir = os.path.join(constants.BASE_DIR, "cps", "metadata_provider")
 modules = os.listdir(os.path.join(constants.BASE_DIR, "cps", "metadata_provider"))
@@ -113,8 +106,8 @@ def metadata_change_active_provider(prov_name):
         data = []
         provider = next((c for c in cl if c.__id__ == prov_name), None)
         if provider is not None:
-            data = provider.search(new_state.get("query", ""))
-        return make_response(jsonify([asdict(x) for x in data]))
+            data, __ = metadata_gateway.search([provider], new_state.get("query", ""))
+        return make_response(jsonify(data))
     return ""
 
 
@@ -127,13 +120,36 @@ def metadata_search():
     locale = get_locale()
     if query:
         static_cover = url_for("static", filename="generic_cover.jpg")
-        # ret = cl[0].search(query, static_cover, locale)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            meta = {
-                executor.submit(c.search, query, static_cover, locale): c
-                for c in cl
-                if active.get(c.__id__, True)
-            }
-            for future in concurrent.futures.as_completed(meta):
-                data.extend([asdict(x) for x in future.result() if x])
+        # providers answering after the time budget are left out, their results are cached for the next search
+        data, __ = metadata_gateway.search([c for c in cl if active.get(c.__id__, True)], query, static_cover, locale)
     return  make_response(jsonify(data))
+
+
+@meta.route("/metadata/search/stream", methods=["POST"])
+@user_login_required
+def metadata_search_stream():
+    """Sends the results of every provider as one json line as soon as the provider answered, followed by a summary
+    line. Closing the connection cancels the provider searches which didn't start yet"""
+    query = request.form.to_dict().get("query")
+    active = current_user.view_settings.get("metadata", {})
+    providers = [c for c in cl if active.get(c.__id__, True)] if query else []
+    results = metadata_gateway.stream(providers, query, url_for("static", filename="generic_cover.jpg"),
+                                      get_locale())
+
+    def generate():
+        start = time.perf_counter()
+        summary = {"event": "summary", "records": 0, "ok": [], "cached": [], "error": [], "timeout": []}
+        for provider, records, seconds, status in results:
+            summary["records"] += len(records)
+            summary[status].append(provider.__id__)
+            yield json.dumps({"event": "provider", "id": provider.__id__, "name": provider.__name__,
+                              "status": status, "ms": round(seconds * 1000), "records": records}) + "\n"
+        summary["ms"] = round((time.perf_counter() - start) * 1000)
+        yield json.dumps(summary) + "\n"
+
+    response = Response(generate(), mimetype="application/x-ndjson")
+    response.headers["Cache-Control"] = "no-cache"
+    # keeps reverse proxies from buffering the lines
+    response.headers["X-Accel-Buffering"] = "no"
+    response.call_on_close(results.close)
+    return response
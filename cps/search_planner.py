@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+# Query planner for the advanced search. The filters of a search are collected as predicates with an estimated number
+# of matching books. All include values of a category become one grouped IN subquery on the link table, estimated
+# from the category counts, text filters are evaluated once on the (small) category table instead of once per book.
+# Predicates are applied in the order cheap and indexed first, most selective first within the same cost.
+# explain() reports the chosen order with estimated and real row counts and the time spent per predicate, together
+# with sqlite's plan of the combined query.
+
+import time
+
+from sqlalchemy import select, distinct
+from sqlalchemy.sql.expression import func, not_
+
+from . import logger, db
+
+log = logger.create()
+
+# Cost classes of predicates, lower is cheaper
+TIER_INDEXED = 0  # uncorrelated IN subqueries on indexed link tables, evaluated once
+TIER_COLUMN = 1   # filters on columns of the books row
+TIER_SCAN = 2     # text matches and correlated subqueries
+
+# Share of books assumed to match predicates without category counts
+TEXT_SELECTIVITY = 0.1
+RANGE_SELECTIVITY = 0.3
+STATUS_SELECTIVITY = 0.5
+
+
+class Predicate:
+    # estimate is the number of matching books or a function returning it, which is only called once the plan is
+    # ordered, so searches served from the result cache don't run the count queries
+    def __init__(self, name, clause, tier, estimate):
+        self.name = name
+        self.clause = clause
+        self.tier = tier
+        self._estimate = estimate
+
+    @property
+    def estimate(self):
+        if callable(self._estimate):
+            self._estimate = self._estimate()
+        return self._estimate
+
+
+class SearchPlanner:
+    def __init__(self, session):
+        self.session = session
+        self.predicates = []
+        self._total = None
+
+    @property
+    def total(self):
+        if self._total is None:
+            self._total = self.session.query(func.count(db.Books.id)).scalar() or 0
+        return self._total
+
+    def add(self, name, clause, tier, selectivity):
+        self.predicates.append(Predicate(name, clause, tier, lambda: int(self.total * selectivity)))
+
+    def _category_counts(self, book_column, category_column, values):
+        return dict(self.session.query(category_column, func.count(distinct(book_column)))
+                    .filter(category_column.in_(values))
+                    .group_by(category_column).all())
+
+    def include_all(self, name, book_column, category_column, values):
+        """Books linked to every one of the values"""
+        values = list(dict.fromkeys(values or []))
+        if not values:
+            return
+        if len(values) == 1:
+            books = select(book_column).where(category_column == values[0])
+        else:
+            books = (select(book_column).where(category_column.in_(values))
+                     .group_by(book_column).having(func.count(distinct(category_column)) == len(values)))
+
+        def estimate():
+            counts = self._category_counts(book_column, category_column, values)
+            return min(counts.get(value, 0) for value in values) if len(counts) == len(values) else 0
+        self.predicates.append(Predicate(name, db.Books.id.in_(books), TIER_INDEXED, estimate))
+
+    def include_any(self, name, book_column, category_column, values):
+        """Books linked to at least one of the values"""
+        values = list(dict.fromkeys(values or []))
+        if not values:
+            return
+        self.predicates.append(Predicate(name, db.Books.id.in_(select(book_column)
+                                                               .where(category_column.in_(values))),
+                                         TIER_INDEXED,
+                                         lambda: min(self.total, sum(self._category_counts(
+                                             book_column, category_column, values).values()))))
+
+    def exclude_any(self, name, book_column, category_column, values):
+        """Books linked to none of the values"""
+        values = list(dict.fromkeys(values or []))
+        if not values:
+            return
+        self.predicates.append(Predicate(name,
+                                         not_(db.Books.id.in_(select(book_column)
+                                                              .where(category_column.in_(values)))),
+                                         TIER_INDEXED,
+                                         lambda: max(0, self.total - sum(self._category_counts(
+                                             book_column, category_column, values).values()))))
+
+    def include_matching(self, name, book_column, condition, *joins):
+        """Books linked to category entries matching the condition, evaluated once over the category table"""
+        books = select(book_column)
+        for join in joins:
+            books = books.join(*join) if isinstance(join, tuple) else books.join(join)
+        self.add(name, db.Books.id.in_(books.where(condition)), TIER_SCAN, TEXT_SELECTIVITY)
+
+    def ordered(self):
+        return sorted(self.predicates, key=lambda predicate: (predicate.tier, predicate.estimate))
+
+    def apply(self, query):
+        if not self.predicates:
+            return query
+        return query.filter(*[predicate.clause for predicate in self.ordered()])
+
+    def explain(self, query):
+        """Runs the predicates on their own and step by step in plan order, returns the plan with row counts,
+        timings and the sqlite query plan of the combined query"""
+        steps = []
+        combined = query
+        for predicate in self.ordered():
+            start = time.perf_counter()
+            rows = query.filter(predicate.clause).count()
+            alone_ms = (time.perf_counter() - start) * 1000
+            combined = combined.filter(predicate.clause)
+            start = time.perf_counter()
+            remaining = combined.count()
+            steps.append({"predicate": predicate.name,
+                          "tier": predicate.tier,
+                          "estimate": predicate.estimate,
+                          "rows": rows,
+                          "remaining": remaining,
+                          "ms": round(alone_ms, 2),
+                          "cumulative_ms": round((time.perf_counter() - start) * 1000, 2)})
+        start = time.perf_counter()
+        result_count = combined.count()
+        return {"total_books": self.total,
+                "predicates": steps,
+                "result_count": result_count,
+                "ms": round((time.perf_counter() - start) * 1000, 2),
+                "query_plan": self.query_plan(combined)}
+
+    def query_plan(self, query):
+        try:
+            compiled = query.statement.compile(dialect=self.session.get_bind().dialect,
+                                               compile_kwargs={"render_postcompile": True})
+            params = tuple(compiled.params[key] for key in compiled.positiontup)
+            rows = self.session.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), params)
+            return [row[-1] for row in rows]
+        except Exception as ex:
+            log.error_or_exception(ex)
+            return []
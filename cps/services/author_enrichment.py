@@ -8,7 +8,6 @@ Inspired by Calibre Desktop plugins, this service aggregates metadata from:
 - Wikipedia (Multi-language biographies)
 """
 
-import requests
 import hashlib
 import random
 import re
@@ -16,7 +15,8 @@ from datetime import datetime, timezone, timedelta
 from lxml.html import fromstring
 from urllib.parse import quote, urlparse
 from .. import logger, ub
-from .isbn_extractor import extract_isbn_from_file
+from ..isbn_extractor import extract_isbn_from_file
+from .enrichment_engine import EnrichmentEngine, enrichment_http
 
 log = logger.create()
 
@@ -71,17 +71,21 @@ def normalize_book_title(title):
 # --- Providers ---
 
 class AuthorMetadataSource:
+    name = 'generic'
+
     def fetch(self, author_name, isbn=None):
         raise NotImplementedError
 
 class OpenLibrarySource(AuthorMetadataSource):
+    name = 'openlibrary'
+
     def fetch(self, author_name, isbn=None):
         try:
             author_key = None
             if isbn:
                 # Try finding author via ISBN first
                 isbn_url = f'https://openlibrary.org/isbn/{isbn}.json'
-                resp = requests.get(isbn_url, timeout=API_TIMEOUT)
+                resp = enrichment_http.get(isbn_url, timeout=API_TIMEOUT)
                 if resp.status_code == 200:
                     book_data = resp.json()
                     authors = book_data.get('authors', [])
@@ -92,7 +96,7 @@ class OpenLibrarySource(AuthorMetadataSource):
                 # Search by name
                 search_url = f'{OPENLIBRARY_BASE}/search/authors.json'
                 params = {'q': author_name}
-                resp = requests.get(search_url, params=params, timeout=API_TIMEOUT)
+                resp = enrichment_http.get(search_url, params=params, timeout=API_TIMEOUT)
                 search_data = resp.json()
                 if search_data.get('docs'):
                     # Legacy helper find_best_author_match
@@ -105,7 +109,7 @@ class OpenLibrarySource(AuthorMetadataSource):
                     author_key = f'/authors/{author_key}'
                 
                 detail_url = f'{OPENLIBRARY_BASE}{author_key}.json'
-                resp = requests.get(detail_url, timeout=API_TIMEOUT)
+                resp = enrichment_http.get(detail_url, timeout=API_TIMEOUT)
                 data = resp.json()
                 
                 bio = data.get('bio', '')
@@ -120,7 +124,7 @@ class OpenLibrarySource(AuthorMetadataSource):
                 works = []
                 try:
                     works_url = f'{OPENLIBRARY_BASE}{author_key}/works.json?limit=100'
-                    works_resp = requests.get(works_url, timeout=API_TIMEOUT)
+                    works_resp = enrichment_http.get(works_url, timeout=API_TIMEOUT)
                     works_data = works_resp.json()
                     works = [e.get('title') for e in works_data.get('entries', []) if e.get('title')]
                 except: pass
@@ -137,6 +141,8 @@ class OpenLibrarySource(AuthorMetadataSource):
         return None
 
 class WikipediaSource(AuthorMetadataSource):
+    name = 'wikipedia'
+
     def fetch(self, author_name, isbn=None):
         # Wraps the previous wikipedia logic
         try:
@@ -146,7 +152,7 @@ class WikipediaSource(AuthorMetadataSource):
             
             for clean_name in name_variations:
                 params = {'action': 'query', 'list': 'search', 'srsearch': clean_name, 'format': 'json', 'srlimit': 3}
-                resp = requests.get(search_url, params=params, headers=headers, timeout=10)
+                resp = enrichment_http.get(search_url, params=params, headers=headers, timeout=10)
                 results = resp.json().get("query", {}).get("search", [])
                 if not results: continue
                 
@@ -155,7 +161,7 @@ class WikipediaSource(AuthorMetadataSource):
                     "action": "query", "prop": "extracts|pageimages", "exintro": True, "exsentences": 12,
                     "explaintext": True, "redirects": 1, "titles": title, "format": "json", "pithumbsize": 1000
                 }
-                info_resp = requests.get(search_url, params=info_params, headers=headers, timeout=10)
+                info_resp = enrichment_http.get(search_url, params=info_params, headers=headers, timeout=10)
                 pages = info_resp.json().get("query", {}).get("pages", {})
                 
                 for pid, pdata in pages.items():
@@ -175,12 +181,14 @@ class WikipediaSource(AuthorMetadataSource):
         return None
 
 class DatabazeknihSource(AuthorMetadataSource):
+    name = 'databazeknih'
+
     def fetch(self, author_name, isbn=None):
         try:
             headers = get_headers()
             q = quote(author_name)
             search_url = f"{DATABAZEKNIH_BASE}/vyhledavani/autori?q={q}"
-            resp = requests.get(search_url, headers=headers, timeout=API_TIMEOUT)
+            resp = enrichment_http.get(search_url, headers=headers, timeout=API_TIMEOUT)
             root = fromstring(resp.content)
             
             # Find candidate links
@@ -192,7 +200,7 @@ class DatabazeknihSource(AuthorMetadataSource):
             profile_url = DATABAZEKNIH_BASE + "/" + href.lstrip("/")
             
             # 1. Main Profile (Image)
-            prof_resp = requests.get(profile_url, headers=headers, timeout=API_TIMEOUT)
+            prof_resp = enrichment_http.get(profile_url, headers=headers, timeout=API_TIMEOUT)
             prof_root = fromstring(prof_resp.content)
             
             photo_url = ""
@@ -208,7 +216,7 @@ class DatabazeknihSource(AuthorMetadataSource):
             # 2. Biography
             bio = ""
             bio_url = f"{DATABAZEKNIH_BASE}/zivotopis/{slug}"
-            bio_resp = requests.get(bio_url, headers=headers, timeout=API_TIMEOUT)
+            bio_resp = enrichment_http.get(bio_url, headers=headers, timeout=API_TIMEOUT)
             bio_root = fromstring(bio_resp.content)
             
             bio_header = bio_root.xpath("//h2[contains(@class, 'lora') and contains(text(), 'ivotopis')]")
@@ -226,7 +234,7 @@ class DatabazeknihSource(AuthorMetadataSource):
             works = []
             works_url = f"{DATABAZEKNIH_BASE}/vydane-knihy/{slug}"
             try:
-                w_resp = requests.get(works_url, headers=headers, timeout=API_TIMEOUT)
+                w_resp = enrichment_http.get(works_url, headers=headers, timeout=API_TIMEOUT)
                 w_root = fromstring(w_resp.content)
                 w_nodes = w_root.xpath("//div[contains(@class, 'book-triangle-container')]//a[contains(@class, 'new')]")
                 works = [n.text_content().strip() for n in w_nodes if n.text_content().strip()]
@@ -248,13 +256,15 @@ class DatabazeknihSource(AuthorMetadataSource):
         return None
 
 class GoodreadsSource(AuthorMetadataSource):
+    name = 'goodreads'
+
     def fetch(self, author_name, isbn=None):
         try:
             headers = get_headers()
             q = quote(author_name)
             # search_type=people to find author profiles
             search_url = f"https://www.goodreads.com/search?q={q}&search_type=people"
-            resp = requests.get(search_url, headers=headers, timeout=API_TIMEOUT)
+            resp = enrichment_http.get(search_url, headers=headers, timeout=API_TIMEOUT)
             root = fromstring(resp.content)
             
             # Find author link
@@ -262,7 +272,7 @@ class GoodreadsSource(AuthorMetadataSource):
             if not results: return None
             
             author_url = "https://www.goodreads.com" + results[0].get("href")
-            resp = requests.get(author_url, headers=headers, timeout=API_TIMEOUT)
+            resp = enrichment_http.get(author_url, headers=headers, timeout=API_TIMEOUT)
             root = fromstring(resp.content)
             
             # Bio: usually in .description or similar
@@ -292,13 +302,15 @@ class GoodreadsSource(AuthorMetadataSource):
         return None
 
 class AmazonSource(AuthorMetadataSource):
+    name = 'amazon'
+
     def fetch(self, author_name, isbn=None):
         try:
             # Amazon is harder due to bot protection, but we try basic search
             headers = get_headers()
             q = quote(author_name)
             search_url = f"https://www.amazon.com/s?k={q}&i=stripbooks"
-            resp = requests.get(search_url, headers=headers, timeout=API_TIMEOUT)
+            resp = enrichment_http.get(search_url, headers=headers, timeout=API_TIMEOUT)
             root = fromstring(resp.content)
             
             # Look for author page link
@@ -306,7 +318,7 @@ class AmazonSource(AuthorMetadataSource):
             if not author_links: return None
             
             author_url = "https://www.amazon.com" + author_links[0].get("href") if not author_links[0].get("href").startswith("http") else author_links[0].get("href")
-            resp = requests.get(author_url, headers=headers, timeout=API_TIMEOUT)
+            resp = enrichment_http.get(author_url, headers=headers, timeout=API_TIMEOUT)
             root = fromstring(resp.content)
             
             # Bio
@@ -342,16 +354,18 @@ def find_best_author_match(docs, author_name):
 
 # --- Main Logic ---
 
-def fetch_author_info(author_name, isbn=None):
-    """Refactored main entry point with multi-source merging."""
-    providers = [
-        DatabazeknihSource(),
-        GoodreadsSource(),
-        OpenLibrarySource(),
-        WikipediaSource(),
-        AmazonSource()
-    ]
-    
+# Sources in order of preference for the photo, the name of databazeknih is preferred for CZ/SK authors
+SOURCES = [
+    DatabazeknihSource(),
+    GoodreadsSource(),
+    OpenLibrarySource(),
+    WikipediaSource(),
+    AmazonSource()
+]
+
+
+def merge_author_results(author_name, results):
+    """Merges the results of the sources (in order of SOURCES, None for no result) into one author info"""
     final_data = {
         'biography': '',
         'image_url': '',
@@ -360,8 +374,7 @@ def fetch_author_info(author_name, isbn=None):
         'sources': []
     }
     
-    for provider in providers:
-        res = provider.fetch(author_name, isbn)
+    for res in results:
         if res:
             final_data['sources'].append(res['source'])
             # Bio: Prefer longer
@@ -387,6 +400,49 @@ def fetch_author_info(author_name, isbn=None):
     return final_data
 
 
+def fetch_author_info(author_name, isbn=None):
+    """Queries all sources at once and merges their results."""
+    engine = EnrichmentEngine(SOURCES, workers=len(SOURCES))
+    for __, __, results in engine.run([(None, author_name, isbn)]):
+        return merge_author_results(author_name, results)
+    return None
+
+
+def store_author_info(session, author_info, author_id, author_name, new_data, force_refresh=False,
+                      is_initial_load=False):
+    """Applies fetched author info (None if no source found anything) to the cached entry, returns the entry."""
+    now = datetime.now()
+    if new_data:
+        new_hash = new_data["content_hash"]
+        if not author_info:
+            last_checked_time = now - timedelta(days=random.randint(0, 30)) if is_initial_load else now
+            author_info = ub.AuthorInfo(
+                author_id=author_id,
+                author_name=author_name,
+                suggested_name=new_data["name"] if new_data["name"] != author_name else None,
+                biography=new_data["biography"],
+                image_url=new_data["image_url"],
+                works=new_data.get("works", []),
+                content_hash=new_hash,
+                last_updated=now,
+                last_checked=last_checked_time
+            )
+            session.add(author_info)
+        else:
+            author_info.last_checked = now
+            if author_info.content_hash != new_hash or force_refresh:
+                author_info.biography = new_data["biography"]
+                author_info.image_url = new_data["image_url"]
+                author_info.works = new_data.get("works", [])
+                author_info.content_hash = new_hash
+                author_info.last_updated = now
+                if new_data["name"] != author_info.author_name:
+                    author_info.suggested_name = new_data["name"]
+    elif author_info:
+        author_info.last_checked = now
+    return author_info
+
+
 def get_author_info(author_id, author_name, force_refresh=False, is_initial_load=False, commit=True):
     """Checks cache and returns enriched author info."""
     now = datetime.now()
@@ -427,43 +483,12 @@ def get_author_info(author_id, author_name, force_refresh=False, is_initial_load
             log.debug("ISBN hint discovery failed for %s: %s", author_name, e)
 
         new_data = fetch_author_info(author_name, isbn=isbn_hint)
-        
-        if new_data:
-            new_hash = new_data["content_hash"]
-            if not author_info:
-                last_checked_time = now - timedelta(days=random.randint(0, 30)) if is_initial_load else now
-                author_info = ub.AuthorInfo(
-                    author_id=author_id,
-                    author_name=author_name,
-                    suggested_name=new_data["name"] if new_data["name"] != author_name else None,
-                    biography=new_data["biography"],
-                    image_url=new_data["image_url"],
-                    works=new_data.get("works", []),
-                    content_hash=new_hash,
-                    last_updated=now,
-                    last_checked=last_checked_time
-                )
-                ub.session.add(author_info)
-            else:
-                author_info.last_checked = now
-                if author_info.content_hash != new_hash or force_refresh:
-                    author_info.biography = new_data["biography"]
-                    author_info.image_url = new_data["image_url"]
-                    author_info.works = new_data.get("works", [])
-                    author_info.content_hash = new_hash
-                    author_info.last_updated = now
-                    if new_data["name"] != author_info.author_name:
-                        author_info.suggested_name = new_data["name"]
-            
-            if commit:
-                try:
-                    ub.session.commit()
-                except: ub.session.rollback()
-        elif author_info:
-            author_info.last_checked = now
-            if commit:
-                try: ub.session.commit()
-                except: ub.session.rollback()
+        author_info = store_author_info(ub.session, author_info, author_id, author_name, new_data,
+                                        force_refresh=force_refresh, is_initial_load=is_initial_load)
+        if author_info and commit:
+            try:
+                ub.session.commit()
+            except: ub.session.rollback()
 
     return author_info
 
@@ -495,7 +520,7 @@ def get_series_works(series_name, author_names=None):
     """Global series lookup using Open Library search."""
     try:
         search_url = f'{OPENLIBRARY_BASE}/search.json?q={series_name}'
-        resp = requests.get(search_url, timeout=API_TIMEOUT)
+        resp = enrichment_http.get(search_url, timeout=API_TIMEOUT)
         data = resp.json()
         works = []
         auth_set = {a.lower().strip() for a in author_names} if author_names else set()
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+# Concurrent author enrichment. The sources of all authors are queried on a thread pool, so a slow source or host
+# doesn't hold back the others. Every host has a token bucket limiting the requests per second with a burst, the
+# number of requests running at once is capped globally. Answers with status 429 or 5xx are retried with exponential
+# backoff, a 429 also pauses the host for all threads (Retry-After is honored). Each run collects a throughput
+# report with the requests, retries and waiting time per host and the calls and hits per source.
+# Requests answered by the http cache are not rate limited.
+
+import concurrent.futures
+import queue
+import random
+import time
+from threading import Lock, BoundedSemaphore
+from urllib.parse import urlsplit
+
+import requests
+
+from .. import logger
+from ..http_cache import http_cache
+from ..metadata_gateway import provider_http
+
+log = logger.create()
+
+DEFAULT_RATE = 1.0
+DEFAULT_BURST = 5
+DEFAULT_CONCURRENCY = 8
+MAX_RETRIES = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# Authors queried at once per worker, bounds the pending jobs for large libraries
+AUTHORS_PER_WORKER = 2
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = Lock()
+
+    def acquire(self):
+        """Blocks until a request may be sent, returns the seconds waited"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def block(self, seconds):
+        """No requests to the host for seconds, used after the host answered with 429"""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+class HostStats:
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.errors = 0
+        self.wait = 0.0
+
+    def to_dict(self):
+        return {"requests": self.requests, "retries": self.retries, "throttled": self.throttled,
+                "server_errors": self.server_errors, "errors": self.errors, "wait_s": round(self.wait, 1)}
+
+
+def retry_delay(attempt, response):
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * (0.5 + random.random() / 2)
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            delay = max(delay, min(BACKOFF_MAX, int(retry_after)))
+    return delay
+
+
+class RateLimitedHttp:
+    """GET requests of the enrichment sources, sent through the shared connection pools of provider_http"""
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, concurrency=DEFAULT_CONCURRENCY):
+        self._lock = Lock()
+        self._buckets = dict()
+        self._stats = dict()
+        self.configure(rate, burst, concurrency)
+
+    def configure(self, rate, burst, concurrency):
+        with self._lock:
+            self.rate = rate if rate and rate > 0 else DEFAULT_RATE
+            self.burst = burst if burst and burst > 0 else DEFAULT_BURST
+            self.concurrency = concurrency if concurrency and concurrency > 0 else DEFAULT_CONCURRENCY
+            self._slots = BoundedSemaphore(self.concurrency)
+            self._buckets.clear()
+
+    def _host(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+            if host not in self._stats:
+                self._stats[host] = HostStats()
+            return self._buckets[host], self._stats[host], self._slots
+
+    def get(self, url, params=None, headers=None, cached=True, **kwargs):
+        """Answered from the http cache if possible, only requests sent to the host are rate limited"""
+        url = requests.Request("GET", url, params=params).prepare().url
+        if not cached:
+            return self._send(url, headers=headers, **kwargs)
+
+        def send(request_headers):
+            return self._send(url, headers=request_headers, **kwargs)
+        return http_cache.get(url, send, headers)
+
+    def _send(self, url, **kwargs):
+        bucket, stats, slots = self._host(url)
+        response = error = None
+        for attempt in range(MAX_RETRIES + 1):
+            waited = bucket.acquire()
+            response = error = None
+            with slots:
+                try:
+                    response = provider_http.request("GET", url, cached=False, **kwargs)
+                except requests.RequestException as ex:
+                    error = ex
+            with self._lock:
+                stats.wait += waited
+                stats.requests += 1
+                stats.retries += attempt > 0
+                if error is not None:
+                    stats.errors += 1
+                elif response.status_code == 429:
+                    stats.throttled += 1
+                elif response.status_code >= 500:
+                    stats.server_errors += 1
+            if error is None and response.status_code != 429 and response.status_code < 500:
+                return response
+            if attempt == MAX_RETRIES:
+                break
+            delay = retry_delay(attempt, response)
+            if response is not None and response.status_code == 429:
+                bucket.block(delay)
+            log.debug("Retrying %s in %.1fs (%s)", url, delay, error or response.status_code)
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+        if error is not None:
+            raise error
+        return response
+
+    def get_stats(self):
+        with self._lock:
+            return {host: stats.to_dict() for host, stats in sorted(self._stats.items())}
+
+
+class EnrichmentEngine:
+    """Queries all sources for many authors at once, results are returned per author as soon as all its sources
+    answered"""
+    def __init__(self, sources, workers=DEFAULT_CONCURRENCY, http=None):
+        self.sources = sources
+        self.workers = max(1, workers or DEFAULT_CONCURRENCY)
+        self.http = http or enrichment_http
+        self._lock = Lock()
+        self._source_stats = {source.name: {"calls": 0, "hits": 0, "seconds": 0.0} for source in sources}
+        self.authors = 0
+        self.enriched = 0
+        self.started = None
+        self.finished = None
+        self._hosts_before = dict()
+
+    def _fetch(self, index, name, isbn):
+        source = self.sources[index]
+        start = time.perf_counter()
+        try:
+            result = source.fetch(name, isbn)
+        except Exception as ex:
+            log.debug("Author source %s failed for %s: %s", source.name, name, ex)
+            result = None
+        with self._lock:
+            stats = self._source_stats[source.name]
+            stats["calls"] += 1
+            stats["hits"] += bool(result)
+            stats["seconds"] += time.perf_counter() - start
+        return result
+
+    def run(self, authors, should_stop=None):
+        """Yields (key, name, results of the sources in source order) for every (key, name, isbn) of authors"""
+        self.started = time.perf_counter()
+        self._hosts_before = self.http.get_stats()
+        authors = iter(authors)
+        done = queue.Queue()
+        pending = dict()
+        futures = set()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="enrichment")
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < self.workers * AUTHORS_PER_WORKER:
+                    try:
+                        key, name, isbn = next(authors)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[key] = (name, [None] * len(self.sources), [len(self.sources)])
+                    for index in range(len(self.sources)):
+                        future = executor.submit(self._fetch, index, name, isbn)
+                        futures.add(future)
+                        future.add_done_callback(lambda f, key=key, index=index: done.put((key, index, f)))
+                if not pending:
+                    break
+                if should_stop and should_stop():
+                    break
+                try:
+                    key, index, future = done.get(timeout=1)
+                except queue.Empty:
+                    continue
+                futures.discard(future)
+                name, results, remaining = pending[key]
+                results[index] = future.result()
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    del pending[key]
+                    self.authors += 1
+                    self.enriched += any(results)
+                    yield key, name, results
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+            self.finished = time.perf_counter()
+
+    def report(self):
+        seconds = ((self.finished or time.perf_counter()) - self.started) if self.started else 0.0
+        with self._lock:
+            sources = {name: {"calls": stats["calls"], "hits": stats["hits"],
+                              "avg_ms": round(1000 * stats["seconds"] / stats["calls"]) if stats["calls"] else None}
+                       for name, stats in self._source_stats.items()}
+        return {"authors": self.authors, "enriched": self.enriched, "seconds": round(seconds, 1),
+                "authors_per_minute": round(60 * self.authors / seconds, 1) if seconds else None,
+                "workers": self.workers, "rate": self.http.rate, "burst": self.http.burst,
+                "sources": sources, "hosts": self._host_stats()}
+
+    def _host_stats(self):
+        """Requests per host sent during this run"""
+        hosts = dict()
+        for host, stats in self.http.get_stats().items():
+            before = self._hosts_before.get(host, {})
+            stats = {field: round(value - before.get(field, 0), 1) for field, value in stats.items()}
+            if stats["requests"]:
+                hosts[host] = stats
+        return hosts
+
+
+def format_report(report):
+    lines = ["Author enrichment: {authors} authors ({enriched} enriched) in {seconds}s, {authors_per_minute} "
+             "authors/min, {workers} workers, {rate} requests/s per host, burst {burst}".format(**report)]
+    for name, stats in report["sources"].items():
+        lines.append("  source {}: {calls} calls, {hits} hits, {avg_ms} ms average".format(name, **stats))
+    for host, stats in report["hosts"].items():
+        lines.append("  host {}: {requests} requests, {retries} retries, {throttled} throttled, {server_errors} "
+                     "server errors, {errors} failed, {wait_s}s waited for rate limit".format(host, **stats))
+    return "\n".join(lines)
+
+
+enrichment_http = RateLimitedHttp()
@@ -83,8 +83,95 @@ $(function () {
         $("#identifier-table").append(line);
     }
 
+    var searchController = null;
+
+    function addBook(book) {
+        if (!$("#book-list").length) {
+            $("#meta-info").html("<ul id=\"book-list\" class=\"media-list\"></ul>");
+        }
+        var $book = $(templates.bookResult(book));
+        $book.find("img").on("click", function () {
+            populateForm(book);
+        });
+        $("#book-list").append($book);
+    }
+
+    function showProviderStatus(event) {
+        var text = event.name + ": ";
+        if (event.status === "error") {
+            text += msg.provider_error;
+        } else if (event.status === "timeout") {
+            text += msg.provider_timeout;
+        } else {
+            text += event.records.length + " (" + event.ms + " ms)";
+        }
+        $("#meta-status").append($("<span class=\"meta-provider-status\"></span>").text(text));
+    }
+
+    function handleSearchEvent(event) {
+        if (event.event === "provider") {
+            showProviderStatus(event);
+            event.records.forEach(addBook);
+        } else if (event.event === "summary" && !event.records) {
+            $("#meta-info").html("<p class=\"text-danger\">" + msg.no_result + "!</p>");
+        }
+    }
+
+    // Results of every provider are shown as soon as it answered, the response is a stream of json lines
+    function doStreamSearch (keyword) {
+        if (searchController) {
+            searchController.abort();
+        }
+        var controller = new AbortController();
+        searchController = controller;
+        var decoder = new TextDecoder();
+        var buffer = "";
+        $("#meta-status").empty();
+        $("#meta-info").text(msg.loading);
+        fetch(getPath() + "/metadata/search/stream", {
+            method: "POST",
+            credentials: "same-origin",
+            headers: {"X-CSRFToken": $("input[name='csrf_token']").val()},
+            body: new URLSearchParams({"query": keyword}),
+            signal: controller.signal
+        }).then(function (response) {
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            var reader = response.body.getReader();
+            function read() {
+                return reader.read().then(function (chunk) {
+                    if (chunk.done) {
+                        return;
+                    }
+                    buffer += decoder.decode(chunk.value, {stream: true});
+                    var lines = buffer.split("\n");
+                    buffer = lines.pop();
+                    lines.forEach(function (line) {
+                        if (line) {
+                            handleSearchEvent(JSON.parse(line));
+                        }
+                    });
+                    return read();
+                });
+            }
+            return read();
+        }).catch(function (error) {
+            if (error.name !== "AbortError") {
+                $("#meta-info").html("<p class=\"text-danger\">" + msg.search_error + "!</p>");
+            }
+        }).then(function () {
+            if (searchController === controller) {
+                searchController = null;
+            }
+        });
+    }
+
     function doSearch (keyword) {
-        if (keyword) {
+        if (keyword && window.fetch && window.AbortController && window.ReadableStream) {
+            doStreamSearch(keyword);
+        }
+        else if (keyword) {
             $("#meta-info").text(msg.loading);
             $.ajax({
                 url: getPath() + "/metadata/search",
@@ -177,6 +264,12 @@ $(function () {
         keyword = bookTitle;
         doSearch(bookTitle);
     });
+    $("#metaModal").on("hidden.bs.modal", function() {
+        // stops the providers which did not start searching yet
+        if (searchController) {
+            searchController.abort();
+        }
+    });
     $("#metaModal").on("show.bs.modal", function(e) {
         $(e.relatedTarget).one('focus', function (e) {
             $(this).blur();
@@ -71,8 +71,13 @@ var reader;
         // Key to persist last-read position for this book in localStorage
         let position_key = "calibre.reader.position." + reader.book.key();
         let stored_locations = localStorage.getItem(locations_key);
+        // Pages of fixed layout books are their spine items, known from the server
+        let fixed_layout = calibre.layout === "pre-paginated" && calibre.spineLength > 0;
         let make_locations, save_locations;
-        if (stored_locations) {
+        if (fixed_layout) {
+            make_locations = Promise.resolve();
+            save_locations = () => {};
+        } else if (stored_locations) {
             make_locations = Promise.resolve(
                 reader.book.locations.load(stored_locations)
             );
@@ -106,15 +111,19 @@ var reader;
                 } catch (e) {}
 
                 reader.rendition.on("relocated", (location) => {
-                    let percentage = Math.round(location.end.percentage * 100);
+                    let percentage, current, total;
+                    if (fixed_layout) {
+                        current = location.end.index + 1;
+                        total = calibre.spineLength;
+                        percentage = Math.round((current / total) * 100);
+                    } else {
+                        percentage = Math.round(location.end.percentage * 100);
+                        // Pages based on generated EPUB locations (CFI positions)
+                        current = reader.book.locations.locationFromCfi(location.start.cfi) || 0; // 1-based index typically
+                        total = reader.book.locations.length() || 0;
+                    }
                     progressDiv.textContent = percentage + "%";
 
-                    // Pages based on generated EPUB locations (CFI positions)
-                    const cfi = location.start.cfi;
-                    const current =
-                        reader.book.locations.locationFromCfi(cfi) || 0; // 1-based index typically
-                    const total = reader.book.locations.length() || 0;
-
                     if (total > 0) {
                         pagesDiv.textContent = current + "/" + total;
                         pagesDiv.style.visibility = "visible";
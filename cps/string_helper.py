@@ -21,3 +21,18 @@ import re
 def strip_whitespaces(text):
     return re.sub(r"(^[\s\u200B-\u200D\ufeff]+)|([\s\u200B-\u200D\ufeff]+$)","", text)
 
+
+def split_authors(values):
+    authors_list = []
+    for value in values:
+        authors = re.split('[&;]', value)
+        for author in authors:
+            commas = author.count(',')
+            if commas == 1:
+                author_split = author.split(',')
+                authors_list.append(strip_whitespaces(author_split[1]) + ' ' + strip_whitespaces(author_split[0]))
+            elif commas > 1:
+                authors_list.extend([strip_whitespaces(x) for x in author.split(',')])
+            else:
+                authors_list.append(strip_whitespaces(author))
+    return authors_list
@@ -1,8 +1,9 @@
 from flask_babel import lazy_gettext as N_
 from datetime import datetime, timezone
-import time
 
 from cps import logger, ub, db, audit_helper, config, app
+from cps.services import author_enrichment
+from cps.services.enrichment_engine import EnrichmentEngine, enrichment_http, format_report
 from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
 
 
@@ -113,7 +114,6 @@ class TaskEnrichAuthors(CalibreTask):
         self.app_db_session = ub.get_new_session_instance()
 
     def run(self, worker_thread):
-        from cps import services
         try:
             self.log.info("=== TaskEnrichAuthors STARTING ===")
             with app.app_context():
@@ -166,44 +166,37 @@ class TaskEnrichAuthors(CalibreTask):
                     self._handleSuccess()
                     return
 
+                isbn_hints = self.get_isbn_hints(calibre_db.session)
+                existing = {a.author_id: a for a in self.app_db_session.query(ub.AuthorInfo).all()}
+                enrichment_http.configure(config.config_enrichment_rate, config.config_enrichment_burst,
+                                          config.config_enrichment_workers)
+                engine = EnrichmentEngine(author_enrichment.SOURCES, workers=config.config_enrichment_workers)
+                jobs = ((author.id, author.name.replace('|', ','), isbn_hints.get(author.id))
+                        for author in authors_to_process)
                 processed = 0
-                updated = 0
-                
-                for index, author in enumerate(authors_to_process):
-                    if self.stat == STAT_CANCELLED or self.stat == STAT_ENDED:
-                        self.log.info("Task cancelled after processing %d authors", processed)
-                        self.app_db_session.commit()
-                        return
-
-                    author_name = author.name.replace('|', ',')
-                    is_new = author.id in new_authors
-                    
-                    # Defer commit to the bulk loop
-                    services.author_enrichment.get_author_info(
-                        author.id, 
-                        author_name, 
-                        force_refresh=True,
-                        is_initial_load=is_new,
-                        commit=False
-                    )
-                    
+                for author_id, author_name, results in engine.run(jobs, self.is_stopped):
+                    new_data = author_enrichment.merge_author_results(author_name, results)
+                    author_enrichment.store_author_info(self.app_db_session, existing.get(author_id), author_id,
+                                                        author_name, new_data, force_refresh=True,
+                                                        is_initial_load=author_id in new_authors)
                     processed += 1
-                    updated += 1 # We assume change if force_refresh is on, or we could check hash
-                    
-                    # Yield CPU and check for cancellation
                     self.yield_cpu()
-                    
-                    # Be nice to external APIs
-                    time.sleep(1)
-                    
+
                     # Batch commit every 10 authors
                     if processed % 10 == 0:
                         self.app_db_session.commit()
-                        self.progress = (index + 1) / total
-                        self.message = N_('Processed %(count)d of %(total)d authors', 
-                                         count=index+1, total=total)
+                        self.progress = processed / total
+                        self.message = N_('Processed %(count)d of %(total)d authors',
+                                         count=processed, total=total)
 
                 self.app_db_session.commit()
+                report = engine.report()
+                self.log.info(format_report(report))
+                if self.is_stopped():
+                    self.log.info("Task cancelled after processing %d authors", processed)
+                    return
+                self.message = N_('Processed %(count)d authors, %(rate)s per minute',
+                                  count=processed, rate=report["authors_per_minute"])
                 self.log.info("=== TaskEnrichAuthors COMPLETED: Processed %d authors ===", processed)
                 self._handleSuccess()
                 
@@ -213,6 +206,22 @@ class TaskEnrichAuthors(CalibreTask):
         finally:
             self.app_db_session.remove()
 
+    def is_stopped(self):
+        return self.stat in (STAT_CANCELLED, STAT_ENDED)
+
+    @staticmethod
+    def get_isbn_hints(session):
+        """Returns dict author id -> isbn of one of the books of the author, helps the sources to find the author"""
+        hints = dict()
+        rows = (session.query(db.books_authors_link.c.author, db.Books.isbn)
+                .join(db.Books, db.Books.id == db.books_authors_link.c.book)
+                .filter(db.Books.isbn != ""))
+        for author_id, isbn in rows:
+            isbn = isbn.strip().replace('-', '')
+            if len(isbn) >= 10:
+                hints.setdefault(author_id, isbn)
+        return hints
+
     @property
     def name(self):
         return "Enrich Authors"
@@ -21,7 +21,7 @@ import datetime
 from flask_babel import lazy_gettext as N_
 from sqlalchemy.sql.expression import or_
 
-from cps import logger, file_helper, ub
+from cps import logger, file_helper, ub, db, app, library_changes
 from cps.services.worker import CalibreTask
 
 
@@ -51,6 +51,16 @@ class TaskClean(CalibreTask):
             self._handleError('Error deleting expired session keys: ' + str(ex))
             self.app_db_session.rollback()
             return
+        # drop old entries of the library change feed
+        try:
+            pruned = library_changes.prune(self.app_db_session)
+            self.app_db_session.commit()
+            self.log.debug("Deleted {} old library change entries".format(pruned))
+        except Exception as ex:
+            self.log.debug('Error deleting old library change entries: ' + str(ex))
+            self._handleError('Error deleting old library change entries: ' + str(ex))
+            self.app_db_session.rollback()
+            return
 
         self._handleSuccess()
         self.app_db_session.remove()
@@ -62,3 +72,41 @@ class TaskClean(CalibreTask):
     @property
     def is_cancellable(self):
         return False
+
+
+class TaskCleanDownloads(CalibreTask):
+    def __init__(self, task_message=N_('Delete download entries of deleted books')):
+        super(TaskCleanDownloads, self).__init__(task_message)
+        self.log = logger.create()
+        self.app_db_session = ub.get_new_session_instance()
+
+    def run(self, worker_thread):
+        # The hot books list ignores downloads of books which no longer exist, they are removed here
+        try:
+            with app.app_context():
+                calibre_db = db.CalibreDB(app)
+                stale_ids = [entry.book_id for entry in
+                             calibre_db.session.query(ub.Downloads.book_id)
+                             .outerjoin(db.Books, db.Books.id == ub.Downloads.book_id)
+                             .filter(db.Books.id == None)
+                             .distinct()]
+            if stale_ids:
+                self.app_db_session.query(ub.Downloads).filter(ub.Downloads.book_id.in_(stale_ids))\
+                    .delete(synchronize_session=False)
+                self.app_db_session.commit()
+                self.log.debug("Deleted download entries of {} deleted books".format(len(stale_ids)))
+            self._handleSuccess()
+        except Exception as ex:
+            self.log.debug('Error deleting stale download entries: ' + str(ex))
+            self._handleError('Error deleting stale download entries: ' + str(ex))
+            self.app_db_session.rollback()
+        finally:
+            self.app_db_session.remove()
+
+    @property
+    def name(self):
+        return "Clean up downloads"
+
+    @property
+    def is_cancellable(self):
+        return False
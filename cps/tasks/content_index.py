@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Updates the full-text index of book contents, only books whose indexed file changed are extracted again
+
+import os
+
+from flask_babel import lazy_gettext as N_
+
+from cps import config, logger, db, app
+from cps.content_index import content_index, extract_text, CONTENT_FORMATS
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
+
+# Extracted documents written to the index in one transaction
+STORE_BATCH = 20
+
+
+class TaskUpdateContentIndex(CalibreTask):
+    def __init__(self, rebuild=False, task_message=N_('Updating full-text index of book contents')):
+        super(TaskUpdateContentIndex, self).__init__(task_message)
+        self.log = logger.create()
+        self.rebuild = rebuild
+
+    def run(self, worker_thread):
+        if config.config_use_google_drive:
+            self.log.info("Book contents on Google Drive are not indexed")
+            self._handleSuccess()
+            return
+        if not content_index.available:
+            self._handleError("Full-text index is not available, sqlite lacks FTS5 support")
+            return
+        try:
+            with app.app_context():
+                calibre_db = db.CalibreDB(app)
+                books = self.get_indexable_files(calibre_db.session)
+            if self.rebuild:
+                content_index.clear()
+            self.update_index(books)
+        except Exception as ex:
+            self.log.error_or_exception(ex)
+            self._handleError("Updating full-text index failed: {}".format(ex))
+            return
+        finally:
+            content_index.progress = None
+        if self.stat not in (STAT_CANCELLED, STAT_ENDED):
+            self._handleSuccess()
+
+    @staticmethod
+    def get_indexable_files(session):
+        """Returns dict book_id -> (format, file path) of the preferred indexable format of every book"""
+        files = dict()
+        rows = (session.query(db.Books.id, db.Books.path, db.Data.name, db.Data.format)
+                .join(db.Data, db.Data.book == db.Books.id)
+                .filter(db.Data.format.in_(CONTENT_FORMATS)))
+        for book_id, path, name, book_format in rows:
+            book_format = book_format.upper()
+            current = files.get(book_id)
+            if current is None or CONTENT_FORMATS.index(book_format) < CONTENT_FORMATS.index(current[0]):
+                files[book_id] = (book_format, os.path.join(config.get_book_path(), path,
+                                                            name + "." + book_format.lower()))
+        return files
+
+    def update_index(self, books):
+        state = content_index.get_state()
+        removed = [book_id for book_id in state if book_id not in books]
+        if removed:
+            content_index.remove(removed)
+        pending = []
+        extracted = 0
+        content_index.progress = (0, len(books))
+        for done, (book_id, (book_format, file_path)) in enumerate(books.items(), 1):
+            if self.stat in (STAT_CANCELLED, STAT_ENDED):
+                break
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                if book_id in state:
+                    content_index.remove([book_id])
+                continue
+            if state.get(book_id) != (book_format, file_stat.st_mtime, file_stat.st_size):
+                status, text = extract_text(file_path, book_format)
+                pending.append((book_id, book_format, file_stat.st_mtime, file_stat.st_size, status, text))
+                extracted += 1
+                if len(pending) >= STORE_BATCH:
+                    content_index.store(pending)
+                    pending = []
+                self.yield_cpu()
+            content_index.progress = (done, len(books))
+            self.progress = done / len(books)
+        if pending:
+            content_index.store(pending)
+        self.log.info("Full-text index: %d books extracted, %d removed, %d unchanged",
+                      extracted, len(removed), len(books) - extracted)
+
+    @property
+    def name(self):
+        return "Full-Text Index"
+
+    @property
+    def is_cancellable(self):
+        return True
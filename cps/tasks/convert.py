@@ -28,7 +28,7 @@ from sqlalchemy.exc import SQLAlchemyError
 from flask_babel import lazy_gettext as N_
 
 from cps.services.worker import CalibreTask
-from cps import db, app
+from cps import db, ub, app, library_changes
 from cps import logger, config
 from cps.subproc_wrapper import process_open
 from flask_babel import gettext as _
@@ -191,10 +191,12 @@ class TaskConvert(CalibreTask):
                         try:
                             local_db.session.merge(new_format)
                             local_db.session.commit()
+                            ub_session = init_db_thread()
                             if self.settings['new_book_format'].upper() in ['KEPUB', 'EPUB', 'EPUB3']:
-                                ub_session = init_db_thread()
                                 remove_synced_book(book_id, True, ub_session)
-                                ub_session.close()
+                            else:
+                                library_changes.record(book_id, ub.LibraryChange.TYPE_MODIFIED, session=ub_session)
+                            ub_session.close()
                         except SQLAlchemyError as e:
                             local_db.session.rollback()
                             log.error("Database error: %s", e)
@@ -19,7 +19,7 @@
 from flask_babel import lazy_gettext as N_
 
 from cps import config, logger, db, ub, app
-from cps.services.worker import CalibreTask
+from cps.services.worker import CalibreTask, STAT_CANCELLED, STAT_ENDED
 from sqlalchemy.sql.expression import text
 
 
@@ -75,3 +75,103 @@ class TaskDatabaseHealthCheck(CalibreTask):
     @property
     def is_cancellable(self):
         return False
+
+
+class TaskBuildSearchIndex(CalibreTask):
+    def __init__(self, task_message=N_('Building search index')):
+        super(TaskBuildSearchIndex, self).__init__(task_message)
+        self.log = logger.create()
+
+    def run(self, worker_thread):
+        from cps.search_index import search_index
+        if not config.db_configured:
+            self._handleSuccess()
+            return
+        try:
+            with app.app_context():
+                calibre_db = db.CalibreDB(app)
+                search_index.build(calibre_db.session)
+        except Exception as ex:
+            self.log.error_or_exception("Building search index failed: {}".format(ex))
+            self._handleError(str(ex))
+            return
+        self._handleSuccess()
+
+    @property
+    def name(self):
+        return "Build Search Index"
+
+    @property
+    def is_cancellable(self):
+        return False
+
+
+class TaskBuildDocumentIndex(CalibreTask):
+    """Builds the document index at startup, afterwards it applies the library changes, queued by sync requests"""
+    def __init__(self, task_message=N_('Building KOReader document index')):
+        super(TaskBuildDocumentIndex, self).__init__(task_message)
+        self.log = logger.create()
+
+    def run(self, worker_thread):
+        from cps.document_index import document_index
+        if not config.db_configured:
+            self._handleSuccess()
+            return
+        try:
+            with app.app_context():
+                calibre_db = db.CalibreDB(app)
+                if document_index.ready:
+                    document_index.refresh(config, calibre_db.session)
+                else:
+                    document_index.build(calibre_db.session,
+                                         None if config.config_use_google_drive else config.get_book_path())
+        except Exception as ex:
+            self.log.error_or_exception("Building document index failed: {}".format(ex))
+            self._handleError(str(ex))
+            return
+        finally:
+            document_index.refresh_done()
+        self._handleSuccess()
+
+    @property
+    def name(self):
+        return "Build Document Index"
+
+    @property
+    def is_cancellable(self):
+        return False
+
+
+class TaskBuildEpubStructure(CalibreTask):
+    def __init__(self, task_message=N_('Reading epub structure')):
+        super(TaskBuildEpubStructure, self).__init__(task_message)
+        self.log = logger.create()
+
+    def run(self, worker_thread):
+        from cps.epub_structure import structure_cache
+        if not config.db_configured or config.config_use_google_drive:
+            self._handleSuccess()
+            return
+        session = ub.get_new_session_instance()
+        try:
+            with app.app_context():
+                calibre_db = db.CalibreDB(app)
+                parsed = structure_cache.update(session, calibre_db.session, config.get_book_path(),
+                                                should_stop=lambda: self.stat in (STAT_CANCELLED, STAT_ENDED))
+                self.log.debug("Epub structure of %d files read", parsed)
+        except Exception as ex:
+            session.rollback()
+            self.log.error_or_exception("Reading epub structure failed: {}".format(ex))
+            self._handleError(str(ex))
+            return
+        finally:
+            session.close()
+        self._handleSuccess()
+
+    @property
+    def name(self):
+        return "Read Epub Structure"
+
+    @property
+    def is_cancellable(self):
+        return True
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from flask_babel import lazy_gettext as N_
-from cps import helper, config, logger, app
+from cps import helper, config, logger, app, calibre_db
 from cps.services.worker import CalibreTask
 
 log = logger.create()
@@ -31,3 +31,37 @@ class TaskUpdateMetadata(CalibreTask):
     @property
     def is_cancellable(self):
         return False
+
+
+class TaskBulkUpdateMetadata(CalibreTask):
+    """Renames the folders and files of many edited books after their changes were committed at once"""
+    def __init__(self, books):
+        super(TaskBulkUpdateMetadata, self).__init__(N_("Updating book metadata and files"))
+        # list of (book id, new first author or None)
+        self.books = books
+
+    def run(self, worker_thread):
+        errors = []
+        with app.app_context():
+            for index, (book_id, first_author) in enumerate(self.books):
+                error = helper.update_dir_structure(book_id, config.get_book_path(), first_author)
+                if error:
+                    log.error("Background metadata update of book %s failed: %s", book_id, error)
+                    errors.append(error)
+                    calibre_db.session.rollback()
+                else:
+                    # the new path of the book
+                    calibre_db.session.commit()
+                self.progress = (index + 1) / len(self.books)
+        if errors:
+            self._handleError("; ".join(errors[:5]))
+        else:
+            self._handleSuccess()
+
+    @property
+    def name(self):
+        return N_("Bulk Update Metadata")
+
+    @property
+    def is_cancellable(self):
+        return False
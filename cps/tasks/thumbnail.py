@@ -455,6 +455,168 @@ class TaskGenerateSeriesThumbnails(CalibreTask):
         return True
 
 
+class TaskGenerateAuthorThumbnails(CalibreTask):
+    def __init__(self, author_id=-1, task_message=''):
+        super(TaskGenerateAuthorThumbnails, self).__init__(task_message)
+        self.log = logger.create()
+        self.author_id = author_id
+        self.app_db_session = ub.get_new_session_instance()
+        self.cache = fs.FileSystem()
+        self.resolutions = [
+            constants.COVER_THUMBNAIL_SMALL,
+            constants.COVER_THUMBNAIL_MEDIUM,
+        ]
+
+    def run(self, worker_thread):
+        if use_IM and self.stat != STAT_CANCELLED and self.stat != STAT_ENDED:
+            self.message = 'Scanning Authors'
+            try:
+                authors = self.get_authors_with_images(self.author_id)
+                if self.author_id == -1:
+                    self.delete_orphaned_thumbnails(authors)
+            except Exception as ex:
+                self.log.error_or_exception(ex)
+                self._handleError('Error scanning author images: ' + str(ex))
+                self.app_db_session.remove()
+                return
+            count = len(authors)
+
+            total_generated = 0
+            for i, author_info in enumerate(authors):
+                total_generated += self.create_author_thumbnails(author_info)
+
+                # Increment the progress
+                self.progress = (1.0 / count) * i
+                if total_generated > 0:
+                    self.message = N_('Generated %(count)s author thumbnails', count=total_generated)
+
+                # Check if job has been cancelled or ended
+                if self.stat == STAT_CANCELLED:
+                    self.log.info('GenerateAuthorThumbnails task has been cancelled.')
+                    return
+
+                if self.stat == STAT_ENDED:
+                    self.log.info('GenerateAuthorThumbnails task has been ended.')
+                    return
+
+            if total_generated == 0:
+                self.self_cleanup = True
+
+        self._handleSuccess()
+        self.app_db_session.remove()
+
+    def get_authors_with_images(self, author_id=-1):
+        filter_exp = (ub.AuthorInfo.author_id == author_id) if author_id != -1 else True
+        authors = (self.app_db_session.query(ub.AuthorInfo)
+                   .filter(ub.AuthorInfo.image_url.isnot(None))
+                   .filter(ub.AuthorInfo.image_url != '')
+                   .filter(filter_exp)
+                   .all())
+        if author_id == -1:
+            # author info of authors removed from the library is kept, their images are not
+            with app.app_context():
+                calibre_db = db.CalibreDB(app)
+                author_ids = {row[0] for row in calibre_db.session.query(db.Authors.id)}
+            authors = [author_info for author_info in authors if author_info.author_id in author_ids]
+        return authors
+
+    def get_author_thumbnails(self, author_id):
+        return self.app_db_session \
+            .query(ub.Thumbnail) \
+            .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_AUTHOR) \
+            .filter(ub.Thumbnail.entity_id == author_id) \
+            .all()
+
+    def delete_orphaned_thumbnails(self, authors):
+        """Removes the thumbnails of authors which were deleted or have no image anymore"""
+        author_ids = {author_info.author_id for author_info in authors}
+        orphans = [thumbnail for thumbnail in self.app_db_session.query(ub.Thumbnail)
+                   .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_AUTHOR)
+                   if thumbnail.entity_id not in author_ids]
+        for thumbnail in orphans:
+            self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
+            self.app_db_session.delete(thumbnail)
+        if orphans:
+            self.app_db_session.commit()
+            self.log.info('Deleted %d orphaned author thumbnails', len(orphans))
+
+    def create_author_thumbnails(self, author_info):
+        thumbnails = self.get_author_thumbnails(author_info.author_id)
+        outdated = author_info.image_source != author_info.image_url
+        missing_resolutions = set(self.resolutions).difference(t.resolution for t in thumbnails)
+        missing_files = [t for t in thumbnails
+                         if not self.cache.get_cache_file_exists(t.filename, constants.CACHE_TYPE_THUMBNAILS)]
+        if not outdated and not missing_resolutions and not missing_files:
+            return 0
+
+        # The image is downloaded once, all resolutions are generated from it
+        try:
+            content = self.download_author_image(author_info.image_url)
+        except Exception as ex:
+            self.log.debug('Error downloading author image {}: {}'.format(author_info.image_url, ex))
+            return 0
+
+        generated = 0
+        try:
+            for thumbnail in thumbnails:
+                if outdated or thumbnail in missing_files:
+                    thumbnail.generated_at = datetime.now(timezone.utc)
+                    self.cache.delete_cache_file(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS)
+                    self.generate_author_thumbnail(content, thumbnail)
+                    generated += 1
+            for resolution in missing_resolutions:
+                thumbnail = ub.Thumbnail()
+                thumbnail.type = constants.THUMBNAIL_TYPE_AUTHOR
+                thumbnail.entity_id = author_info.author_id
+                thumbnail.format = 'jpeg'
+                thumbnail.resolution = resolution
+                self.app_db_session.add(thumbnail)
+                # the filename is set on insert
+                self.app_db_session.flush()
+                self.generate_author_thumbnail(content, thumbnail)
+                generated += 1
+            author_info.image_source = author_info.image_url
+            self.app_db_session.commit()
+        except Exception as ex:
+            self.log.debug('Error creating author thumbnail: ' + str(ex))
+            self.app_db_session.rollback()
+            return 0
+        return generated
+
+    @staticmethod
+    def download_author_image(url):
+        # imported here, the enrichment engine is only needed by background tasks
+        from cps.services.enrichment_engine import enrichment_http
+        response = enrichment_http.get(url, cached=False, timeout=30)
+        response.raise_for_status()
+        if not response.headers.get('Content-Type', '').startswith('image/'):
+            raise Exception('Not an image: ' + response.headers.get('Content-Type', ''))
+        return response.content
+
+    def generate_author_thumbnail(self, content, thumbnail):
+        with Image(blob=content) as img:
+            height = get_resize_height(thumbnail.resolution)
+            if img.height > height:
+                width = get_resize_width(thumbnail.resolution, img.width, img.height)
+                img.resize(width=width, height=height, filter='lanczos')
+            img.format = thumbnail.format
+            img.save(filename=self.cache.get_cache_file_path(thumbnail.filename, constants.CACHE_TYPE_THUMBNAILS))
+
+    @property
+    def name(self):
+        return N_('Author Thumbnails')
+
+    def __str__(self):
+        if self.author_id > 0:
+            return "Add Author Thumbnails for Author {}".format(self.author_id)
+        else:
+            return "Generate Author Thumbnails"
+
+    @property
+    def is_cancellable(self):
+        return True
+
+
 class TaskClearCoverThumbnailCache(CalibreTask):
     def __init__(self, book_id, task_message=N_('Clearing cover thumbnail cache')):
         super(TaskClearCoverThumbnailCache, self).__init__(task_message)
@@ -471,6 +633,7 @@ class TaskClearCoverThumbnailCache(CalibreTask):
                     calibre_db = db.CalibreDB(app)
                     thumbnails = (calibre_db.session.query(ub.Thumbnail)
                                   .join(db.Books, ub.Thumbnail.entity_id == db.Books.id, isouter=True)
+                                  .filter(ub.Thumbnail.type == constants.THUMBNAIL_TYPE_COVER)
                                   .filter(db.Books.id==None)
                                   .all())
                     # calibre_db.session.close()
@@ -16,11 +16,28 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import multiprocessing
+import os
+import shutil
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
-from flask_babel import lazy_gettext as N_
+from flask import g
+from flask_babel import lazy_gettext as N_, gettext as _
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
-from cps.services.worker import CalibreTask, STAT_FINISH_SUCCESS
+from cps import app, config, db, ub, logger, helper, uploader, gdriveutils, library_changes
+from cps.epub_structure import structure_cache
+from cps.services.worker import CalibreTask, STAT_FINISH_SUCCESS, STAT_CANCELLED, STAT_ENDED
+from cps.string_helper import split_authors
+
+# Processes reading metadata and covers of uploaded files at once
+MAX_EXTRACT_WORKERS = 4
+# Uploaded books written to the database in one transaction
+BATCH_SIZE = 25
 
 
 class TaskUpload(CalibreTask):
@@ -44,3 +61,269 @@ class TaskUpload(CalibreTask):
     @property
     def is_cancellable(self):
         return False
+
+
+class TaskImportUploads(CalibreTask):
+    """Imports the files of a multi file upload. Files with the content of a file in the library or of an earlier file
+    of the upload are rejected, the metadata and covers of the remaining files are extracted in a process pool and
+    the books are written to the database in batches. A file with the title and first author of a book missing its
+    format is added to that book"""
+    def __init__(self, files, user_id):
+        super(TaskImportUploads, self).__init__(N_("Importing uploaded books"))
+        # list of (temp file path, uploaded file name, sha256)
+        self.files = files
+        self.user_id = user_id
+        self.log = logger.create()
+        self.imported = self.merged = self.duplicates = self.failed = 0
+
+    @property
+    def stopped(self):
+        return self.stat in (STAT_CANCELLED, STAT_ENDED)
+
+    def run(self, worker_thread):
+        try:
+            files = self._reject_duplicates()
+            metas = self._extract(files)
+            if not self.stopped:
+                self._import(metas)
+        except Exception as ex:
+            self.log.error_or_exception("Importing uploaded books failed: {}".format(ex))
+            self._handleError(str(ex))
+            return
+        finally:
+            for tmp_file_path, __, __ in self.files:
+                if os.path.exists(tmp_file_path):
+                    os.remove(tmp_file_path)
+        self.message = self._summary()
+        if self.stopped:
+            return
+        if self.failed and not self.imported and not self.merged:
+            self._handleError(self.message)
+        else:
+            self._handleSuccess()
+
+    def _summary(self):
+        return _("%(imported)d books imported, %(merged)d formats added to existing books, %(duplicates)d duplicates "
+                 "rejected, %(failed)d failed", imported=self.imported, merged=self.merged,
+                 duplicates=self.duplicates, failed=self.failed)
+
+    def _reject_duplicates(self):
+        """Returns the files whose content is neither in the library nor an earlier file of the upload. Only library
+        files with the same format and size are hashed"""
+        remaining = list()
+        seen = set()
+        with app.app_context():
+            calibre_db = db.CalibreDB(app)
+            for tmp_file_path, file_name, digest in self.files:
+                duplicate = digest in seen
+                if not duplicate and not config.config_use_google_drive:
+                    file_format = os.path.splitext(file_name)[1][1:].upper()
+                    candidates = (calibre_db.session.query(db.Books.path, db.Data.name)
+                                  .join(db.Data, db.Data.book == db.Books.id)
+                                  .filter(db.Data.format == file_format,
+                                          db.Data.uncompressed_size == os.path.getsize(tmp_file_path)))
+                    for path, name in candidates:
+                        library_file = os.path.join(config.get_book_path(), path, name + "." + file_format.lower())
+                        try:
+                            if uploader.file_sha256(library_file) == digest:
+                                duplicate = True
+                                break
+                        except OSError:
+                            continue
+                if duplicate:
+                    self.log.info("Uploaded file %s is already in the library", file_name)
+                    self.duplicates += 1
+                    os.remove(tmp_file_path)
+                else:
+                    seen.add(digest)
+                    remaining.append((tmp_file_path, file_name))
+        self.progress = 0.1
+        return remaining
+
+    @staticmethod
+    def _start_method():
+        # The server runs the scheduler, updater and worker threads, a forked child could inherit a lock (logging,
+        # sqlite) held by one of them and block forever. The workers are started from a fresh interpreter instead
+        # and only import the uploader module, the app isn't set up there
+        methods = multiprocessing.get_all_start_methods()
+        return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+    def _extract(self, files):
+        """Returns list of (file name, meta) in upload order, files whose metadata can't be read are left out"""
+        metas = [None] * len(files)
+        if not files:
+            return []
+        rar_executable = config.config_rarfile_location
+        workers = min(MAX_EXTRACT_WORKERS, os.cpu_count() or 1, len(files))
+        finished = set()
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        mp_context=self._start_method()) as executor:
+                futures = {executor.submit(uploader.process_upload, tmp_file_path, file_name, rar_executable): index
+                           for index, (tmp_file_path, file_name) in enumerate(files)}
+                for future in concurrent.futures.as_completed(futures):
+                    if self.stopped:
+                        for pending in futures:
+                            pending.cancel()
+                        break
+                    index = futures[future]
+                    try:
+                        metas[index] = future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as ex:
+                        self.log.error("Reading metadata of %s failed: %s", files[index][1], ex)
+                        self.failed += 1
+                    finished.add(index)
+                    self.progress = 0.1 + 0.5 * len(finished) / len(files)
+        except (BrokenProcessPool, OSError) as ex:
+            self.log.warning("Metadata extraction pool failed, reading remaining files in this thread: %s", ex)
+            for index, (tmp_file_path, file_name) in enumerate(files):
+                if index in finished or self.stopped:
+                    continue
+                try:
+                    metas[index] = uploader.process_upload(tmp_file_path, file_name, rar_executable)
+                except Exception as ex:
+                    self.log.error("Reading metadata of %s failed: %s", file_name, ex)
+                    self.failed += 1
+                finished.add(index)
+                self.progress = 0.1 + 0.5 * len(finished) / len(files)
+        return [(file_name, meta) for (__, file_name), meta in zip(files, metas) if meta is not None]
+
+    def _import(self, metas):
+        from cps import calibre_db, editbooks
+        session = ub.get_new_session_instance()
+        try:
+            user = session.query(ub.User).filter(ub.User.id == self.user_id).first()
+            with app.test_request_context():
+                # the book creation checks the language filter of the uploading user
+                g._login_user = user
+                calibre_db.create_functions(config)
+                for start in range(0, len(metas), BATCH_SIZE):
+                    if self.stopped:
+                        break
+                    self._import_batch(calibre_db, editbooks, metas[start:start + BATCH_SIZE])
+                    self.progress = 0.6 + 0.4 * min(1.0, (start + BATCH_SIZE) / len(metas))
+                if config.config_use_google_drive:
+                    gdriveutils.updateGdriveCalibreFromLocal()
+        finally:
+            session.close()
+
+    def _import_batch(self, calibre_db, editbooks, metas):
+        added = list()
+        merged = list()
+        # book folders and added format files of the batch, removed again if the batch can't be committed
+        moved = list()
+        self._begin(calibre_db.session)
+        for file_name, meta in metas:
+            if meta.author == "Unknown":
+                # the extraction ran without translations
+                meta = meta._replace(author=_("Unknown"))
+            target = None
+            try:
+                # a failing file only rolls back its own book
+                with calibre_db.session.begin_nested():
+                    book = self._existing_book(calibre_db, meta)
+                    if book:
+                        target = self._add_format(calibre_db, book, meta)
+                    else:
+                        db_book, error = editbooks.add_uploaded_book(meta)
+                        if not config.config_use_google_drive:
+                            target = os.path.join(config.get_book_path(), db_book.path)
+                        if error:
+                            raise OSError(error)
+                    calibre_db.session.flush()
+            except (OSError, IOError, OperationalError, IntegrityError, StaleDataError) as ex:
+                self.log.error("Importing %s failed: %s", file_name, ex)
+                self._remove_moved([target])
+                self.failed += 1
+                continue
+            if book:
+                merged.append(book.id)
+            else:
+                added.append(db_book.id)
+            moved.append(target)
+        try:
+            calibre_db.session.commit()
+        except (OperationalError, IntegrityError, StaleDataError) as ex:
+            calibre_db.session.rollback()
+            self.log.error_or_exception("Database error: {}".format(ex))
+            self._remove_moved(moved)
+            self.failed += len(added) + len(merged)
+            return
+        self.imported += len(added)
+        self.merged += len(merged)
+        if added:
+            library_changes.record(added, ub.LibraryChange.TYPE_ADDED)
+        if merged:
+            library_changes.record(merged, ub.LibraryChange.TYPE_MODIFIED)
+        if not config.config_use_google_drive:
+            try:
+                structure_cache.update(ub.session, calibre_db.session, config.get_book_path(), added + merged)
+            except (OperationalError, IntegrityError) as ex:
+                ub.session.rollback()
+                self.log.error_or_exception(ex)
+        for book_id in added:
+            helper.add_book_to_thumbnail_cache(book_id)
+        calibre_db.clear_cache()
+
+    @staticmethod
+    def _existing_book(calibre_db, meta):
+        """Book with the exact title and first author of the file which doesn't have its format yet"""
+        if config.config_use_google_drive or meta.title == _("Unknown") or meta.author == _("Unknown"):
+            return None
+        first_author = split_authors([meta.author])[0]
+        file_format = meta.extension.upper()[1:]
+        return (calibre_db.session.query(db.Books)
+                .filter(func.lower(db.Books.title) == meta.title.lower(),
+                        db.Books.authors.any(func.lower(db.Authors.name) == first_author.lower()),
+                        ~db.Books.data.any(db.Data.format == file_format))
+                .first())
+
+    @staticmethod
+    def _add_format(calibre_db, book, meta):
+        """Moves the file into the folder of the book and adds the format, returns the path of the file"""
+        file_name = book.data[0].name if book.data else book.path.rsplit('/', 1)[-1]
+        file_path = os.path.join(config.get_book_path(), book.path)
+        os.makedirs(file_path, exist_ok=True)
+        target = os.path.join(file_path, file_name + meta.extension.lower())
+        shutil.move(meta.file_path, target)
+        if meta.cover and os.path.exists(meta.cover):
+            os.remove(meta.cover)
+        calibre_db.session.add(db.Data(book.id, meta.extension.upper()[1:], os.path.getsize(target), file_name))
+        return target
+
+    @staticmethod
+    def _begin(session):
+        # pysqlite opens a transaction only before changing data, a savepoint issued first would open a transaction
+        # of its own which is committed on release
+        connection = session.connection()
+        if not connection.connection.driver_connection.in_transaction:
+            connection.exec_driver_sql("BEGIN")
+
+    def _remove_moved(self, paths):
+        """Removes book folders and format files of books which were rolled back"""
+        for path in paths:
+            if not path or not os.path.exists(path):
+                continue
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                    # the author folder if the book was the only one of its author
+                    if not os.listdir(os.path.dirname(path)):
+                        os.rmdir(os.path.dirname(path))
+                else:
+                    os.remove(path)
+            except OSError as ex:
+                self.log.error("Removing %s of a failed upload failed: %s", path, ex)
+
+    @property
+    def name(self):
+        return "Import Uploads"
+
+    def __str__(self):
+        return "Import Uploads of {} files".format(len(self.files))
+
+    @property
+    def is_cancellable(self):
+        return True
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+# Matching of the book entries of mobile reader backups (Librera, Moon+ Reader, ReadEra) to the books of the library.
+# Titles, authors, series and stored file names of all books are normalized once per import (lowercase, accents
+# folded like the lcase function of the database, punctuation stripped, leading zeros of numbers removed) and held in
+# dictionaries, so an entry is matched by a few lookups, in order of confidence: the calibre id of "Title (id)" names,
+# the stored file name, title and author, the title alone, the title without series numbering and series name plus
+# series index. Entries matching nothing exactly are compared by similarity with the titles sharing their rarest words.
+
+import re
+from collections import namedtuple
+from difflib import SequenceMatcher
+
+from . import db
+
+Match = namedtuple("Match", ["book_id", "confidence", "method"])
+
+CONFIDENCE_ID = 1.0
+CONFIDENCE_FILE = 1.0
+CONFIDENCE_TITLE_AUTHOR = 0.95
+CONFIDENCE_TITLE = 0.9
+CONFIDENCE_SERIES = 0.8
+CONFIDENCE_AMBIGUOUS = 0.7
+# Minimum similarity of a fuzzy match, its confidence is the similarity scaled by FUZZY_WEIGHT
+FUZZY_CUTOFF = 0.85
+FUZZY_WEIGHT = 0.9
+MAX_FUZZY_CANDIDATES = 500
+
+BOOK_EXTENSIONS = ('.epub', '.kepub', '.mobi', '.azw', '.azw3', '.pdf', '.docx', '.fb2', '.cbz', '.cbr', '.html',
+                   '.txt', '.djvu', '.rtf')
+
+_punctuation = re.compile(r"[\W_]+", re.UNICODE)
+_leading_zeros = re.compile(r"\b0+(\d)")
+_calibre_id = re.compile(r"\((\d+)\)$")
+# "(Foundation #2)", "[Discworld 12]" at the end and "02 - ", "Book 2: " at the start of a title
+_series_suffix = re.compile(r"\s*[(\[][^)\]]*\d[^)\]]*[)\]]\s*$")
+_series_prefix = re.compile(r"^\s*(?:(?:book|vol|volume|part|tome|band)\.?\s*)?#?\d+(?:\.\d+)?\s*[-:.)]\s*",
+                            re.IGNORECASE)
+_series_number = re.compile(r"^(.*?)\s*#?\s*(\d+(?:\.\d+)?)$")
+
+
+def normalize(value):
+    value = _punctuation.sub(" ", db.lcase(value or ""))
+    return _leading_zeros.sub(r"\1", " ".join(value.split()))
+
+
+def author_words(name):
+    # initials are left out, they are written in too many ways
+    return {word for word in normalize(name).split() if len(word) > 1 or word.isdigit()}
+
+
+def strip_extension(name):
+    name = (name or "").strip()
+    if name.lower().endswith(BOOK_EXTENSIONS):
+        name = name[:name.rindex(".")]
+    return name.strip()
+
+
+def strip_series(title):
+    return _series_prefix.sub("", _series_suffix.sub("", title))
+
+
+def format_index(series_index):
+    """Series index of the database as written in names, 2.0 -> "2" """
+    try:
+        number = float(series_index)
+    except (TypeError, ValueError):
+        return None
+    return str(int(number)) if number.is_integer() else str(number)
+
+
+class TitleMatcher:
+    def __init__(self, session):
+        self._books = set()
+        self._titles = dict()
+        self._stripped = dict()
+        self._files = dict()
+        self._series = dict()
+        self._authors = dict()
+        self._words = dict()
+        self._load(session)
+
+    def _load(self, session):
+        for book_id, title in session.query(db.Books.id, db.Books.title):
+            self._books.add(book_id)
+            key = normalize(title)
+            self._titles.setdefault(key, []).append(book_id)
+            stripped = normalize(strip_series(title))
+            if stripped and stripped != key:
+                self._stripped.setdefault(stripped, []).append(book_id)
+            for word in set(key.split()):
+                self._words.setdefault(word, set()).add(key)
+        for book_id, name in (session.query(db.books_authors_link.c.book, db.Authors.name)
+                              .join(db.Authors, db.Authors.id == db.books_authors_link.c.author)):
+            self._authors.setdefault(book_id, set()).update(author_words(name.replace('|', ',')))
+        for book_id, name in session.query(db.Data.book, db.Data.name):
+            self._files.setdefault(normalize(name), []).append(book_id)
+        for book_id, name, series_index in (session.query(db.books_series_link.c.book, db.Series.name,
+                                                           db.Books.series_index)
+                                            .join(db.Series, db.Series.id == db.books_series_link.c.series)
+                                            .join(db.Books, db.Books.id == db.books_series_link.c.book)):
+            number = format_index(series_index)
+            if number is not None:
+                self._series.setdefault((normalize(name), number), []).append(book_id)
+
+    def _author_matches(self, book_id, words):
+        """Names match if the words of one are part of the other, "Tolkien" matches "J. R. R. Tolkien" """
+        book_words = self._authors.get(book_id, set())
+        return bool(words) and (words <= book_words or book_words <= words or len(words & book_words) >= 2)
+
+    def _pick(self, book_ids, author, confidence, method):
+        """Chooses the book of the author among books with the same title"""
+        if author:
+            words = author_words(author)
+            for book_id in book_ids:
+                if self._author_matches(book_id, words):
+                    return Match(book_id, round(min(1.0, confidence + 0.05), 2), method + "_author")
+        elif len(book_ids) == 1:
+            return Match(book_ids[0], confidence, method)
+        return Match(book_ids[0], min(confidence, CONFIDENCE_AMBIGUOUS), method)
+
+    @staticmethod
+    def _splits(name, author):
+        """(title, author, split) candidates of an entry, names of calibre files are "Title - Author". split is True
+        if the author was taken from the name"""
+        if author:
+            return [(name, author, False)]
+        parts = name.split(" - ")
+        splits = [(" - ".join(parts[:i]), " - ".join(parts[i:]), True) for i in range(len(parts) - 1, 0, -1)]
+        return splits + [(name, None, False)]
+
+    def _series_match(self, title):
+        match = _series_number.match(normalize(title))
+        if match:
+            return self._series.get((match.group(1), _leading_zeros.sub(r"\1", match.group(2))))
+        return None
+
+    def _fuzzy(self, key):
+        words = sorted((word for word in set(key.split()) if word in self._words), key=lambda w: len(self._words[w]))
+        candidates = set()
+        for word in words[:2]:
+            candidates.update(self._words[word])
+            if len(candidates) >= MAX_FUZZY_CANDIDATES:
+                break
+        best, best_ratio = None, FUZZY_CUTOFF
+        for candidate in list(candidates)[:MAX_FUZZY_CANDIDATES]:
+            matcher = SequenceMatcher(None, key, candidate)
+            if matcher.real_quick_ratio() >= best_ratio and matcher.quick_ratio() >= best_ratio:
+                ratio = matcher.ratio()
+                if ratio >= best_ratio:
+                    best, best_ratio = candidate, ratio
+        return best, best_ratio
+
+    def match(self, name, author=None):
+        """Returns the Match of the entry, None if no book matches"""
+        name = strip_extension(name.replace("_", " "))
+        id_match = _calibre_id.search(name)
+        if id_match and int(id_match.group(1)) in self._books:
+            return Match(int(id_match.group(1)), CONFIDENCE_ID, "id")
+        file_ids = self._files.get(normalize(name))
+        if file_ids and not author:
+            return self._pick(file_ids, None, CONFIDENCE_FILE, "file")
+        splits = self._splits(name, author)
+        for title, title_author, split in splits:
+            book_ids = self._titles.get(normalize(title))
+            if book_ids:
+                if split:
+                    # a split only counts if the rest of the name is the author
+                    words = author_words(title_author)
+                    book_ids = [book_id for book_id in book_ids if self._author_matches(book_id, words)]
+                    if book_ids:
+                        return Match(book_ids[0], CONFIDENCE_TITLE_AUTHOR, "title_author")
+                    continue
+                return self._pick(book_ids, title_author, CONFIDENCE_TITLE, "title")
+        for title, title_author, __ in splits:
+            stripped = normalize(strip_series(title))
+            book_ids = self._titles.get(stripped) or self._stripped.get(stripped) or self._series_match(title)
+            if book_ids:
+                return self._pick(book_ids, title_author, CONFIDENCE_SERIES, "series")
+        best, ratio = self._fuzzy(normalize(name))
+        if best is None and len(splits) > 1:
+            best, ratio = self._fuzzy(normalize(splits[0][0]))
+        if best is not None:
+            return self._pick(self._titles[best], splits[0][1], round(ratio * FUZZY_WEIGHT, 2), "fuzzy")
+        return None
@@ -40,7 +40,7 @@ except ImportError as e:
     except ImportError as e:
         OAuthConsumerMixin = BaseException
         oauth_support = False
-from sqlalchemy import create_engine, exc, exists, event, text
+from sqlalchemy import create_engine, exc, exists, event, text, inspect
 from sqlalchemy import Column, ForeignKey
 from sqlalchemy import String, Integer, SmallInteger, Boolean, DateTime, Float, JSON
 from sqlalchemy.orm.attributes import flag_modified
@@ -129,12 +129,6 @@ def store_ids(result):
         ids.append(element.id)
     searched_ids[current_user.id] = ids
 
-def store_combo_ids(result):
-    ids = list()
-    for element in result:
-        ids.append(element[0].id)
-    searched_ids[current_user.id] = ids
-
 
 class UserBase:
 
@@ -544,6 +538,76 @@ class KoboStatistics(Base):
     spent_reading_minutes = Column(Integer)
 
 
+# Serialized Kobo metadata of a book with a placeholder for the download url base, only valid for the stored
+# last_modified timestamp
+class KoboMetadataCache(Base):
+    __tablename__ = 'kobo_metadata_cache'
+
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, index=True)
+    last_modified = Column(String)
+    metadata_json = Column(String)
+
+
+# Structure of an epub/kepub file (layout, spine, cover, OPF version), only valid for the stored size and modification
+# time of the file
+class EpubStructure(Base):
+    __tablename__ = 'epub_structure'
+
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, index=True)
+    format = Column(String)
+    size = Column(Integer)
+    mtime = Column(Float)
+    layout = Column(String)
+    spine_length = Column(Integer)
+    page_count = Column(Integer)
+    cover_href = Column(String)
+    opf_version = Column(String)
+
+
+# Backup files of mobile reading apps processed by the mobile sync, a file with unchanged size and modification time
+# or content is not read again
+class MobileBackup(Base):
+    __tablename__ = 'mobile_backup'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
+    path = Column(String)
+    size = Column(Integer)
+    mtime = Column(Float)
+    content_hash = Column(String)
+    entries = Column(Integer, default=0)
+    processed_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+# Append-only feed of library changes, the id is used as sequence number by consumers (Kobo sync, caches).
+# Entries without user_id are relevant for all users, entries with user_id only for this user (shelves, archive, ...)
+class LibraryChange(Base):
+    __tablename__ = 'library_change'
+
+    TYPE_ADDED = 0
+    TYPE_MODIFIED = 1
+    TYPE_DELETED = 2
+    TYPE_EXTERNAL = 3
+    TYPE_USER = 4
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    book_id = Column(Integer, nullable=True)
+    user_id = Column(Integer, nullable=True)
+    change_type = Column(SmallInteger, nullable=False)
+    timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+    def __repr__(self):
+        return '<LibraryChange %d book:%r type:%d>' % (self.id, self.book_id, self.change_type)
+
+
+# Settings of a user deciding which books are visible, changes of other settings (e.g. view_settings written when
+# sorting a list) aren't library changes
+USER_VISIBILITY_COLUMNS = ('allowed_tags', 'denied_tags', 'allowed_column_value', 'denied_column_value', 'locale',
+                           'default_language', 'role', 'sidebar_view')
+
+
 # Updates the last_modified timestamp in the KoboReadingState table if any of its children tables are modified.
 @event.listens_for(Session, 'before_flush')
 def receive_before_flush(session, flush_context, instances):
@@ -555,6 +619,19 @@ def receive_before_flush(session, flush_context, instances):
     for change in itertools.chain(session.new, session.deleted):
         if isinstance(change, BookShelf):
             change.ub_shelf.last_modified = datetime.now(timezone.utc)
+    # Changes of shelves, archived books and user settings alter the books visible to this user
+    changed_users = set()
+    for change in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(change, BookShelf) and change.ub_shelf:
+            changed_users.add(change.ub_shelf.user_id)
+        elif isinstance(change, (ArchivedBook, Shelf)):
+            changed_users.add(change.user_id)
+        elif isinstance(change, User) and any(inspect(change).attrs[column].history.has_changes()
+                                              for column in USER_VISIBILITY_COLUMNS):
+            changed_users.add(change.id)
+    for user_id in changed_users:
+        if user_id is not None:
+            session.add(LibraryChange(user_id=user_id, change_type=LibraryChange.TYPE_USER))
 
 
 # Baseclass representing Downloads from calibre-web in app.db
@@ -608,6 +685,7 @@ class AuthorInfo(Base):
     suggested_name = Column(String)  # Proposed name from enrichment (First Last)
     biography = Column(String)
     image_url = Column(String)
+    image_source = Column(String)  # image_url the local portraits were generated from
     content_hash = Column(String)  # MD5 hash of bio+image to detect actual changes
     works = Column(JSON)  # List of works from Open Library
     last_updated = Column(DateTime, default=lambda: datetime.now(timezone.utc))
@@ -666,6 +744,14 @@ def add_missing_tables(engine, _session):
         UserPreference.__table__.create(bind=engine)
     if not engine.dialect.has_table(engine.connect(), "author_info"):
         AuthorInfo.__table__.create(bind=engine)
+    if not engine.dialect.has_table(engine.connect(), "kobo_metadata_cache"):
+        KoboMetadataCache.__table__.create(bind=engine)
+    if not engine.dialect.has_table(engine.connect(), "library_change"):
+        LibraryChange.__table__.create(bind=engine)
+    if not engine.dialect.has_table(engine.connect(), "mobile_backup"):
+        MobileBackup.__table__.create(bind=engine)
+    if not engine.dialect.has_table(engine.connect(), "epub_structure"):
+        EpubStructure.__table__.create(bind=engine)
 
 
 # migrate all settings missing in registration table
@@ -708,7 +794,19 @@ def migrate_Database(_session):
     migrate_author_info_columns(_session)
     migrate_author_info_works_column(_session)
     migrate_author_info_suggested_name_column(_session)
+    migrate_author_info_image_source_column(_session)
     migrate_user_mobile_sync_column(_session)
+    migrate_kobo_metadata_cache_table(engine)
+
+
+def migrate_kobo_metadata_cache_table(engine):
+    """Entries stored per download url base (with the auth token of a user) are dropped, the cache starts over"""
+    if "url_key" in [column["name"] for column in inspect(engine).get_columns("kobo_metadata_cache")]:
+        with engine.connect() as conn:
+            trans = conn.begin()
+            conn.execute(text("DROP TABLE kobo_metadata_cache"))
+            trans.commit()
+        KoboMetadataCache.__table__.create(bind=engine)
 
 
 def migrate_user_mobile_sync_column(session):
@@ -775,6 +873,15 @@ def migrate_author_info_suggested_name_column(session):
         session.rollback()
 
 
+def migrate_author_info_image_source_column(session):
+    """Add image_source column to author_info"""
+    try:
+        session.execute(text("ALTER TABLE author_info ADD COLUMN image_source VARCHAR"))
+        session.commit()
+    except exc.OperationalError:
+        session.rollback()
+
+
 def clean_database(_session):
     # Remove expired remote login tokens
     now = datetime.now()
@@ -18,16 +18,18 @@
 
 import os
 import hashlib
+import uuid
 from flask_babel import gettext as _
 
 from . import logger, comic, isoLanguages
 from .constants import BookMeta
-from .helper import split_authors
 from .file_helper import get_temp_dir
-from .string_helper import strip_whitespaces
+from .string_helper import strip_whitespaces, split_authors
 
 log = logger.create()
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
 try:
     from wand.image import Image, Color
     from wand import version as ImageVersion
@@ -109,6 +111,12 @@ def process(tmp_file_path, original_file_name, original_file_extension, rar_exec
     return meta
 
 
+def process_upload(tmp_file_path, file_name, rar_executable):
+    """Metadata extraction of the upload import, runs in worker processes which only import this module"""
+    file_root, file_extension = os.path.splitext(file_name)
+    return process(tmp_file_path, file_root, file_extension, rar_executable)
+
+
 def default_meta(tmp_file_path, original_file_name, original_file_extension):
     return BookMeta(
         file_path=tmp_file_path,
@@ -275,3 +283,23 @@ def upload(uploadfile, rar_excecutable):
     log.debug("Temporary file: %s", tmp_file_path)
     uploadfile.save(tmp_file_path)
     return process(tmp_file_path, filename_root, file_extension, rar_excecutable)
+
+
+def save_upload(uploadfile):
+    """Streams the uploaded file to a new file in the temp dir, returns its path and sha256"""
+    tmp_file_path = os.path.join(get_temp_dir(), uuid.uuid4().hex)
+    sha256 = hashlib.sha256()
+    with open(tmp_file_path, 'wb') as tmp_file:
+        for chunk in iter(lambda: uploadfile.stream.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            tmp_file.write(chunk)
+    log.debug("Temporary file: %s", tmp_file_path)
+    return tmp_file_path, sha256.hexdigest()
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
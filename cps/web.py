@@ -45,7 +45,8 @@ from . import calibre_db, kobo_sync_status
 from .search import render_search_results, render_adv_search_results
 from .gdriveutils import getFileFromEbooksFolder, do_gdrive_download
 from .helper import check_valid_domain, check_email, check_username, \
-    get_book_cover, get_series_cover_thumbnail, get_download_link, send_mail, generate_random_password, \
+    get_book_cover, get_series_cover_thumbnail, get_author_thumbnails, get_author_image, update_author_thumbnails, \
+    get_download_link, send_mail, generate_random_password, \
     send_registration_mail, check_send_to_ereader, check_read_formats, tags_filters, reset_password, valid_email, \
     edit_book_read_status, valid_password, get_valid_filename
 from .pagination import Pagination
@@ -54,6 +55,7 @@ from .cw_babel import get_available_locale
 from .usermanagement import login_required_if_no_ano
 from .kobo_sync_status import remove_synced_book
 from .render_template import render_title_template
+from .epub_structure import structure_cache
 from .kobo_sync_status import change_archived_books
 from . import limiter
 from .services.worker import WorkerThread
@@ -583,21 +585,7 @@ def render_hot_books(page, order):
         else:
             random = false()
 
-        off = int(int(config.config_books_per_page) * (page - 1))
-        all_books = ub.session.query(ub.Downloads, func.count(ub.Downloads.book_id)) \
-            .order_by(*order[0]).group_by(ub.Downloads.book_id)
-        hot_books = all_books.offset(off).limit(config.config_books_per_page)
-        entries = list()
-        for book in hot_books:
-            query = calibre_db.generate_linked_query(config.config_read_column, db.Books)
-            download_book = query.filter(calibre_db.common_filters()).filter(
-                book.Downloads.book_id == db.Books.id).first()
-            if download_book:
-                entries.append(download_book)
-            else:
-                ub.delete_download(book.Downloads.book_id)
-        num_books = entries.__len__()
-        pagination = Pagination(page, config.config_books_per_page, num_books)
+        entries, pagination = calibre_db.fill_indexpage_hot_books(page, 0, order[0], config.config_read_column)
         view_type = current_user.get_view_property('hot', 'view_type')
         template = 'index.html' if view_type != 'table' else 'list.html'
         return render_title_template(template, random=random, entries=entries, pagination=pagination,
@@ -698,12 +686,21 @@ def render_author_books(page, author_id, order):
     if not hasattr(author_info, 'author_name'):
         author_info.author_name = author_name
 
+    # Local copies of the author image, the remote image is shown until they are generated
+    thumbnails = get_author_thumbnails(author_id)
+    author_images = {name: url_for("web.get_author_portrait", author_id=author_id, resolution=name,
+                                   v=int(thumbnail.generated_at.timestamp() * 1000))
+                     for name, thumbnail in (("sm", thumbnails.get(constants.COVER_THUMBNAIL_SMALL)),
+                                             ("md", thumbnails.get(constants.COVER_THUMBNAIL_MEDIUM)))
+                     if thumbnail}
+
     # Calculate missing books from bibliography
     missing_books = services.author_enrichment.get_missing_books(author_id)
     log.debug("Found %d missing books for author %d", len(missing_books), author_id)
 
     return render_title_template('author.html', entries=entries, pagination=pagination, id=author_id,
                                  title=_("Author: %(name)s", name=author_name), author=author_info,
+                                 author_images=author_images,
                                  other_books=other_books, missing_books=missing_books,
                                  page="author", order=order[1])
 
@@ -759,6 +756,7 @@ def refresh_author_info(author_id):
                 author_info.last_checked = now
             
             ub.session.commit()
+            update_author_thumbnails(author_id)
             
             return jsonify({
                 "success": True,
@@ -1930,6 +1928,18 @@ def get_series_cover(series_id, resolution=None):
     return get_series_cover_thumbnail(series_id, cover_resolution)
 
 
+@web.route("/author_image/<int:author_id>/<string:resolution>")
+@login_required_if_no_ano
+def get_author_portrait(author_id, resolution):
+    resolutions = {
+        'sm': constants.COVER_THUMBNAIL_SMALL,
+        'md': constants.COVER_THUMBNAIL_MEDIUM,
+    }
+    if resolution not in resolutions:
+        abort(404)
+    return get_author_image(author_id, resolutions[resolution])
+
+
 @web.route("/toggle_view_mode")
 @user_login_required
 def toggle_view_mode():
@@ -2436,8 +2446,11 @@ def read_book(book_id, book_format):
                                                              ub.Bookmark.format == book_format.upper())).first()
     if book_format.lower() == "epub" or book_format.lower() == "kepub":
         log.debug("Start [k]epub reader for %d", book_id)
+        book_data = next((data for data in book.data if data.format.lower() == book_format.lower()), None)
+        structure = structure_cache.get(book, book_data) if book_data else None
+        ub.session_commit()
         return render_title_template('read.html', bookid=book_id, title=book.title, bookmark=bookmark,
-                                     book_format=book_format)
+                                     book_format=book_format, structure=structure)
     elif book_format.lower() == "pdf":
         log.debug("Start pdf reader for %d", book_id)
         return render_title_template('readpdf.html', pdffile=book_id, title=book.title)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Latency and recall of the typo tolerant search.
+
+A metadata only library (no book files) with pronounceable random titles, author and series names is generated,
+the search index is built and searches with one or two typos per word (swapped, dropped, doubled or replaced
+characters) are run against it. Reported are the build time of the index, latency percentiles of the suggestion
+and the ranked fuzzy search and the share of searches finding the book the typo was made from (recall) and
+ranking it first. The script exits with status 1 if the p99 latency of the fuzzy search exceeds the budget.
+
+Usage:
+    python3 scripts/fuzzy_search_benchmark.py --workdir /tmp/fuzzy-bench --books 200000 --queries 500
+
+  --json FILE stores the results for comparing runs of different versions of search_index.py.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from kobo_sync_benchmark import BOOKS_TABLE, PhaseStats  # noqa: E402
+
+CONSONANTS = "bcdfghjklmnprstvwz"
+VOWELS = "aeiou"
+
+
+def make_words(rnd, count):
+    words = set()
+    while len(words) < count:
+        words.add("".join(rnd.choice(CONSONANTS) + rnd.choice(VOWELS) for __ in range(rnd.randint(2, 4))))
+    return sorted(words)
+
+
+def unique_names(make_name, count):
+    names = dict()
+    while len(names) < count:
+        names[make_name()] = None
+    return list(names)
+
+
+def generate_metadata(library_dir, book_count, seed=42):
+    """Creates a calibre like metadata.db with book_count books, without book files"""
+    from sqlalchemy import create_engine
+    from cps import db
+
+    rnd = random.Random(seed)
+    os.makedirs(library_dir, exist_ok=True)
+    engine = create_engine("sqlite:///{}".format(os.path.join(library_dir, "metadata.db")))
+    engine = engine.execution_options(schema_translate_map={"calibre": None})
+    with engine.begin() as conn:
+        conn.exec_driver_sql(BOOKS_TABLE)
+    db.Base.metadata.create_all(engine, tables=[table for table in db.Base.metadata.sorted_tables
+                                                if not table.name.startswith(("custom_column_",
+                                                                              "books_custom_column_"))
+                                                and table.name != "books"])
+    tables = db.Base.metadata.tables
+    vocabulary = make_words(rnd, max(1000, book_count // 4))
+    names = make_words(rnd, max(500, book_count // 10))
+    author_names = unique_names(lambda: "{} {}".format(rnd.choice(names).title(), rnd.choice(names).title()),
+                                max(1, book_count // 5))
+    series_names = unique_names(lambda: " ".join(rnd.choice(vocabulary) for __ in range(2)).title(),
+                                max(1, book_count // 20))
+    authors = [{"id": i + 1, "name": name, "sort": "", "link": ""} for i, name in enumerate(author_names)]
+    series = [{"id": i + 1, "name": name, "sort": ""} for i, name in enumerate(series_names)]
+    now = datetime.now(timezone.utc)
+    books, book_authors, book_series = [], [], []
+    for book_id in range(1, book_count + 1):
+        title = " ".join(rnd.choice(vocabulary) for __ in range(rnd.randint(2, 5))).title()
+        books.append({"id": book_id, "title": title, "sort": title, "author_sort": "", "timestamp": now,
+                      "pubdate": now, "series_index": 1.0, "last_modified": now, "path": str(book_id),
+                      "has_cover": 0, "uuid": "00000000-0000-4000-8000-{:012d}".format(book_id), "isbn": "",
+                      "flags": 1})
+        book_authors.append({"book": book_id, "author": rnd.choice(authors)["id"]})
+        if book_id % 3 == 0:
+            book_series.append({"book": book_id, "series": rnd.choice(series)["id"]})
+    with engine.begin() as conn:
+        conn.execute(tables["library_id"].insert(), [{"uuid": "00000000-0000-4000-8000-000000000000"}])
+        conn.execute(tables["authors"].insert(), authors)
+        conn.execute(tables["series"].insert(), series)
+        conn.execute(tables["books"].insert(), books)
+        conn.execute(tables["books_authors_link"].insert(), book_authors)
+        conn.execute(tables["books_series_link"].insert(), book_series)
+        # indexes of calibre's schema used by the search
+        conn.exec_driver_sql("CREATE INDEX books_authors_link_aidx ON books_authors_link (author)")
+        conn.exec_driver_sql("CREATE INDEX books_series_link_sidx ON books_series_link (series)")
+    engine.dispose()
+
+
+def setup_in_process(workdir, library_dir):
+    sys.argv = [sys.argv[0], "-p", os.path.join(workdir, "app.db"), "-g", os.path.join(workdir, "gdrive.db")]
+    import cps
+    from cps import db, config
+    app = cps.create_app()
+    config.config_calibre_dir = library_dir
+    config.save()
+    db.CalibreDB.update_config(config, library_dir, os.path.join(workdir, "app.db"))
+    return app
+
+
+def make_typo(rnd, word):
+    position = rnd.randrange(1, len(word) - 1)
+    operation = rnd.choice(("swap", "drop", "double", "replace"))
+    if operation == "swap":
+        return word[:position] + word[position + 1] + word[position] + word[position + 2:]
+    if operation == "drop":
+        return word[:position] + word[position + 1:]
+    if operation == "double":
+        return word[:position] + word[position] + word[position:]
+    return word[:position] + rnd.choice(VOWELS if word[position] in VOWELS else CONSONANTS) + word[position + 1:]
+
+
+def make_queries(session, count, seed=7):
+    """Returns (search term with typos, id of the book it was made from): a title word plus the last name of the
+    author or two title words"""
+    from cps import db
+    rnd = random.Random(seed)
+    total = session.query(db.Books).count()
+    queries = []
+    while len(queries) < count:
+        book = session.get(db.Books, rnd.randint(1, total))
+        words = book.title.lower().split()
+        if rnd.random() < 0.5 and book.authors:
+            parts = [rnd.choice(words), book.authors[0].name.lower().split()[-1]]
+        else:
+            parts = rnd.sample(words, 2)
+        queries.append((" ".join(make_typo(rnd, word) if len(word) > 4 else word for word in parts), book.id))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Typo tolerant search latency and recall")
+    parser.add_argument("--workdir", default="fuzzy-bench", help="directory for app.db and the synthetic library")
+    parser.add_argument("--books", type=int, default=200000, help="size of the generated library")
+    parser.add_argument("--queries", type=int, default=300, help="number of searches")
+    parser.add_argument("--budget-ms", type=float, default=100, help="allowed p99 latency of the fuzzy search")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    library_dir = os.path.join(workdir, "library-{}".format(args.books))
+    if not os.path.exists(os.path.join(library_dir, "metadata.db")):
+        print("Generating library with {} books in {}".format(args.books, library_dir))
+        generate_metadata(library_dir, args.books)
+    app = setup_in_process(workdir, library_dir)
+
+    from cps import db
+    from cps.search_index import SearchIndex
+    with app.app_context():
+        session = db.CalibreDB(app).session
+        index = SearchIndex()
+        start = time.perf_counter()
+        index.build(session)
+        build_seconds = time.perf_counter() - start
+        queries = make_queries(session, args.queries)
+
+        suggest_stats = PhaseStats("suggest")
+        fuzzy_stats = PhaseStats("fuzzy_search")
+        found = first = 0
+        for term, book_id in queries:
+            start = time.perf_counter()
+            index.suggest(term)
+            suggest_stats.add(time.perf_counter() - start, 0, None, True)
+            start = time.perf_counter()
+            ids = index.fuzzy_book_ids(session, term)
+            fuzzy_stats.add(time.perf_counter() - start, 0, None, True)
+            found += book_id in ids
+            first += bool(ids) and ids[0] == book_id
+
+    results = {"books": args.books, "queries": len(queries), "build_s": round(build_seconds, 2),
+               "index": index.get_stats(), "recall": round(found / len(queries), 3),
+               "first_hit": round(first / len(queries), 3),
+               "phases": [suggest_stats.to_dict(), fuzzy_stats.to_dict()]}
+    print("index: {} built in {}s".format(results["index"], results["build_s"]))
+    print("recall {:.1%}, ranked first {:.1%}".format(results["recall"], results["first_hit"]))
+    columns = ["phase", "requests", "p50_ms", "p90_ms", "p99_ms", "max_ms"]
+    print(" ".join("{:>14}".format(column) for column in columns))
+    for phase in results["phases"]:
+        print(" ".join("{:>14}".format(phase[column]) for column in columns))
+    if args.json:
+        with open(args.json, "w") as result_file:
+            json.dump(results, result_file, indent=2)
+    within_budget = results["phases"][1]["p99_ms"] <= args.budget_ms
+    print("p99 {} ms, budget {} ms: {}".format(results["phases"][1]["p99_ms"], args.budget_ms,
+                                               "ok" if within_budget else "exceeded"))
+    sys.stdout.flush()
+    # background threads of the app (updater, scheduler) would keep the process alive
+    os._exit(0 if within_budget else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Load simulation for the Kobo sync protocol endpoints.
+
+Creates N simulated Kobo devices (users with Kobo auth tokens) and drives full syncs
+(following continuation tokens), reading state PUTs, cover image requests and incremental
+syncs against a library. For every phase latency percentiles, payload sizes and (in-process
+mode) the number of SQL queries per request are reported.
+
+Usage:
+  In-process (Flask test client, synthetic library is generated in the work directory):
+    python3 scripts/kobo_sync_benchmark.py --workdir /tmp/kobo-bench --books 5000 --devices 10
+
+  Against a running server (rate limiter has to be disabled, tokens are created in its app.db):
+    python3 scripts/kobo_sync_benchmark.py --url http://localhost:8083 --app-db /path/to/app.db --devices 10
+
+  --json FILE stores the results for comparing runs of different versions of kobo.py / SyncToken.
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import sys
+import time
+import zipfile
+from binascii import hexlify
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+SYNC_TOKEN_HEADER = "x-kobo-synctoken"
+DEVICE_PREFIX = "kobo-bench-"
+# 1x1 pixel jpeg used as cover of the generated books
+COVER_JPEG = base64.b64decode(
+    "/9j/4AAQSkZJRgABAQEASABIAAD/2wBDAAMCAgICAgMCAgIDAwMDBAYEBAQEBAgGBgUGCQgKCgkICQkKDA8MCgsOCwkJDRENDg8QEBEQCgw"
+    "SExIQEw8QEBD/yQALCAABAAEBAREA/8wABgAQEAX/2gAIAQEAAD8A0s8g/9k=")
+OPF_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="uid">{uuid}</dc:identifier><dc:title>{title}</dc:title><dc:language>en</dc:language>
+  </metadata>
+  <manifest><item id="c1" href="c1.xhtml" media-type="application/xhtml+xml"/></manifest>
+  <spine><itemref idref="c1"/></spine>
+</package>"""
+BOOKS_TABLE = """CREATE TABLE books (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT NOT NULL DEFAULT 'Unknown' COLLATE NOCASE,
+    sort TEXT COLLATE NOCASE, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP, pubdate TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    series_index REAL NOT NULL DEFAULT 1.0, author_sort TEXT COLLATE NOCASE, isbn TEXT DEFAULT "" COLLATE NOCASE,
+    lccn TEXT DEFAULT "" COLLATE NOCASE, path TEXT NOT NULL DEFAULT "", flags INTEGER NOT NULL DEFAULT 1, uuid TEXT,
+    has_cover BOOL DEFAULT 0, last_modified TIMESTAMP NOT NULL DEFAULT "2000-01-01 00:00:00+00:00")"""
+CONTAINER_XML = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def install(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        @event.listens_for(Engine, "before_cursor_execute")
+        def _count(conn, cursor, statement, parameters, context, executemany):
+            self.count += 1
+
+
+class PhaseStats:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.sizes = []
+        self.queries = []
+        self.errors = 0
+
+    def add(self, latency, size, queries, ok):
+        self.latencies.append(latency)
+        self.sizes.append(size)
+        if queries is not None:
+            self.queries.append(queries)
+        if not ok:
+            self.errors += 1
+
+    @staticmethod
+    def percentile(values, pct):
+        if not values:
+            return 0
+        values = sorted(values)
+        index = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values) + 0.5)) - 1))
+        return values[index]
+
+    def to_dict(self):
+        return {
+            "phase": self.name,
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "p50_ms": round(self.percentile(self.latencies, 50) * 1000, 2),
+            "p90_ms": round(self.percentile(self.latencies, 90) * 1000, 2),
+            "p99_ms": round(self.percentile(self.latencies, 99) * 1000, 2),
+            "max_ms": round(max(self.latencies, default=0) * 1000, 2),
+            "queries_mean": round(sum(self.queries) / len(self.queries), 1) if self.queries else None,
+            "queries_max": max(self.queries) if self.queries else None,
+            "bytes_mean": int(sum(self.sizes) / len(self.sizes)) if self.sizes else 0,
+            "bytes_total": sum(self.sizes),
+        }
+
+
+def generate_library(library_dir, book_count, seed=42):
+    """Creates a calibre like metadata.db with book_count books, each with an epub file and a cover"""
+    from sqlalchemy import create_engine
+    from cps import db
+
+    rnd = random.Random(seed)
+    os.makedirs(library_dir, exist_ok=True)
+    engine = create_engine("sqlite:///{}".format(os.path.join(library_dir, "metadata.db")))
+    engine = engine.execution_options(schema_translate_map={"calibre": None})
+    with engine.begin() as conn:
+        # calibre stores series_index as REAL, the model maps it as String
+        conn.exec_driver_sql(BOOKS_TABLE)
+    db.Base.metadata.create_all(engine, tables=[table for table in db.Base.metadata.sorted_tables
+                                                if not table.name.startswith(("custom_column_",
+                                                                              "books_custom_column_"))
+                                                and table.name != "books"])
+    tables = db.Base.metadata.tables
+    now = datetime.now(timezone.utc)
+    authors = [{"id": i + 1, "name": "Author {}".format(i + 1), "sort": "{}, Author".format(i + 1), "link": ""}
+               for i in range(max(1, book_count // 5))]
+    series = [{"id": i + 1, "name": "Series {}".format(i + 1), "sort": "Series {}".format(i + 1)}
+              for i in range(max(1, book_count // 20))]
+    books, data, book_authors, book_series, book_langs = [], [], [], [], []
+    for book_id in range(1, book_count + 1):
+        author = rnd.choice(authors)
+        title = "Synthetic Book {}".format(book_id)
+        book_uuid = "00000000-0000-4000-8000-{:012d}".format(book_id)
+        path = "{}/{} ({})".format(author["name"], title, book_id)
+        file_name = "{} - {}".format(title, author["name"])
+        book_dir = os.path.join(library_dir, path)
+        os.makedirs(book_dir, exist_ok=True)
+        epub_path = os.path.join(book_dir, file_name + ".epub")
+        with zipfile.ZipFile(epub_path, "w") as epub:
+            epub.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+            epub.writestr("META-INF/container.xml", CONTAINER_XML)
+            epub.writestr("content.opf", OPF_TEMPLATE.format(uuid=book_uuid, title=title))
+            epub.writestr("c1.xhtml", "<html><body><p>{}</p></body></html>".format(title * 20))
+        with open(os.path.join(book_dir, "cover.jpg"), "wb") as cover:
+            cover.write(COVER_JPEG)
+        created = now - timedelta(minutes=book_count - book_id)
+        books.append({"id": book_id, "title": title, "sort": title, "author_sort": author["sort"],
+                      "timestamp": created, "pubdate": created, "series_index": 1.0,
+                      "last_modified": created, "path": path, "has_cover": 1, "uuid": book_uuid,
+                      "isbn": "", "flags": 1})
+        data.append({"book": book_id, "format": "EPUB", "uncompressed_size": os.path.getsize(epub_path),
+                     "name": file_name})
+        book_authors.append({"book": book_id, "author": author["id"]})
+        if book_id % 3 == 0:
+            book_series.append({"book": book_id, "series": rnd.choice(series)["id"]})
+        book_langs.append({"book": book_id, "lang_code": 1})
+    with engine.begin() as conn:
+        conn.execute(tables["library_id"].insert(), [{"uuid": "00000000-0000-4000-8000-000000000000"}])
+        conn.execute(tables["languages"].insert(), [{"id": 1, "lang_code": "eng"}])
+        conn.execute(tables["authors"].insert(), authors)
+        conn.execute(tables["series"].insert(), series)
+        conn.execute(tables["books"].insert(), books)
+        conn.execute(tables["calibre.data"].insert(), data)
+        conn.execute(tables["books_authors_link"].insert(), book_authors)
+        conn.execute(tables["books_series_link"].insert(), book_series)
+        conn.execute(tables["books_languages_link"].insert(), book_langs)
+    engine.dispose()
+
+
+def touch_library(library_dir, count, seed=7):
+    """Simulates external changes (e.g. editing books in calibre) by bumping last_modified of some books"""
+    import sqlite3
+    conn = sqlite3.connect(os.path.join(library_dir, "metadata.db"))
+    ids = [row[0] for row in conn.execute("SELECT id FROM books")]
+    stamp = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f+00:00")
+    changed = random.Random(seed).sample(ids, min(count, len(ids)))
+    conn.executemany("UPDATE books SET last_modified = ? WHERE id = ?", [(stamp, book_id) for book_id in changed])
+    conn.commit()
+    conn.close()
+
+
+def create_devices(device_count):
+    """Creates (or reuses) users with download rights and kobo auth tokens, returns list of tokens"""
+    from cps import ub, constants
+    tokens = []
+    for index in range(device_count):
+        name = "{}{}".format(DEVICE_PREFIX, index)
+        user = ub.session.query(ub.User).filter(ub.User.name == name).first()
+        if not user:
+            user = ub.User()
+            user.name = name
+            user.email = "{}@example.org".format(name)
+            user.role = constants.ROLE_DOWNLOAD
+            user.password = ""
+            ub.session.add(user)
+            ub.session.commit()
+        auth_token = ub.session.query(ub.RemoteAuthToken).filter(ub.RemoteAuthToken.user_id == user.id,
+                                                                 ub.RemoteAuthToken.token_type == 1).first()
+        if not auth_token:
+            auth_token = ub.RemoteAuthToken()
+            auth_token.user_id = user.id
+            auth_token.expiration = datetime.max
+            auth_token.auth_token = hexlify(os.urandom(16)).decode("utf-8")
+            auth_token.token_type = 1
+            ub.session.add(auth_token)
+            ub.session.commit()
+        tokens.append(auth_token.auth_token)
+    return tokens
+
+
+def reset_devices(tokens):
+    """Forgets everything synced to the simulated devices, so the next run starts with a full sync again"""
+    from cps import ub
+    user_ids = [token.user_id for token in
+                ub.session.query(ub.RemoteAuthToken).filter(ub.RemoteAuthToken.auth_token.in_(tokens))]
+    for table in (ub.KoboSyncedBooks, ub.KoboReadingState, ub.ReadBook, ub.ArchivedBook):
+        ub.session.query(table).filter(table.user_id.in_(user_ids)).delete()
+    ub.session.commit()
+
+
+class TestClientTransport:
+    def __init__(self, app, counter):
+        self.client = app.test_client()
+        self.counter = counter
+
+    def request(self, method, path, headers=None, body=None):
+        before = self.counter.count
+        start = time.perf_counter()
+        response = self.client.open(path, method=method, headers=headers or {}, json=body)
+        payload = response.get_data()
+        return time.perf_counter() - start, response.status_code, response.headers, payload, \
+            self.counter.count - before
+
+
+class HttpTransport:
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def request(self, method, path, headers=None, body=None):
+        start = time.perf_counter()
+        response = self.session.request(method, self.url + path, headers=headers or {}, json=body, timeout=300)
+        payload = response.content
+        return time.perf_counter() - start, response.status_code, response.headers, payload, None
+
+
+class Device:
+    def __init__(self, token, transport):
+        self.token = token
+        self.transport = transport
+        self.sync_token = None
+        self.book_uuids = []
+
+    def sync(self, stats):
+        """Syncs until the server doesn't ask for continuation anymore, returns number of requests"""
+        requests_done = 0
+        while True:
+            headers = {SYNC_TOKEN_HEADER: self.sync_token} if self.sync_token else {}
+            latency, status, response_headers, payload, queries = self.transport.request(
+                "GET", "/kobo/{}/v1/library/sync".format(self.token), headers)
+            stats.add(latency, len(payload), queries, status == 200)
+            requests_done += 1
+            if status != 200:
+                return requests_done
+            self.sync_token = response_headers.get(SYNC_TOKEN_HEADER, self.sync_token)
+            for item in json.loads(payload or b"[]"):
+                entitlement = item.get("NewEntitlement") or item.get("ChangedEntitlement")
+                if entitlement:
+                    self.book_uuids.append(entitlement["BookEntitlement"]["Id"])
+            if response_headers.get("x-kobo-sync") != "continue":
+                return requests_done
+
+    def put_states(self, stats, count, rnd):
+        for book_uuid in rnd.sample(self.book_uuids, min(count, len(self.book_uuids))):
+            now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+            body = {"ReadingStates": [{
+                "EntitlementId": book_uuid,
+                "LastModified": now,
+                "CurrentBookmark": {"ProgressPercent": rnd.randint(1, 99), "ContentSourceProgressPercent": 10,
+                                    "Location": {"Value": "c1.xhtml", "Type": "KoboSpan", "Source": "c1.xhtml"}},
+                "Statistics": {"SpentReadingMinutes": rnd.randint(1, 600), "RemainingTimeMinutes": 30},
+                "StatusInfo": {"Status": "Reading"},
+            }]}
+            latency, status, __, payload, queries = self.transport.request(
+                "PUT", "/kobo/{}/v1/library/{}/state".format(self.token, book_uuid), body=body)
+            stats.add(latency, len(payload), queries, status == 200)
+
+    def get_covers(self, stats, count, rnd):
+        for book_uuid in rnd.sample(self.book_uuids, min(count, len(self.book_uuids))):
+            latency, status, __, payload, queries = self.transport.request(
+                "GET", "/kobo/{}/{}/355/530/false/image.jpg".format(self.token, book_uuid))
+            stats.add(latency, len(payload), queries, status == 200)
+
+
+def run_phase(name, devices, action, concurrency):
+    stats = PhaseStats(name)
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(lambda device: action(device, stats), devices))
+    else:
+        for device in devices:
+            action(device, stats)
+    result = stats.to_dict()
+    result["wall_s"] = round(time.perf_counter() - start, 2)
+    return result
+
+
+def print_results(results):
+    columns = ["phase", "requests", "errors", "p50_ms", "p90_ms", "p99_ms", "max_ms",
+               "queries_mean", "queries_max", "bytes_mean", "wall_s"]
+    print(" ".join("{:>16}".format(column) for column in columns))
+    for result in results:
+        print(" ".join("{:>16}".format("-" if result[column] is None else result[column]) for column in columns))
+
+
+def setup_in_process(workdir, library_dir):
+    sys.argv = [sys.argv[0], "-p", os.path.join(workdir, "app.db"), "-g", os.path.join(workdir, "gdrive.db")]
+    import cps
+    from cps import db, config, services
+    app = cps.create_app()
+    if not services.SyncToken:
+        sys.exit("Kobo sync is not available, optional dependency jsonschema is missing")
+    config.config_calibre_dir = library_dir
+    config.config_kobo_sync = True
+    config.config_kobo_proxy = False
+    config.config_ratelimiter = False
+    config.save()
+    app.config.update(RATELIMIT_ENABLED=False)
+    db.CalibreDB.update_config(config, library_dir, os.path.join(workdir, "app.db"))
+    from cps.web import web
+    from cps.kobo import kobo
+    from cps.kobo_auth import kobo_auth
+    app.register_blueprint(web)
+    app.register_blueprint(kobo)
+    app.register_blueprint(kobo_auth)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kobo sync load simulation")
+    parser.add_argument("--workdir", default="kobo-bench", help="directory for app.db and the synthetic library")
+    parser.add_argument("--library", help="use this calibre library instead of generating one")
+    parser.add_argument("--books", type=int, default=1000, help="size of the generated library")
+    parser.add_argument("--devices", type=int, default=5, help="number of simulated kobo devices")
+    parser.add_argument("--states", type=int, default=20, help="reading state PUTs per device")
+    parser.add_argument("--covers", type=int, default=20, help="cover requests per device")
+    parser.add_argument("--touch", type=int, default=50, help="books changed externally before the last sync")
+    parser.add_argument("--url", help="drive a running server instead of the in-process test client")
+    parser.add_argument("--app-db", help="app.db of the running server (required with --url)")
+    parser.add_argument("--concurrency", type=int, default=1, help="parallel devices (only with --url)")
+    parser.add_argument("--keep-state", action="store_true", help="don't reset the devices before the run")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    counter = QueryCounter()
+    if args.url:
+        if not args.app_db:
+            parser.error("--app-db is required with --url")
+        from cps import ub
+        ub.init_db(args.app_db)
+        library_dir = args.library
+        concurrency = max(1, args.concurrency)
+        make_transport = lambda: HttpTransport(args.url)
+    else:
+        library_dir = os.path.abspath(args.library or os.path.join(workdir, "library"))
+        if not os.path.exists(os.path.join(library_dir, "metadata.db")):
+            print("Generating library with {} books in {}".format(args.books, library_dir))
+            generate_library(library_dir, args.books)
+        app = setup_in_process(workdir, library_dir)
+        counter.install()
+        # the app.db session is shared, requests have to be serialized like in the tornado server
+        concurrency = 1
+        make_transport = lambda: TestClientTransport(app, counter)
+
+    tokens = create_devices(args.devices)
+    if not args.keep_state:
+        reset_devices(tokens)
+    devices = [Device(token, make_transport()) for token in tokens]
+    rnd = random.Random(1)
+
+    results = [
+        run_phase("full_sync", devices, lambda device, stats: device.sync(stats), concurrency),
+        run_phase("incremental_idle", devices, lambda device, stats: device.sync(stats), concurrency),
+        run_phase("state_put", devices, lambda device, stats: device.put_states(stats, args.states, rnd),
+                  concurrency),
+        run_phase("cover", devices, lambda device, stats: device.get_covers(stats, args.covers, rnd), concurrency),
+        run_phase("incremental_states", devices, lambda device, stats: device.sync(stats), concurrency),
+    ]
+    if args.touch and library_dir:
+        touch_library(library_dir, args.touch)
+        results.append(run_phase("incremental_touched", devices, lambda device, stats: device.sync(stats),
+                                 concurrency))
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as result_file:
+            json.dump({"books": args.books, "devices": args.devices, "mode": "http" if args.url else "in-process",
+                       "results": results}, result_file, indent=2)
+    sys.stdout.flush()
+    # background threads of the app (updater, scheduler) would keep the process alive
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
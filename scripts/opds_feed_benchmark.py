@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Compares the OPDS 1.2 Atom feeds with the OPDS 2.0 JSON feeds of the same pages.
+
+For every feed pair the payload size (plain and gzip compressed), the render time and the number of SQL queries
+are measured. The feed cache is cleared before each request, so the numbers show the rendering of the feed and not
+the cache lookup. The first page of both formats is compared, OPDS 2.0 feeds are paginated by cursor, following
+pages are not comparable to the offset pages of the Atom feeds.
+
+Usage:
+    python3 scripts/opds_feed_benchmark.py --workdir /tmp/opds-bench --books 5000 --rounds 20
+
+  --json FILE stores the results for comparing runs of different versions of opds.py / opds2.py.
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from kobo_sync_benchmark import PhaseStats, QueryCounter, generate_library  # noqa: E402
+
+BENCH_USER = "opds-bench"
+BENCH_PASSWORD = "opds-bench"
+
+
+def setup_in_process(workdir, library_dir):
+    sys.argv = [sys.argv[0], "-p", os.path.join(workdir, "app.db"), "-g", os.path.join(workdir, "gdrive.db")]
+    import cps
+    from cps import db, config
+    app = cps.create_app()
+    config.config_calibre_dir = library_dir
+    config.config_anonbrowse = 0
+    config.config_ratelimiter = False
+    config.save()
+    app.config.update(RATELIMIT_ENABLED=False)
+    db.CalibreDB.update_config(config, library_dir, os.path.join(workdir, "app.db"))
+    from cps.jinjia import jinjia
+    from cps.web import web
+    from cps.opds import opds
+    from cps.opds2 import opds2
+    app.register_blueprint(jinjia)
+    app.register_blueprint(web)
+    app.register_blueprint(opds)
+    app.register_blueprint(opds2)
+    return app
+
+
+def create_user():
+    from werkzeug.security import generate_password_hash
+    from cps import ub, constants
+    user = ub.session.query(ub.User).filter(ub.User.name == BENCH_USER).first()
+    if not user:
+        user = ub.User()
+        user.name = BENCH_USER
+        user.email = "{}@example.org".format(BENCH_USER)
+        user.role = constants.ROLE_DOWNLOAD
+        user.sidebar_view = constants.ADMIN_USER_SIDEBAR
+        ub.session.add(user)
+    user.password = generate_password_hash(BENCH_PASSWORD)
+    ub.session.commit()
+    return {"Authorization": "Basic " + base64.b64encode("{}:{}".format(BENCH_USER, BENCH_PASSWORD)
+                                                         .encode("utf-8")).decode("ascii")}
+
+
+def get_feed_pairs(library_dir, query):
+    import sqlite3
+    conn = sqlite3.connect(os.path.join(library_dir, "metadata.db"))
+    try:
+        author_id = conn.execute("SELECT author FROM books_authors_link GROUP BY author "
+                                 "ORDER BY count(*) DESC LIMIT 1").fetchone()[0]
+        tag_row = conn.execute("SELECT tag FROM books_tags_link GROUP BY tag ORDER BY count(*) DESC LIMIT 1").fetchone()
+        series_row = conn.execute("SELECT series FROM books_series_link GROUP BY series "
+                                  "ORDER BY count(*) DESC LIMIT 1").fetchone()
+    finally:
+        conn.close()
+    pairs = [
+        ("new", "/opds/new", "/opds2/new"),
+        ("rated", "/opds/rated", "/opds2/rated"),
+        ("title", "/opds/books/letter/00", "/opds2/publications?sort=title"),
+        ("hot", "/opds/hot", "/opds2/hot"),
+        ("author", "/opds/author/{}".format(author_id), "/opds2/author/{}".format(author_id)),
+        ("search", "/opds/search?query={}".format(query), "/opds2/search?query={}".format(query)),
+    ]
+    if tag_row:
+        pairs.append(("category", "/opds/category/{}".format(tag_row[0]), "/opds2/category/{}".format(tag_row[0])))
+    if series_row:
+        pairs.append(("series", "/opds/series/{}".format(series_row[0]), "/opds2/series/{}".format(series_row[0])))
+    return pairs
+
+
+def measure(client, counter, headers, name, path, rounds):
+    from cps.opds_cache import feed_cache
+    stats = PhaseStats(name)
+    compressed = 0
+    for __ in range(rounds):
+        feed_cache.clear()
+        before = counter.count
+        start = time.perf_counter()
+        response = client.get(path, headers=headers)
+        payload = response.get_data()
+        stats.add(time.perf_counter() - start, len(payload), counter.count - before, response.status_code == 200)
+    if payload:
+        compressed = len(gzip.compress(payload))
+    result = stats.to_dict()
+    result["path"] = path
+    result["gzip_bytes"] = compressed
+    return result
+
+
+def print_results(results):
+    columns = ["phase", "requests", "errors", "p50_ms", "p90_ms", "max_ms", "queries_mean", "bytes_mean",
+               "gzip_bytes"]
+    print(" ".join("{:>16}".format(column) for column in columns))
+    for result in results:
+        print(" ".join("{:>16}".format("-" if result[column] is None else result[column]) for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OPDS Atom vs OPDS 2.0 JSON feed comparison")
+    parser.add_argument("--workdir", default="opds-bench", help="directory for app.db and the synthetic library")
+    parser.add_argument("--library", help="use this calibre library instead of generating one")
+    parser.add_argument("--books", type=int, default=1000, help="size of the generated library")
+    parser.add_argument("--rounds", type=int, default=10, help="requests per feed")
+    parser.add_argument("--query", default="Book", help="search term used for the search feeds")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    library_dir = os.path.abspath(args.library or os.path.join(workdir, "library"))
+    if not os.path.exists(os.path.join(library_dir, "metadata.db")):
+        print("Generating library with {} books in {}".format(args.books, library_dir))
+        generate_library(library_dir, args.books)
+    app = setup_in_process(workdir, library_dir)
+    counter = QueryCounter()
+    counter.install()
+    headers = create_user()
+    client = app.test_client()
+
+    results = []
+    for name, atom_path, json_path in get_feed_pairs(library_dir, args.query):
+        results.append(measure(client, counter, headers, name + "_atom", atom_path, args.rounds))
+        results.append(measure(client, counter, headers, name + "_json", json_path, args.rounds))
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as result_file:
+            json.dump({"books": args.books, "rounds": args.rounds, "results": results}, result_file, indent=2)
+    sys.stdout.flush()
+    # background threads of the app (updater, scheduler) would keep the process alive
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
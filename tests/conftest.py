@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# Shared fixtures of the tests. The app is created once per test run with its settings in a temporary directory and a
+# library generated by scripts/kobo_sync_benchmark.py, tests changing the library leave the generated books alone.
+
+import os
+import sys
+import threading
+import time
+import zipfile
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+
+BOOK_COUNT = 20
+
+OPF = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="uid">{title}</dc:identifier><dc:title>{title}</dc:title><dc:creator>{author}</dc:creator>
+    <dc:language>en</dc:language>
+  </metadata>
+  <manifest><item id="c1" href="c1.xhtml" media-type="application/xhtml+xml"/></manifest>
+  <spine><itemref idref="c1"/></spine>
+</package>"""
+
+
+def make_epub(path, title, author):
+    from kobo_sync_benchmark import CONTAINER_XML
+    with zipfile.ZipFile(path, "w") as epub:
+        epub.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml", CONTAINER_XML)
+        epub.writestr("content.opf", OPF.format(title=title, author=author))
+        epub.writestr("c1.xhtml", "<html><body><p>{}</p></body></html>".format(title * 50))
+    return path
+
+
+class StubServer:
+    """Local http server, a handler registered for a path gets the number of the request to the path and returns
+    (status, headers, body, delay in seconds)"""
+    def __init__(self):
+        self.routes = dict()
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                with stub._lock:
+                    stub.calls[path] += 1
+                    number = stub.calls[path]
+                status, headers, body, delay = stub.routes[path](number, self.headers)
+                if delay:
+                    time.sleep(delay)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def route(self, path, handler):
+        self.routes[path] = handler
+        return self.url(path)
+
+    def url(self, path):
+        return "http://127.0.0.1:{}{}".format(self.server.server_port, path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture(scope="session")
+def workdir(tmp_path_factory):
+    return tmp_path_factory.mktemp("calibre-web")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def isolated_dirs(workdir):
+    """Caches of the test run are written to the work directory instead of the checkout, the log file is passed to the
+    app with -o"""
+    from cps.fs import FileSystem
+    saved = FileSystem._cache_dir
+    FileSystem._cache_dir = str(workdir / "cache")
+    yield
+    FileSystem._cache_dir = saved
+
+
+@pytest.fixture(scope="session")
+def app(workdir, isolated_dirs):
+    from kobo_sync_benchmark import generate_library
+    library = str(workdir / "library")
+    generate_library(library, BOOK_COUNT)
+    argv = sys.argv
+    sys.argv = ["cps", "-p", str(workdir / "app.db"), "-g", str(workdir / "gdrive.db"),
+                "-o", str(workdir / "calibre-web.log")]
+    try:
+        import cps
+        from cps import db, config
+        cw_app = cps.create_app()
+    finally:
+        sys.argv = argv
+    config.config_calibre_dir = library
+    config.config_ratelimiter = False
+    config.save()
+    cw_app.config.update(TESTING=True, RATELIMIT_ENABLED=False, WTF_CSRF_ENABLED=False)
+    db.CalibreDB.update_config(config, library, str(workdir / "app.db"))
+    from cps.jinjia import jinjia
+    from cps.web import web
+    from cps.opds import opds
+    from cps.opds2 import opds2
+    from cps.admin import admi
+    cw_app.register_blueprint(jinjia)
+    cw_app.register_blueprint(web)
+    cw_app.register_blueprint(opds)
+    cw_app.register_blueprint(opds2)
+    cw_app.register_blueprint(admi)
+    yield cw_app
+    # the updater thread would keep the test run alive
+    cps.updater_thread.stop()
+
+
+@pytest.fixture
+def calibre_session(app):
+    """Session of the library outside of any request"""
+    from cps import db
+    with app.app_context():
+        calibre_db = db.CalibreDB(app)
+        yield calibre_db.session
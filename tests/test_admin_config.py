@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+PASSWORD = "Admin-Test-1"
+
+
+@pytest.fixture
+def admin_client(app):
+    from werkzeug.security import generate_password_hash
+    from cps import ub
+    admin = ub.session.query(ub.User).filter(ub.User.id == 1).one()
+    admin.password = generate_password_hash(PASSWORD)
+    ub.session.commit()
+    client = app.test_client()
+    response = client.post("/login", data={"username": admin.name, "password": PASSWORD})
+    assert response.status_code == 302
+    return client
+
+
+@pytest.mark.parametrize("field, value", [
+    ("config_enrichment_burst", "many"),
+    ("config_enrichment_burst", "0"),
+    ("config_enrichment_workers", "2.5"),
+    ("config_enrichment_workers", "64"),
+])
+def test_invalid_enrichment_settings_rejected(admin_client, field, value):
+    from cps import config
+    before = getattr(config, field)
+    response = admin_client.post("/admin/ajaxconfig", data={field: value})
+    assert response.status_code == 200
+    assert response.get_json()["result"][0]["type"] == "danger"
+    assert getattr(config, field) == before
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+
+@pytest.fixture
+def editor(app):
+    """Request context of the admin user, yields the session of the library"""
+    from flask import g
+    from cps import calibre_db, ub
+    with app.test_request_context():
+        g._login_user = ub.session.query(ub.User).filter(ub.User.id == 1).one()
+        yield calibre_db.session
+
+
+def stored(session, book_ids):
+    from cps import db
+    session.expire_all()
+    return {book.id: (book.title, sorted(tag.name for tag in book.tags))
+            for book in session.query(db.Books).filter(db.Books.id.in_(book_ids))}
+
+
+def tag_exists(session, name):
+    from cps import db
+    return session.query(db.Tags).filter(db.Tags.name == name).count() > 0
+
+
+def test_dry_run_reports_changes_without_storing(editor):
+    from cps.editbooks import bulk_edit_books
+    before = stored(editor, [1, 2])
+
+    success, report = bulk_edit_books([1, 2], [('title', 'Bulk Title'), ('tags', 'Bulk Dry Run')], dry_run=True)
+
+    assert success
+    assert all(entry['changes']['title'] == 'Bulk Title' for entry in report)
+    assert all('Bulk Dry Run' in entry['changes']['tags'] for entry in report)
+    assert stored(editor, [1, 2]) == before
+    assert not tag_exists(editor, 'Bulk Dry Run')
+
+
+def test_invalid_language_stores_nothing(editor):
+    from cps.editbooks import bulk_edit_books
+    before = stored(editor, [1, 2])
+
+    success, report = bulk_edit_books([1, 2], [('tags', 'Bulk Failed'), ('languages', 'No Such Language')])
+
+    assert not success
+    assert not any(entry['success'] for entry in report)
+    assert all('no such language' in entry['msg'].lower() for entry in report)
+    assert stored(editor, [1, 2]) == before
+    assert not tag_exists(editor, 'Bulk Failed')
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+import pytest
+
+
+@pytest.fixture
+def document_index(app):
+    from cps import document_index
+    return document_index
+
+
+def koreader_partial_md5(data):
+    """util.partialMD5 of KOReader, bit.lshift works on 32 bit integers with the shift count taken modulo 32"""
+    md5 = hashlib.md5()
+    for i in range(-1, 11):
+        offset = (1024 << ((2 * i) & 31)) & 0xFFFFFFFF
+        sample = data[offset:offset + 1024]
+        if not sample:
+            break
+        md5.update(sample)
+    return md5.hexdigest()
+
+
+@pytest.mark.parametrize("size", [0, 500, 1024, 5000, 70000, 3 * 1024 * 1024])
+def test_partial_md5_matches_koreader(document_index, tmp_path, size):
+    data = bytes(index % 251 for index in range(size))
+    book = tmp_path / "book.epub"
+    book.write_bytes(data)
+    assert document_index.partial_md5(str(book)) == koreader_partial_md5(data)
+
+
+def test_partial_md5_known_digest(document_index, tmp_path):
+    book = tmp_path / "book.epub"
+    book.write_bytes(b"calibre-web" * 100000)
+    assert document_index.partial_md5(str(book)) == "d62c7e8acba5b5e3317609383b5bd579"
+
+
+def test_refresh_queued_once(document_index, tmp_path, monkeypatch):
+    monkeypatch.setattr(document_index, "REFRESH_INTERVAL", 0)
+    index = document_index.DocumentIndex(path=str(tmp_path / "documents.db"))
+    assert not index.refresh_due()
+    index.sequence = 0
+    assert index.refresh_due()
+    assert not index.refresh_due()
+    index.refresh_done()
+    assert index.refresh_due()
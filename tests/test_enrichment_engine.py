@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import pytest
+
+from cps.services import enrichment_engine
+from cps.services.enrichment_engine import RateLimitedHttp, TokenBucket
+
+
+@pytest.fixture(autouse=True)
+def short_backoff(monkeypatch):
+    monkeypatch.setattr(enrichment_engine, "BACKOFF_BASE", 0.01)
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=20, burst=2)
+    start = time.perf_counter()
+    waited = sum(bucket.acquire() for __ in range(8))
+    elapsed = time.perf_counter() - start
+    # the burst passes at once, the other 6 requests wait 1/20 s each
+    assert elapsed == pytest.approx(0.3, abs=0.1)
+    assert waited == pytest.approx(0.3, abs=0.1)
+
+
+def test_requests_to_host_are_rate_limited(stub_server):
+    url = stub_server.route("/author", lambda number, headers: (200, {}, b"{}", 0))
+    http = RateLimitedHttp(rate=10, burst=1, concurrency=4)
+    start = time.perf_counter()
+    for __ in range(4):
+        assert http.get(url, cached=False).status_code == 200
+    assert time.perf_counter() - start >= 0.28
+    assert http.get_stats()[url.split("/")[2]]["requests"] == 4
+
+
+def test_throttled_request_honors_retry_after(stub_server):
+    url = stub_server.route("/throttled", lambda number, headers:
+                            (429, {"Retry-After": "1"}, b"", 0) if number == 1 else (200, {}, b"{}", 0))
+    http = RateLimitedHttp(rate=100, burst=5)
+    start = time.perf_counter()
+    response = http.get(url, cached=False)
+
+    assert response.status_code == 200
+    assert time.perf_counter() - start >= 1
+    stats = http.get_stats()[url.split("/")[2]]
+    assert (stats["requests"], stats["retries"], stats["throttled"]) == (2, 1, 1)
+
+
+def test_server_errors_are_retried(stub_server, monkeypatch):
+    monkeypatch.setattr(enrichment_engine, "MAX_RETRIES", 2)
+    flaky = stub_server.route("/flaky", lambda number, headers:
+                              (503, {}, b"", 0) if number <= 2 else (200, {}, b"{}", 0))
+    down = stub_server.route("/down", lambda number, headers: (500, {}, b"", 0))
+    http = RateLimitedHttp(rate=100, burst=5)
+
+    assert http.get(flaky, cached=False).status_code == 200
+    assert stub_server.calls["/flaky"] == 3
+    # the last answer is returned once the retries are used up
+    assert http.get(down, cached=False).status_code == 500
+    assert stub_server.calls["/down"] == 3
+    stats = http.get_stats()[flaky.split("/")[2]]
+    assert stats["server_errors"] == 5 and stats["retries"] == 4
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import requests
+
+from cps.http_cache import HttpCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return HttpCache(path=str(tmp_path / "http.db"))
+
+
+def fetch(cache, url, headers=None):
+    return cache.get(url, lambda request_headers: requests.get(url, headers=request_headers, timeout=5), headers)
+
+
+def test_variants_stored_per_vary_header(cache, stub_server):
+    def handler(number, headers):
+        return 200, {"Cache-Control": "max-age=60", "Vary": "Accept-Language"}, \
+            headers.get("Accept-Language", "").encode(), 0
+    url = stub_server.route("/vary", handler)
+
+    assert fetch(cache, url, {"Accept-Language": "de"}).text == "de"
+    assert fetch(cache, url, {"Accept-Language": "fr"}).text == "fr"
+    assert fetch(cache, url, {"accept-language": "de"}).text == "de"
+    assert fetch(cache, url, {"Accept-Language": "fr"}).text == "fr"
+    assert stub_server.calls["/vary"] == 2
+    assert cache.stats["hits"] == 2
+
+
+def test_vary_star_not_stored(cache, stub_server):
+    url = stub_server.route("/star", lambda number, headers: (200, {"Cache-Control": "max-age=60", "Vary": "*"},
+                                                              b"body", 0))
+    fetch(cache, url)
+    fetch(cache, url)
+    assert stub_server.calls["/star"] == 2
+
+
+def test_stale_entry_served_on_server_error(cache, stub_server):
+    def handler(number, headers):
+        if number == 1:
+            return 200, {"Cache-Control": "no-cache"}, b"stored", 0
+        return 503, {}, b"unavailable", 0
+    url = stub_server.route("/error", handler)
+
+    assert fetch(cache, url).text == "stored"
+    response = fetch(cache, url)
+    assert response.status_code == 200
+    assert response.text == "stored"
+    assert cache.stats["stale"] == 1
+
+
+def test_server_error_without_entry_passed_on(cache, stub_server):
+    url = stub_server.route("/down", lambda number, headers: (500, {}, b"error", 0))
+    assert fetch(cache, url).status_code == 500
+    assert fetch(cache, url).status_code == 500
+    assert stub_server.calls["/down"] == 2
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+
+def test_download_url_base_filled_in(app):
+    from cps.kobo_metadata_cache import KoboMetadataCache, URL_BASE
+    metadata = {"Description": "Stays " + URL_BASE, "Title": "Ünïcode",
+                "DownloadUrls": [{"Url": URL_BASE + "/1/epub"}, {"Url": URL_BASE + "/1/kepub"}]}
+    url_base = "http://host:8083/kobo/token/download"
+
+    filled = json.loads(KoboMetadataCache.fill(json.dumps(metadata, ensure_ascii=False), url_base))
+
+    assert [entry["Url"] for entry in filled["DownloadUrls"]] == [url_base + "/1/epub", url_base + "/1/kepub"]
+    assert filled["Description"] == metadata["Description"]
+    assert filled["Title"] == "Ünïcode"
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta, timezone
+
+
+def user_entries(user_id):
+    from cps import ub
+    return ub.session.query(ub.LibraryChange).filter(ub.LibraryChange.user_id == user_id,
+                                                     ub.LibraryChange.change_type == ub.LibraryChange.TYPE_USER).count()
+
+
+def test_only_visibility_settings_are_recorded(app):
+    from cps import ub
+    user = ub.session.query(ub.User).filter(ub.User.id == 1).one()
+    before = user_entries(user.id)
+
+    user.set_view_property("table", "sort", "title")
+    ub.session.commit()
+    assert user_entries(user.id) == before
+
+    user.denied_tags = "hidden tag"
+    ub.session.commit()
+    assert user_entries(user.id) == before + 1
+
+    user.denied_tags = ""
+    ub.session.commit()
+
+
+def test_prune_keeps_newest_entry_and_reports_pruned_changes(app):
+    from cps import ub, library_changes
+    old = datetime.now(timezone.utc) - timedelta(days=library_changes.RETENTION_DAYS + 1)
+    library_changes.record([1, 2], ub.LibraryChange.TYPE_MODIFIED)
+    sequence = library_changes.latest_sequence()
+    library_changes.record(3, ub.LibraryChange.TYPE_MODIFIED)
+    library_changes.record(4, ub.LibraryChange.TYPE_MODIFIED)
+    ub.session.query(ub.LibraryChange).update({ub.LibraryChange.timestamp: old})
+    ub.session.commit()
+
+    library_changes.prune(ub.session)
+    ub.session.commit()
+
+    assert ub.session.query(ub.LibraryChange).count() == 1
+    latest = library_changes.latest_sequence()
+    assert latest == sequence + 2
+    # the change of book 3 is gone, a consumer from before it has to check everything
+    assert library_changes.changed_books_since(sequence) == (latest, None)
+    assert library_changes.has_changes_since(sequence)
+    assert library_changes.changed_books_since(latest - 1) == (latest, {4})
+    assert not library_changes.has_changes_since(latest)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+
+import pytest
+
+from cps import metadata_gateway
+from cps.http_cache import HttpCache
+from cps.metadata_gateway import HostPools, MetadataGateway, ResponseCache
+from cps.services.Metadata import Metadata, MetaRecord, MetaSourceInfo
+
+
+class StubProvider(Metadata):
+    """Provider searching the stub server, the titles of the json answer are returned as records"""
+    def __init__(self, provider_id, url):
+        super().__init__()
+        self.__id__ = provider_id
+        self.__name__ = provider_id
+        self.url = url
+
+    def search(self, query, generic_cover="", locale="en"):
+        response = metadata_gateway.provider_http.get(self.url, params={"q": query})
+        response.raise_for_status()
+        source = MetaSourceInfo(id=self.__id__, description=self.__name__, link=self.url)
+        return [MetaRecord(id=index, title=title, authors=[], url=self.url, source=source)
+                for index, title in enumerate(response.json())]
+
+
+def answer(*titles, delay=0):
+    def handler(number, headers):
+        return 200, {"Content-Type": "application/json"}, json.dumps(list(titles)).encode(), delay
+    return handler
+
+
+@pytest.fixture
+def gateway(tmp_path, monkeypatch):
+    # the provider requests bypass the http cache of the installation
+    monkeypatch.setattr(metadata_gateway, "http_cache", HttpCache(path=str(tmp_path / "http.db")))
+    return MetadataGateway(cache=ResponseCache(path=str(tmp_path / "responses.db")))
+
+
+def test_results_are_cached_until_ttl(gateway, stub_server, monkeypatch):
+    provider = StubProvider("stub", stub_server.route("/search", answer("Dune")))
+
+    records, late = gateway.search([provider], "Dune")
+    assert [record["title"] for record in records] == ["Dune"] and late == []
+
+    statuses = [status for __, __, __, status in gateway.stream([provider], "  dune ")]
+    assert statuses == ["cached"]
+    assert stub_server.calls["/search"] == 1
+    assert gateway.get_stats()["providers"]["stub"]["cache_hits"] == 1
+
+    # entries written with an expired ttl are not served
+    monkeypatch.setattr(metadata_gateway, "CACHE_TTL", -1)
+    gateway.search([provider], "Emma")
+    gateway.search([provider], "Emma")
+    assert stub_server.calls["/search"] == 3
+
+
+def test_budget_returns_partial_results(gateway, stub_server):
+    fast = StubProvider("fast", stub_server.route("/fast", answer("Fast Book")))
+    slow = StubProvider("slow", stub_server.route("/slow", answer("Slow Book", delay=1.5)))
+
+    start = time.perf_counter()
+    records, late = gateway.search([fast, slow], "Budget", budget=0.5)
+
+    assert time.perf_counter() - start < 1.2
+    assert [record["title"] for record in records] == ["Fast Book"]
+    assert late == [slow]
+    # the late answer is still stored for the next search
+    time.sleep(1.5)
+    assert [status for provider, __, __, status in gateway.stream([slow], "Budget")] == ["cached"]
+
+
+def test_slow_request_is_hedged_after_p95(stub_server, monkeypatch):
+    monkeypatch.setattr(metadata_gateway, "HEDGE_MIN_DELAY", 0.1)
+    pools = HostPools()
+    fast_url = stub_server.route("/fast", answer("Fast"))
+    for __ in range(metadata_gateway.HEDGE_MIN_SAMPLES):
+        pools.request("GET", fast_url, cached=False)
+    host = fast_url.split("/")[2]
+    assert pools.hedge_delay(host) == pytest.approx(0.1, abs=0.05)
+
+    # the first request hangs, the hedged second one answers at once
+    slow_url = stub_server.route("/stall", lambda number, headers: (200, {}, b"[]", 3 if number == 1 else 0))
+    start = time.perf_counter()
+    response = pools.request("GET", slow_url, hedge=True, cached=False)
+
+    assert response.status_code == 200
+    assert time.perf_counter() - start < 1
+    assert stub_server.calls["/stall"] == 2
+    assert pools.get_stats()[host]["hedged"] == 1
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+
+@pytest.fixture
+def sync_user(app, tmp_path):
+    from cps import ub
+    user = ub.session.query(ub.User).filter(ub.User.id == 1).one()
+    user.mobile_sync_path = str(tmp_path)
+    ub.session.commit()
+    yield user
+    ub.session.query(ub.MobileBackup).filter(ub.MobileBackup.user_id == user.id).delete()
+    user.mobile_sync_path = ""
+    ub.session.commit()
+
+
+def ledger(user):
+    from cps import ub
+    return {entry.path: entry for entry in
+            ub.session.query(ub.MobileBackup).filter(ub.MobileBackup.user_id == user.id)}
+
+
+def test_unreadable_backup_not_recorded(app, sync_user, tmp_path):
+    from cps.mobile import ProgressImport, sync_user_backups
+    librera = tmp_path / "app-Progress.json"
+    librera.write_text(json.dumps({"/sdcard/Books/Unknown Book.epub": {"p": 0.5}}))
+    broken = tmp_path / "backup.mrpro"
+    broken.write_bytes(b"not a zip archive")
+
+    with app.app_context():
+        sync_user_backups(ProgressImport(sync_user))
+        entries = ledger(sync_user)
+        assert set(entries) == {str(librera)}
+        assert entries[str(librera)].entries == 1
+
+        # the broken file is read again, the unchanged one isn't
+        progress = ProgressImport(sync_user)
+        sync_user_backups(progress)
+        assert set(ledger(sync_user)) == {str(librera)}
+        assert progress.unmatched == []
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import json
+import re
+
+import pytest
+
+USER = "opds-test"
+PASSWORD = "opds-test"
+
+
+@pytest.fixture
+def client(app):
+    from werkzeug.security import generate_password_hash
+    from cps import ub, constants
+    user = ub.session.query(ub.User).filter(ub.User.name == USER).first()
+    if not user:
+        user = ub.User()
+        user.name = USER
+        user.email = "{}@example.org".format(USER)
+        user.role = constants.ROLE_DOWNLOAD
+        user.sidebar_view = constants.ADMIN_USER_SIDEBAR
+        ub.session.add(user)
+    user.password = generate_password_hash(PASSWORD)
+    ub.session.commit()
+    client = app.test_client()
+    client.environ_base["HTTP_AUTHORIZATION"] = \
+        "Basic " + base64.b64encode("{}:{}".format(USER, PASSWORD).encode("utf-8")).decode("ascii")
+    return client
+
+
+@pytest.fixture
+def page_counts(app, calibre_session):
+    from cps import db, ub
+    counts = dict()
+    ub.session.query(ub.EpubStructure).delete()
+    for number, (book_id, size) in enumerate(calibre_session.query(db.Data.book, db.Data.uncompressed_size)
+                                             .filter(db.Data.format == "EPUB")):
+        counts[book_id] = 100 + number
+        ub.session.add(ub.EpubStructure(book_id=book_id, format="EPUB", size=size, mtime=0, layout="reflowable",
+                                        spine_length=1, page_count=counts[book_id], opf_version="2.0"))
+    ub.session.commit()
+    yield counts
+    ub.session.query(ub.EpubStructure).delete()
+    ub.session.commit()
+
+
+def extents(feed):
+    entries = re.findall(r"<entry>.*?</entry>", feed, re.DOTALL)
+    return {re.search(r"<id>(.*?)</id>", entry).group(1): re.search(r"<dcterms:extent>(.*?)</dcterms:extent>",
+                                                                    entry).group(1)
+            for entry in entries}
+
+
+def test_streamed_and_paginated_feeds_show_page_counts(client, page_counts):
+    catalog = client.get("/opds/catalog")
+    new = client.get("/opds/new")
+    assert catalog.status_code == 200
+    assert new.status_code == 200
+    streamed = extents(catalog.get_data(as_text=True))
+    assert len(streamed) == len(page_counts)
+    assert sorted(streamed.values()) == sorted("{} pages".format(count) for count in page_counts.values())
+    assert streamed == extents(new.get_data(as_text=True))
+
+
+def test_feed_cache_bounded_by_size():
+    from cps.opds_cache import OpdsFeedCache
+    cache = OpdsFeedCache(max_size=100)
+    for etag in "abc":
+        cache.set(etag, b"x" * 40, "application/atom+xml")
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    cache.set("d", b"x" * 40, "application/atom+xml")
+    # b was used after c
+    assert cache.get("c") is None
+    assert cache.get("b") is not None
+    cache.set("b", b"x" * 10, "application/atom+xml")
+    cache.set("e", b"x" * 200, "application/atom+xml")
+    assert cache.get("e") is None
+    assert cache.get_stats()["size"] == 50
+
+
+def cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+@pytest.mark.parametrize("path, values", [
+    ("/opds2/new", ["2024-01-01", "x"]),
+    ("/opds2/new", [{"a": 1}, 1]),
+    ("/opds2/new", [["x"], 1]),
+    ("/opds2/new", ["2024-01-01"]),
+    ("/opds2/new", []),
+    ("/opds2/hot", ["x"]),
+    ("/opds2/hot", [[1]]),
+    ("/opds2/hot", [-1]),
+    ("/opds2/hot", [True]),
+])
+def test_invalid_cursor_rejected(client, path, values):
+    assert client.get(path, query_string={"cursor": cursor(values)}).status_code == 400
+
+
+def test_next_cursor_followed(client, app, monkeypatch):
+    from cps import config
+    monkeypatch.setattr(config, "config_books_per_page", 5)
+    seen = []
+    path = "/opds2/new"
+    while path:
+        response = client.get(path)
+        assert response.status_code == 200
+        feed = response.get_json()
+        seen.extend(publication["metadata"]["identifier"] for publication in feed["publications"])
+        path = next((link["href"] for link in feed["links"] if link["rel"] == "next"), None)
+    assert len(seen) == len(set(seen))
+    assert len(seen) > 5
+
+
+def test_link_cache_invalidates_book_entries(app):
+    from cps.opds_links import AcquisitionLinkCache
+    cache = AcquisitionLinkCache(max_entries=3)
+    cache._set((1, "generic", ""), 1, ["a"])
+    cache._set((1, "kobo", ""), 1, ["b"])
+    cache._set((2, "generic", ""), 1, ["c"])
+    cache.invalidate(1)
+    assert cache._get((1, "generic", ""), 1) is None
+    assert cache._get((1, "kobo", ""), 1) is None
+    assert cache._get((2, "generic", ""), 1) == ["c"]
+    for book_id in (3, 4, 5):
+        cache._set((book_id, "generic", ""), 1, ["d"])
+    # book 2 was dropped as least recently used, its index entry too
+    assert cache._get((2, "generic", ""), 1) is None
+    assert set(cache._book_keys) == {3, 4, 5}
+    cache.invalidate(2)
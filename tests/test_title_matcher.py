@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from cps import db
+from cps.title_matcher import TitleMatcher, CONFIDENCE_TITLE_AUTHOR, FUZZY_CUTOFF, FUZZY_WEIGHT
+
+# id, title, authors, series, series_index, file name
+BOOKS = [
+    (1, "Les Misérables", "Victor Hugo", None, "1.0", "Les Miserables - Victor Hugo"),
+    (2, "The Hitchhiker's Guide to the Galaxy", "Douglas Adams", None, "1.0", "The Hitchhiker's Guide to the Galaxy"),
+    (3, "Foundation and Empire", "Isaac Asimov", "Foundation", "2.0", "Foundation and Empire - Isaac Asimov"),
+    (4, "Emma", "Jane Austen", None, "1.0", "Emma - Jane Austen"),
+    (5, "Emma", "Alexander McCall Smith", None, "1.0", "Emma - Alexander McCall Smith"),
+    (6, "The Name of the Rose", "Umberto Eco", None, "1.0", "The Name of the Rose - Umberto Eco"),
+]
+
+
+@pytest.fixture(scope="module")
+def matcher():
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def attach(connection, record):
+        connection.execute("attach database ':memory:' as calibre")
+
+    tables = [db.Books.__table__, db.Authors.__table__, db.Series.__table__, db.Data.__table__,
+              db.books_authors_link, db.books_series_link]
+    db.Base.metadata.create_all(engine, tables=tables)
+    session = sessionmaker(bind=engine)()
+    for book_id, title, author, series, series_index, file_name in BOOKS:
+        session.execute(db.Books.__table__.insert().values(id=book_id, title=title, series_index=series_index,
+                                                           path="", flags=1))
+        session.execute(db.Authors.__table__.insert().values(id=book_id, name=author, sort=author, link=""))
+        session.execute(db.books_authors_link.insert().values(book=book_id, author=book_id))
+        session.execute(db.Data.__table__.insert().values(book=book_id, format="EPUB", uncompressed_size=1,
+                                                          name=file_name))
+        if series:
+            session.execute(db.Series.__table__.insert().values(id=book_id, name=series, sort=series))
+            session.execute(db.books_series_link.insert().values(book=book_id, series=book_id))
+    session.commit()
+    yield TitleMatcher(session)
+    session.close()
+
+
+@pytest.mark.parametrize("name, author, book_id, method", [
+    # accents and punctuation folded
+    ("LES MISERABLES", None, 1, "title"),
+    ("Les_Misérables!", None, 1, "title"),
+    ("THE HITCHHIKER_S GUIDE TO THE GALAXY!.epub", None, 2, "file"),
+    ("the hitchhiker’s guide, to the galaxy", "Douglas Adams", 2, "title_author"),
+    # "Title - Author" names of calibre files
+    ("Emma - Jane Austen.mobi", None, 4, "file"),
+    ("Emma - Alexander McCall Smith (copy)", None, 5, "title_author"),
+    ("Emma - Austen", None, 4, "title_author"),
+    # series numbering stripped
+    ("Foundation and Empire (Foundation #2)", None, 3, "series"),
+    ("02 - Foundation and Empire", None, 3, "series"),
+    ("Foundation 02", None, 3, "series"),
+    # calibre id
+    ("Anything (6)", None, 6, "id"),
+])
+def test_match(matcher, name, author, book_id, method):
+    match = matcher.match(name, author)
+    assert match is not None
+    assert (match.book_id, match.method) == (book_id, method)
+
+
+def test_title_author_split_confidence(matcher):
+    match = matcher.match("Foundation and Empire - Asimov")
+    assert match == (3, CONFIDENCE_TITLE_AUTHOR, "title_author")
+
+
+def test_fuzzy_hit(matcher):
+    match = matcher.match("The Name of teh Rose")
+    assert (match.book_id, match.method) == (6, "fuzzy")
+    assert FUZZY_CUTOFF * FUZZY_WEIGHT <= match.confidence < FUZZY_WEIGHT
+
+
+@pytest.mark.parametrize("name, author", [
+    ("A Completely Different Book", None),
+    ("Galaxy Quest", "Unknown Writer"),
+    ("Anything (99)", None),
+])
+def test_clear_miss(matcher, name, author):
+    assert matcher.match(name, author) is None
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import uuid
+
+import pytest
+
+from conftest import make_epub
+
+
+@pytest.fixture
+def upload(app, tmp_path):
+    """Returns a function storing an uploaded file like queue_uploads, (temp file path, file name, sha256)"""
+    from cps import uploader
+    from cps.file_helper import get_temp_dir
+
+    def store(source, file_name):
+        tmp_file_path = os.path.join(get_temp_dir(), uuid.uuid4().hex)
+        shutil.copyfile(str(source), tmp_file_path)
+        return tmp_file_path, file_name, uploader.file_sha256(tmp_file_path)
+    return store
+
+
+def run_import(files):
+    from cps.tasks.upload import TaskImportUploads
+    task = TaskImportUploads(files, 1)
+    task.start(None)
+    return task
+
+
+def books_titled(calibre_session, title):
+    from cps import db
+    calibre_session.expire_all()
+    return calibre_session.query(db.Books).filter(db.Books.title == title).all()
+
+
+def library_file(calibre_session, book_id):
+    from cps import db, config
+    book = calibre_session.query(db.Books).filter(db.Books.id == book_id).one()
+    return os.path.join(config.get_book_path(), book.path, book.data[0].name + ".epub")
+
+
+def test_duplicates_are_rejected(upload, calibre_session, tmp_path):
+    new_book = make_epub(tmp_path / "new.epub", "Duplicate Check", "Upload Author")
+    files = [upload(library_file(calibre_session, 1), "copy.epub"),
+             upload(new_book, "new.epub"),
+             upload(new_book, "new-again.epub")]
+
+    task = run_import(files)
+
+    assert (task.imported, task.duplicates, task.failed) == (1, 2, 0)
+    assert len(books_titled(calibre_session, "Duplicate Check")) == 1
+    assert not any(os.path.exists(tmp_file_path) for tmp_file_path, __, __ in files)
+
+
+def test_batches_are_committed(upload, calibre_session, tmp_path, monkeypatch):
+    from cps.tasks import upload as upload_task
+    monkeypatch.setattr(upload_task, "BATCH_SIZE", 2)
+    batches = []
+    import_batch = upload_task.TaskImportUploads._import_batch
+
+    def counting_batch(self, calibre_db, editbooks, metas):
+        batches.append(len(metas))
+        return import_batch(self, calibre_db, editbooks, metas)
+    monkeypatch.setattr(upload_task.TaskImportUploads, "_import_batch", counting_batch)
+    files = [upload(make_epub(tmp_path / "batch{}.epub".format(i), "Batch Book {}".format(i), "Batch Author"),
+                    "batch{}.epub".format(i)) for i in range(3)]
+
+    task = run_import(files)
+
+    assert batches == [2, 1]
+    assert task.imported == 3
+    for i in range(3):
+        assert len(books_titled(calibre_session, "Batch Book {}".format(i))) == 1
+
+
+def test_failing_file_only_rolls_back_its_book(upload, calibre_session, tmp_path, monkeypatch):
+    from cps import editbooks, config
+    add_uploaded_book = editbooks.add_uploaded_book
+    failed_paths = []
+
+    def failing_add(meta):
+        db_book, error = add_uploaded_book(meta)
+        if db_book.title == "Broken Book":
+            failed_paths.append(os.path.join(config.get_book_path(), db_book.path))
+            return db_book, "moving failed"
+        return db_book, error
+    monkeypatch.setattr(editbooks, "add_uploaded_book", failing_add)
+    files = [upload(make_epub(tmp_path / "{}.epub".format(title), title, "Rollback Author"), title + ".epub")
+             for title in ("Good Book A", "Broken Book", "Good Book B")]
+
+    task = run_import(files)
+
+    assert (task.imported, task.failed) == (2, 1)
+    assert len(books_titled(calibre_session, "Good Book A")) == 1
+    assert len(books_titled(calibre_session, "Good Book B")) == 1
+    assert books_titled(calibre_session, "Broken Book") == []
+    # the files moved for the rolled back book are removed again
+    assert failed_paths and not os.path.exists(failed_paths[0])
+    for title in ("Good Book A", "Good Book B"):
+        book = books_titled(calibre_session, title)[0]
+        assert os.path.exists(library_file(calibre_session, book.id))